@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Benchmark: JSON backends on a getUpdates-sized response (100 updates) and on to_json of reply markups.
+
+    PYTHONPATH=. python benchmarks/bench_json_backend.py [iterations]
+"""
+import json
+import sys
+import timeit
+
+from tgbotapi import types, utils
+
+
+def make_response(count=100):
+    updates = []
+    for i in range(count):
+        updates.append({
+            "update_id": 938203 + i,
+            "message": {
+                "message_id": 241 + i,
+                "from": {"id": 383324787, "is_bot": False, "first_name": "Mustafa", "last_name": "Asaad",
+                         "username": "MA24th", "language_code": "en"},
+                "chat": {"id": -1001405936102, "title": "GRID9", "type": "supergroup"},
+                "date": 1441447009 + i,
+                "text": "/start@gu9rdbot some arguments for the command, عطلة سعيدة",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 15}]
+            }
+        })
+    return json.dumps({"ok": True, "result": updates}, ensure_ascii=False).encode('utf-8')
+
+
+def make_markup():
+    markup = types.InlineKeyboardMarkup(row_width=3)
+    for i in range(12):
+        markup.add(types.InlineKeyboardButton(text='Button {0}'.format(i), callback_data='menu:item:{0}'.format(i)))
+    return markup
+
+
+def bench(label, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print("{0:<40} {1:>10.2f} us/op".format(label, seconds / number * 1e6))
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    markup = make_markup()
+    raw = make_response()
+    print("getUpdates response: {0} bytes".format(len(raw)))
+    for backend in ('json', 'ujson', 'orjson'):
+        try:
+            utils.set_json_backend(backend)
+        except ValueError:
+            print("-- {0}: not installed".format(backend))
+            continue
+        print("-- {0}".format(backend))
+        bench("json_loads(getUpdates response)", lambda: utils.json_loads(raw), number)
+        bench("loads + Update.de_json x100",
+              lambda: [types.Update.de_json(x) for x in utils.json_loads(raw)['result']], number)
+        bench("InlineKeyboardMarkup.to_json()", markup.to_json, number * 10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Benchmark: peak memory of encoding a multipart upload, requests' files= against utils.MultipartEncoder.
+
+    PYTHONPATH=. python benchmarks/bench_multipart_upload.py [size in MB]
+"""
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import requests
+
+from tgbotapi import utils
+
+
+def measure(label, func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = func()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("{0:<30} {1:>10} bytes {2:>8.1f} MB peak {3:>8.3f} s".format(label, size, peak / 1e6, seconds))
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with tempfile.TemporaryFile() as document:
+        document.write(b'\0' * megabytes * 1000000)
+
+        def with_requests():
+            document.seek(0)
+            return len(requests.Request('POST', 'http://localhost/', files={'document': document}).prepare().body)
+
+        def with_encoder():
+            document.seek(0)
+            body = utils.MultipartEncoder(None, {'document': document})
+            size = 0
+            chunk = body.read(16384)
+            while chunk:
+                size += len(chunk)
+                chunk = body.read(16384)
+            return size
+
+        measure("requests files=", with_requests)
+        measure("MultipartEncoder", with_encoder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark: Update.to_bytes / Update.from_bytes against de_json from JSON and against pickle.
+
+    python benchmarks/bench_update_binary.py [iterations]
+"""
+import json
+import pickle
+import sys
+import timeit
+
+from tgbotapi import types
+
+UPDATE = {
+    "update_id": 938203,
+    "message": {
+        "message_id": 241,
+        "from": {"id": 383324787, "is_bot": False, "first_name": "Mustafa", "last_name": "Asaad",
+                 "username": "MA24th", "language_code": "en"},
+        "chat": {"id": -1001405936102, "title": "GRID9", "type": "supergroup"},
+        "date": 1441447009,
+        "reply_to_message": {
+            "message_id": 240,
+            "from": {"id": 952435061, "is_bot": True, "first_name": "GuardBot", "username": "gu9rdbot"},
+            "chat": {"id": -1001405936102, "title": "GRID9", "type": "supergroup"},
+            "date": 1441447000,
+            "text": "Send me a photo, please"
+        },
+        "photo": [
+            {"file_id": "AgADBAADr6cxG0mxAAFT", "file_unique_id": "AQADmN", "width": 90, "height": 67,
+             "file_size": 1234},
+            {"file_id": "AgADBAADr6cxG0mxAAFU", "file_unique_id": "AQADmO", "width": 320, "height": 240,
+             "file_size": 22345},
+            {"file_id": "AgADBAADr6cxG0mxAAFV", "file_unique_id": "AQADmP", "width": 1280, "height": 960,
+             "file_size": 187654}
+        ],
+        "caption": "#holiday photos from @MA24th",
+        "caption_entities": [
+            {"type": "hashtag", "offset": 0, "length": 8},
+            {"type": "mention", "offset": 21, "length": 7}
+        ]
+    }
+}
+
+
+def bench(label, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print("{0:<40} {1:>10.2f} us/op".format(label, seconds / number * 1e6))
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    raw_json = json.dumps(UPDATE)
+    update = types.Update.de_json(UPDATE)
+    raw_binary = update.to_bytes()
+    raw_pickle = pickle.dumps(update, protocol=pickle.HIGHEST_PROTOCOL)
+
+    print("payload size: json={0} binary={1} pickle={2} bytes".format(
+        len(raw_json), len(raw_binary), len(raw_pickle)))
+    print("-- encode")
+    bench("Update.to_bytes()", update.to_bytes, number)
+    bench("pickle.dumps(update)", lambda: pickle.dumps(update, protocol=pickle.HIGHEST_PROTOCOL), number)
+    print("-- decode")
+    bench("Update.from_bytes(raw_binary)", lambda: types.Update.from_bytes(raw_binary), number)
+    bench("Update.de_json(raw_json)", lambda: types.Update.de_json(raw_json), number)
+    bench("pickle.loads(raw_pickle)", lambda: pickle.loads(raw_pickle), number)
+
+
+if __name__ == '__main__':
+    main()
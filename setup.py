@@ -20,7 +20,7 @@ setup(name='tgbotapi',
       license='GNU GPLv2',
       keywords='telegram-bot-api, tgbotapi, framework, telegram bot api, bot api',
       install_requires=['requests', 'six'],
-      extras_require={'json': 'json'},
+      extras_require={'json': ['orjson']},
       classifiers=['Development Status :: 5 - Production/Stable',
                    'Programming Language :: Python :: 3.6',
                    'Programming Language :: Python :: 3.7',
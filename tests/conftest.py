@@ -0,0 +1,12 @@
+import pytest
+
+from tgbotapi import utils
+
+
+@pytest.fixture(autouse=True)
+def stdlib_json():
+    # to_json tests compare against the standard library's formatting, whichever backend is installed
+    backend = utils.get_json_backend()
+    utils.set_json_backend('json')
+    yield
+    utils.set_json_backend(backend)
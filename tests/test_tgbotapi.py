@@ -0,0 +1,1236 @@
+import atexit
+import http.server
+import io
+import os
+import re
+import socketserver
+import threading
+import time
+
+import pytest
+import requests
+
+import tgbotapi
+from tgbotapi import methods
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer needs Python 3.7
+    daemon_threads = True
+
+
+def make_updates():
+    user = {"id": 383324787, "is_bot": False, "first_name": "Mustafa"}
+    chat = {"id": 383324787, "first_name": "Mustafa", "type": "private"}
+    return [
+        {"update_id": 10, "message": {"message_id": 1, "from": user, "chat": chat, "date": 1441447009,
+                                      "text": "hi"}},
+        {"update_id": 11, "poll": {"id": "5", "question": "?", "options": [], "total_voter_count": 0,
+                                   "is_closed": False, "is_anonymous": True, "type": "regular",
+                                   "allows_multiple_answers": False}},
+        {"update_id": 12, "callback_query": {"id": "7", "from": user, "chat_instance": "1", "data": "x"}},
+        {"update_id": 13, "edited_message": {"message_id": 1, "from": user, "chat": chat, "date": 1441447009,
+                                             "edit_date": 1441447010, "text": "hey"}},
+    ]
+
+
+def test_selective_decoding(monkeypatch):
+    requests = []
+
+    def get_updates(token, proxies, offset, limit, timeout, allowed_updates):
+        requests.append(offset)
+        return make_updates() if len(requests) == 1 else []
+
+    monkeypatch.setattr(methods, 'get_updates', get_updates)
+    bot = tgbotapi.TBot('token', threaded=False)
+    received = []
+
+    @bot.message_handler(func=lambda message: True)
+    def on_message(message):
+        received.append(message.text)
+
+    bot._TBot__retrieve_updates()
+    bot._TBot__retrieve_updates()
+    assert received == ['hi']
+    assert bot.get_skipped_updates() == {'poll': 1, 'callback_query': 1, 'edited_message': 1}
+    assert requests == [1, 14]
+
+
+class FakeResponse:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.reason = 'OK' if status_code == 200 else 'Not Found'
+        self.text = ''
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        return self.response
+
+
+def test_download_file_streaming(monkeypatch, tmp_path):
+    content = bytes(range(256)) * 40
+    session = FakeSession(FakeResponse(content))
+    monkeypatch.setattr(methods, 'get_req_session', lambda: session)
+    bot = tgbotapi.TBot('token', threaded=False, proxies={'https': 'socks5://proxy'})
+
+    assert bot.download_file('photos/file_1.jpg') == content
+    assert session.calls[-1] == ('https://api.telegram.org/file/bottoken/photos/file_1.jpg',
+                                 {'proxies': {'https': 'socks5://proxy'}})
+
+    chunks = list(bot.iter_download_file('photos/file_1.jpg', chunk_size=1000))
+    assert [len(chunk) for chunk in chunks] == [1000] * 10 + [240]
+    assert b''.join(chunks) == content
+    assert session.calls[-1][1] == {'proxies': {'https': 'socks5://proxy'}, 'stream': True}
+    assert session.response.closed
+
+    buffer = io.BytesIO()
+    assert bot.download_file('photos/file_1.jpg', buffer, chunk_size=4096) == len(content)
+    assert buffer.getvalue() == content
+
+    received = []
+    assert bot.download_file('photos/file_1.jpg', received.append, chunk_size=4096) == len(content)
+    assert len(received) == 3
+
+    path = tmp_path / 'file_1.jpg'
+    assert bot.download_file('photos/file_1.jpg', path) == len(content)
+    assert path.read_bytes() == content
+    assert os.listdir(str(tmp_path)) == ['file_1.jpg']
+
+
+def test_download_file_streaming_error(monkeypatch, tmp_path):
+    monkeypatch.setattr(methods, 'get_req_session', lambda: FakeSession(FakeResponse(b'', 404)))
+    bot = tgbotapi.TBot('token', threaded=False)
+    try:
+        bot.download_file('photos/missing.jpg', str(tmp_path / 'missing.jpg'))
+    except methods.ApiException:
+        pass
+    else:
+        assert False
+    assert os.listdir(str(tmp_path)) == []
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    content = b''
+    requests = []
+    fail_once = set()
+    short_once = set()
+
+    def do_GET(self):
+        match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+        start, end = int(match.group(1)), int(match.group(2))
+        self.requests.append(start)
+        if start in self.fail_once:
+            self.fail_once.discard(start)
+            self.send_error(500)
+            return
+        body = self.content[start:end + 1]
+        if start in self.short_once:
+            self.short_once.discard(start)
+            body = body[:len(body) // 2]
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, len(self.content)))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_download_file_ranged(monkeypatch, tmp_path):
+    RangeHandler.content = os.urandom(100000)
+    RangeHandler.requests = []
+    server = _Server(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(methods, 'FILE_URL', 'http://127.0.0.1:{0}/file/bot{{0}}/{{1}}'.format(server.server_port))
+    bot = tgbotapi.TBot('token', threaded=False)
+    file = tgbotapi.types.File('id', 'unique', len(RangeHandler.content), 'documents/file_1.bin')
+    path = str(tmp_path / 'file_1.bin')
+    try:
+        # segment 30000 fails on every attempt, the other segments are checkpointed
+        RangeHandler.fail_once = {30000}
+        try:
+            bot.download_file_ranged(file, path, segment_size=10000, num_threads=3, retries=0)
+        except methods.ApiException:
+            pass
+        else:
+            assert False
+        assert sorted(os.listdir(str(tmp_path))) == ['file_1.bin.part', 'file_1.bin.ranges']
+
+        RangeHandler.requests = []
+        RangeHandler.fail_once = {30000}
+        assert bot.download_file_ranged(file, path, segment_size=10000, num_threads=3, retries=1) == 100000
+        assert RangeHandler.requests == [30000, 30000]
+        with open(path, 'rb') as f:
+            assert f.read() == RangeHandler.content
+        assert os.listdir(str(tmp_path)) == ['file_1.bin']
+
+        # a short segment isn't recorded as done, the next call fetches it again
+        os.remove(path)
+        RangeHandler.requests = []
+        RangeHandler.short_once = {50000}
+        try:
+            bot.download_file_ranged(file, path, segment_size=10000, num_threads=3, retries=0)
+        except methods.ApiException:
+            pass
+        else:
+            assert False
+        assert not os.path.exists(path)
+        RangeHandler.requests = []
+        assert bot.download_file_ranged(file, path, segment_size=10000, num_threads=3, retries=0) == 100000
+        assert RangeHandler.requests == [50000]
+        with open(path, 'rb') as f:
+            assert f.read() == RangeHandler.content
+
+        # the checkpoint of another file of the same size isn't resumed
+        os.remove(path)
+        RangeHandler.fail_once = {90000}
+        try:
+            bot.download_file_ranged(file, path, segment_size=10000, num_threads=3, retries=0)
+        except methods.ApiException:
+            pass
+        else:
+            assert False
+        RangeHandler.content = os.urandom(100000)
+        RangeHandler.requests = []
+        other = tgbotapi.types.File('id2', 'unique2', 100000, 'documents/file_2.bin')
+        assert bot.download_file_ranged(other, path, segment_size=10000, num_threads=3, retries=0) == 100000
+        assert len(RangeHandler.requests) == 10
+        with open(path, 'rb') as f:
+            assert f.read() == RangeHandler.content
+
+        # the server has a file of another size than File.file_size
+        os.remove(path)
+        RangeHandler.content = os.urandom(120000)
+        try:
+            bot.download_file_ranged(other, path, segment_size=10000, num_threads=3, retries=0)
+        except methods.ApiException as e:
+            assert 'Content-Range' in str(e)
+        else:
+            assert False
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_upload_cache(monkeypatch, tmp_path):
+    sent = []
+
+    def send_photo(token, proxies, chat_id, photo, *args):
+        sent.append(photo if isinstance(photo, str) else photo.read())
+        if photo == 'stale':
+            raise methods.ApiException('Error code: 400 Description: Bad Request: wrong file identifier/HTTP URL '
+                                       'specified', 'sendPhoto', None)
+        file_id = photo if isinstance(photo, str) else 'id{0}'.format(len(sent))
+        return {"message_id": len(sent), "date": 1441447009, "chat": {"id": chat_id, "type": "private"},
+                "photo": [{"file_id": file_id + '-small', "file_unique_id": "s", "width": 90, "height": 90,
+                           "file_size": 1},
+                          {"file_id": file_id, "file_unique_id": "u", "width": 800, "height": 800,
+                           "file_size": 9}]}
+
+    monkeypatch.setattr(methods, 'send_photo', send_photo)
+    filename = str(tmp_path / 'uploads.cache')
+    bot = tgbotapi.TBot('token', threaded=False)
+    cache = bot.enable_upload_cache(filename, max_entries=2)
+
+    for chat_id in (1, 2, 3):
+        assert bot.send_photo(chat_id, io.BytesIO(b'promo image')).photo[-1].file_id == 'id1'
+    assert sent == [b'promo image', 'id1', 'id1']
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # the cached file_id expired, the content is uploaded again and the new file_id replaces it
+    cache.put(cache.key('photo', b'other image'), 'stale')
+    del sent[:]
+    assert bot.send_photo(4, io.BytesIO(b'other image')).photo[-1].file_id == 'id2'
+    assert sent == ['stale', b'other image']
+
+    # loaded from disk, the least recently used entry was evicted
+    reloaded = tgbotapi.utils.UploadCache(filename, max_entries=2)
+    assert len(reloaded) == 2
+    assert reloaded.get(reloaded.key('photo', b'other image')) == 'id2'
+    assert reloaded.get(reloaded.key('photo', io.BytesIO(b'promo image'))) == 'id1'
+    reloaded.put(reloaded.key('document', b'promo image'), 'doc1')
+    assert reloaded.get(reloaded.key('photo', b'other image')) is None
+    assert tgbotapi.utils.UploadCache.key('photo', 'file_id') is None
+    assert tgbotapi.utils.UploadCache.key('photo', io.BytesIO()) is None
+
+
+class UploadHandler(http.server.BaseHTTPRequestHandler):
+    received = []
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = b''
+            size = int(self.rfile.readline(), 16)
+            while size:
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                size = int(self.rfile.readline(), 16)
+            self.rfile.readline()
+        else:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        self.received.append((self.path, dict(self.headers), body))
+        response = b'{"ok": true, "result": true}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_streaming_upload(tmp_path):
+    UploadHandler.received = []
+    server = _Server(('127.0.0.1', 0), UploadHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = 'http://127.0.0.1:{0}/bottoken/sendDocument'.format(server.server_port)
+    path = tmp_path / 'report.pdf'
+    path.write_bytes(os.urandom(300000))
+    try:
+        with open(str(path), 'rb') as document:
+            assert tgbotapi.utils.make_request('post', api_url, 'sendDocument', {'document': document},
+                                               {'chat_id': 1}, None) is True
+        assert tgbotapi.utils.make_request('post', api_url, 'sendDocument', {'document': iter([b'a', b'bc'])},
+                                           {'chat_id': 1}, None) is True
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    (url, headers, body), (_, chunked_headers, chunked_body) = UploadHandler.received
+    assert url == '/bottoken/sendDocument?chat_id=1'
+    assert int(headers['Content-Length']) == len(body)
+    boundary = headers['Content-Type'].split('boundary=')[1]
+    with open(str(path), 'rb') as document:
+        expected = requests.Request('POST', api_url, files={'document': document}).prepare()
+    assert body == expected.body.replace(expected.headers['Content-Type'].split('boundary=')[1].encode(),
+                                         boundary.encode())
+    assert 'Content-Length' not in chunked_headers
+    assert b'filename="document"\r\n\r\nabc\r\n' in chunked_body
+
+
+def test_file_cache(monkeypatch, tmp_path):
+    calls = []
+
+    def get_file(token, proxies, file_id):
+        calls.append(('getFile', file_id))
+        return {'file_id': file_id, 'file_unique_id': 'u' + file_id, 'file_size': 400, 'file_path': 'p/' + file_id}
+
+    def download_file(token, proxies, file_path):
+        calls.append(('download', file_path))
+        return file_path.encode() * 100
+
+    monkeypatch.setattr(methods, 'get_file', get_file)
+    monkeypatch.setattr(methods, 'download_file', download_file)
+    bot = tgbotapi.TBot('token', threaded=False)
+    cache = bot.enable_file_cache(str(tmp_path), max_bytes=1000, memory_bytes=500)
+    stickers = [tgbotapi.types.Document('A', 'uA'), tgbotapi.types.Document('B', 'uB')]
+
+    assert bot.download_media(stickers[0]) == b'p/A' * 100
+    assert bot.download_media(stickers[0]) == b'p/A' * 100
+    assert bot.download_media(stickers[1]) == b'p/B' * 100
+    assert calls == [('getFile', 'A'), ('download', 'p/A'), ('getFile', 'B'), ('download', 'p/B')]
+    assert sorted(os.listdir(str(tmp_path))) == ['uA', 'uB']
+    assert cache.stats()['memory_hits'] == 1 and cache.stats()['misses'] == 2
+
+    # reopened cache: recency comes from disk, the least recently used file is evicted past max_bytes
+    os.utime(str(tmp_path / 'uA'), (1, 1))
+    cache = tgbotapi.utils.FileCache(str(tmp_path), max_bytes=1000)
+    assert cache.get('uB') == b'p/B' * 100
+    assert cache.put('uC', [b'x' * 200, b'y' * 300]) == 500
+    assert 'uA' not in cache and 'uB' in cache
+    assert cache.size == 800 and cache.stats()['evictions'] == 1
+
+    assert cache.put('big', b'z' * 1001) is None
+    assert sorted(os.listdir(str(tmp_path))) == ['uB', 'uC']
+    assert cache.stats()['hit_rate'] == 1.0
+
+    # files the cache didn't make are neither counted nor removed
+    for name in ('notes.txt', 'draft.tmp', 'uD.0123abcd.tmp'):
+        with open(str(tmp_path / name), 'wb') as file:
+            file.write(b'x' * 600)
+    cache = tgbotapi.utils.FileCache(str(tmp_path), max_bytes=1000)
+    assert len(cache) == 2 and cache.size == 800
+    assert sorted(os.listdir(str(tmp_path))) == ['draft.tmp', 'notes.txt', 'uB', 'uC']
+
+
+def test_get_file_cache(monkeypatch):
+    requested = []
+    started = threading.Event()
+
+    def get_file(token, proxies, file_id):
+        requested.append(file_id)
+        started.set()
+        time.sleep(0.1)
+        return {'file_id': file_id, 'file_unique_id': 'u', 'file_path': 'p/{0}'.format(len(requested))}
+
+    monkeypatch.setattr(methods, 'get_file', get_file)
+    bot = tgbotapi.TBot('token', threaded=False)
+    cache = bot.enable_get_file_cache(ttl=60)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(bot.get_file('A'))) for _ in range(8)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert requested == ['A']
+    assert len(set(map(id, results))) == 1
+    assert bot.get_file('A').file_path == 'p/1'
+    assert (cache.misses, cache.coalesced, cache.hits) == (1, 7, 1)
+
+    # the cached path expired: the download fails with 404, the path is dropped and asked for again
+    downloads = []
+
+    def download_file(token, proxies, file_path):
+        downloads.append(file_path)
+        if file_path == 'p/1':
+            raise methods.ApiException('The server returned HTTP 404 Not Found.', 'Download file',
+                                       FakeResponse(b'', 404))
+        return b'content'
+
+    monkeypatch.setattr(methods, 'download_file', download_file)
+    assert bot.download_media(tgbotapi.types.Document('A', 'u')) == b'content'
+    assert downloads == ['p/1', 'p/2']
+    assert requested == ['A', 'A']
+    assert bot.get_file('A').file_path == 'p/2'
+
+    cache.ttl = 0
+    cache.clear()
+    assert bot.get_file('A').file_path == 'p/3'
+    assert bot.get_file('A').file_path == 'p/4'
+
+    # a BaseException of the loader reaches the waiting callers instead of a None value
+    loading = threading.Event()
+
+    def interrupted():
+        loading.set()
+        time.sleep(0.1)
+        raise KeyboardInterrupt
+
+    waited = []
+
+    def wait():
+        try:
+            waited.append(cache.get('K', lambda: 'value'))
+        except KeyboardInterrupt as e:
+            waited.append(e)
+
+    cache.ttl = 60
+    leader = threading.Thread(target=lambda: pytest.raises(KeyboardInterrupt, cache.get, 'K', interrupted))
+    leader.start()
+    loading.wait()
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    leader.join()
+    waiter.join()
+    assert len(waited) == 1 and isinstance(waited[0], KeyboardInterrupt)
+    assert cache.get('K', lambda: 'value') == 'value'
+
+
+def test_file_id_index(monkeypatch, tmp_path):
+    chat = {"id": 1, "type": "private"}
+    document = {"file_id": "doc-old", "file_unique_id": "D", "file_size": 10}
+    updates = [
+        {"update_id": 1, "message": {"message_id": 1, "chat": chat, "date": 0, "document": document,
+                                     "photo": [{"file_id": "small", "file_unique_id": "S", "width": 1, "height": 1},
+                                               {"file_id": "large", "file_unique_id": "L", "width": 9, "height": 9}]}},
+        {"update_id": 2, "channel_post": {"message_id": 2, "chat": chat, "date": 0,
+                                          "sticker": {"file_id": "st", "file_unique_id": "T"},
+                                          "reply_to_message": {"message_id": 1, "chat": chat, "date": 0,
+                                                               "document": dict(document, file_id="doc-new")}}},
+    ]
+    monkeypatch.setattr(methods, 'get_updates', lambda *args: updates)
+    sent = []
+
+    def send_document(token, proxies, chat_id, document, *args):
+        sent.append(document)
+        return {"message_id": 3, "chat": chat, "date": 0,
+                "document": {"file_id": "doc-sent", "file_unique_id": "D", "file_size": 10}}
+
+    monkeypatch.setattr(methods, 'send_document', send_document)
+    filename = str(tmp_path / 'file_ids.json')
+    bot = tgbotapi.TBot('token', threaded=False)
+    index = bot.enable_file_id_index(max_entries=3, filename=filename)
+
+    # no handlers: the updates are skipped without decoding but their files are still recorded
+    bot._TBot__retrieve_updates()
+    assert len(index) == 3
+    assert index.get('L') == tgbotapi.utils.FileRef('large', 'L', 'photo', None)
+    assert index.get('D') == ('doc-new', 'D', 'document', 10)
+    index.set_key('terms', 'D')
+    assert index.resolve('terms') == 'doc-new'
+
+    bot.send_document(5, tgbotapi.types.Document('doc-old', 'D'))
+    assert sent == ['doc-new']
+    assert index.resolve('terms') == 'doc-sent'
+
+    bot.stop_bot()
+    reloaded = tgbotapi.utils.FileIdIndex(max_entries=3, filename=filename)
+    assert reloaded.resolve('terms') == 'doc-sent' and reloaded.resolve('T') == 'st'
+    reloaded.add('N', 'new', 'voice')
+    assert reloaded.get('L') is None and len(reloaded) == 3
+
+    # the keys of a dropped file are dropped with it, and the keys themselves are bounded
+    reloaded.set_key('banner', 'T')
+    assert reloaded.resolve('terms') == 'doc-sent'
+    reloaded.add('M', 'more', 'voice')
+    reloaded.add('O', 'other', 'voice')
+    assert reloaded.resolve('T') is None and reloaded.resolve('banner') is None
+    assert reloaded.snapshot()['keys'] == {'terms': 'D'}
+    for i in range(5):
+        reloaded.set_key('k{0}'.format(i), 'O')
+    assert list(reloaded.snapshot()['keys']) == ['k2', 'k3', 'k4']
+
+
+def test_send_media_groups(monkeypatch):
+    requests_made = []
+
+    def make_request(method, api_url, api_method, files, params, proxies):
+        requests_made.append((params['chat_id'], params['media'], sorted(files or {})))
+        if params['chat_id'] == 'blocked':
+            raise methods.ApiException('Error code: 403 Description: Forbidden', api_method, None)
+        return [{"message_id": i, "chat": {"id": 1, "type": "private"}, "date": 0,
+                 "photo": [{"file_id": "id-{0}".format(item['media']), "file_unique_id": "u", "width": 1,
+                            "height": 1, "file_size": 1}]}
+                for i, item in enumerate(tgbotapi.utils.json_loads(params['media']))]
+
+    monkeypatch.setattr(methods, 'make_request', make_request)
+    input_media = tgbotapi.types.InputMedia()
+    album = [input_media.Photo('photo', b'first image', caption='1'), input_media.Photo('photo', b'second image'),
+             input_media.Video('video', 'known-video-id', thumb=b'thumb')]
+
+    media, files = tgbotapi.utils.convert_input_media_array(album)
+    assert tgbotapi.utils.json_loads(media) == [
+        {'type': 'photo', 'media': 'attach://file0', 'caption': '1'}, {'type': 'photo', 'media': 'attach://file1'},
+        {'type': 'video', 'media': 'known-video-id', 'thumb': 'attach://file2_thumb', 'supports_streaming': False}]
+    assert sorted(files) == ['file0', 'file1', 'file2_thumb']
+
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.enable_upload_cache(None)
+    results = bot.send_media_groups([(chat_id, album) for chat_id in (1, 2, 'blocked', 3)], num_threads=3)
+    assert [len(result) for result in results if isinstance(result, list)] == [3, 3, 3]
+    assert isinstance(results[2], methods.ApiException)
+    assert results[0][0].photo[0].file_id == 'id-attach://file0'
+    # the first album uploaded the photos, the others reuse their file_ids
+    assert requests_made[0][2] == ['file0', 'file1', 'file2_thumb']
+    for chat_id, media, files in requests_made[1:]:
+        assert [item['media'] for item in tgbotapi.utils.json_loads(media)] == \
+               ['id-attach://file0', 'id-attach://file1', 'known-video-id']
+        assert files == ['file2_thumb']
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    content = b''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_download_file_into(monkeypatch):
+    FileHandler.content = os.urandom(200000)
+    server = _Server(('127.0.0.1', 0), FileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(methods, 'FILE_URL', 'http://127.0.0.1:{0}/file/bot{{0}}/{{1}}'.format(server.server_port))
+    bot = tgbotapi.TBot('token', threaded=False)
+    file = tgbotapi.types.File('id', 'unique', len(FileHandler.content), 'photos/file_1.jpg')
+    try:
+        view = bot.download_file_into(file)
+        assert isinstance(view.obj, bytearray) and len(view.obj) == 200000
+        assert view == FileHandler.content
+
+        buffer = bytearray(250000)
+        view = bot.download_file_into(file, memoryview(buffer)[10000:])
+        assert len(view) == 200000 and buffer[10000:210000] == FileHandler.content
+
+        # file_size unknown or wrong: the default buffer is sized from Content-Length or grown
+        for file_size in (None, 1000):
+            file.file_size = file_size
+            assert bot.download_file_into(file) == FileHandler.content
+
+        try:
+            bot.download_file_into(file, bytearray(1000))
+        except ValueError:
+            pass
+        else:
+            assert False
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_download_many(monkeypatch):
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def track(delay):
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(delay)
+        with lock:
+            active.pop()
+
+    def get_file(token, proxies, file_id):
+        track(0.02)
+        if file_id == 'missing':
+            raise methods.ApiException('Error code: 400 Description: Bad Request: invalid file_id', 'getFile', None)
+        return {'file_id': file_id, 'file_unique_id': 'u' + file_id, 'file_path': 'p/' + file_id}
+
+    def download_file(token, proxies, file_path):
+        # the first file is the slowest
+        track(0.15 if file_path == 'p/0' else 0.02)
+        return file_path.encode()
+
+    monkeypatch.setattr(methods, 'get_file', get_file)
+    monkeypatch.setattr(methods, 'download_file', download_file)
+    bot = tgbotapi.TBot('token', threaded=False)
+    file_ids = ['0', '1', 'missing', '3', '4', '5']
+
+    results = list(bot.download_many(iter(file_ids), num_threads=3))
+    assert max(peak) == 3
+    assert results[-1].index == 0 and results[-1].content == b'p/0'
+    assert sorted(result.index for result in results) == list(range(6))
+    failed = [result for result in results if result.error is not None]
+    assert [(result.file, result.content) for result in failed] == [('missing', None)]
+    assert isinstance(failed[0].error, methods.ApiException)
+
+    results = list(bot.download_many(file_ids, num_threads=3, ordered=True))
+    assert [result.file for result in results] == file_ids
+    assert [result.content for result in results] == [b'p/0', b'p/1', None, b'p/3', b'p/4', b'p/5']
+
+    # num_threads below 1 still downloads, one file at a time
+    assert [result.content for result in bot.download_many(['0', '1'], num_threads=0, ordered=True)] == \
+        [b'p/0', b'p/1']
+
+
+def test_download_media_cache_by_file_id(monkeypatch, tmp_path):
+    downloads = []
+    monkeypatch.setattr(methods, 'get_file', lambda token, proxies, file_id: {
+        'file_id': file_id, 'file_unique_id': 'u', 'file_path': 'p/' + file_id})
+    monkeypatch.setattr(methods, 'download_file', lambda token, proxies, file_path: downloads.append(file_path) or b'x')
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.enable_file_cache(str(tmp_path))
+    # two file_ids of the same file, getFile tells the cache which file it is
+    assert bot.download_media('A') == b'x'
+    assert bot.download_media('A') == b'x'
+    assert bot.download_media('B') == b'x'
+    assert downloads == ['p/A']
+
+
+def on_step(message, *args, **kwargs):
+    pass
+
+
+def test_journal_saver(tmp_path):
+    filename = str(tmp_path / 'step.save')
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.enable_save_next_step_handlers(delay=3600, filename=filename, journal=True)
+    for chat_id in range(5):
+        bot.register_next_step_handler_by_chat_id(chat_id, on_step, 'step', chat_id)
+    bot.clear_step_handler_by_chat_id(3)
+    bot.register_next_step_handler_by_chat_id(1, on_step, 'second')
+    bot.register_next_step_handler_by_chat_id(9, lambda message: None)
+    # nothing but the journal is written, one record per change, the lambda is skipped
+    assert os.listdir(str(tmp_path)) == ['step.save.journal']
+    with open(filename + '.journal', 'ab') as journal:
+        journal.write(b'\x80\x04torn')
+    # the snapshot can't be written with the lambda, the journal is kept
+    bot.disable_save_next_step_handlers()
+    assert os.listdir(str(tmp_path)) == ['step.save.journal']
+
+    restarted = tgbotapi.TBot('token', threaded=False)
+    restarted.enable_save_next_step_handlers(delay=3600, filename=filename, journal=True)
+    restarted.load_next_step_handlers(filename)
+    handlers = restarted._TBot__next_step_handlers
+    assert sorted(handlers) == [0, 1, 2, 4]
+    assert [handler.args for handler in handlers[1]] == [('step', 1), ('second',)]
+    assert handlers[4][0].callback is on_step
+    # loading folded the journal into a new snapshot
+    assert os.listdir(str(tmp_path)) == ['step.save']
+
+    saver = restarted._TBot__next_step_saver
+    saver.compact_every = 2
+    restarted.clear_step_handler_by_chat_id(0)
+    assert os.listdir(str(tmp_path)) == ['step.save', 'step.save.journal']
+    restarted.clear_step_handler_by_chat_id(2)
+    assert os.listdir(str(tmp_path)) == ['step.save']
+    assert sorted(tgbotapi.Saver.return_load_handlers(filename, False)) == [1, 4]
+    assert saver.compactions == 2
+
+    # delay only syncs the journal, it is compacted once it outgrows the snapshot and compact_bytes
+    saver.delay = 0.01
+    saver.compact_every = 10000
+    saver.compact_bytes = 0
+    restarted.register_next_step_handler_by_chat_id(5, on_step)
+    for _ in range(100):
+        if saver.flushes:
+            break
+        time.sleep(0.01)
+    assert saver.flushes == 1 and saver.journal is None and saver.compactions == 2
+    assert sorted(os.listdir(str(tmp_path))) == ['step.save', 'step.save.journal']
+    for chat_id in range(6, 20):
+        restarted.register_next_step_handler_by_chat_id(chat_id, on_step)
+        if saver.compactions == 3:
+            break
+    assert saver.compactions == 3 and saver.journal_bytes == 0
+    assert os.listdir(str(tmp_path)) == ['step.save']
+    restarted.stop_bot()
+
+
+
+def test_handler_expiry(monkeypatch, tmp_path):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    monkeypatch.setattr(methods, 'get_updates', lambda *args: make_updates()[:1])
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.enable_handler_expiry(ttl=60, max_entries=3)
+    bot.enable_save_next_step_handlers(delay=0, filename=str(tmp_path / 'step.save'))
+    # bound methods of lists, unlike lambdas, can be saved
+    called, expired = [], []
+
+    bot.register_next_step_handler_by_chat_id(383324787, called.append, ttl=10, on_expire=expired.append)
+    for chat_id in range(1, 5):
+        bot.register_next_step_handler_by_chat_id(chat_id, called.append, on_expire=expired.append)
+    # the least recently registered chats were evicted past max_entries
+    assert expired == [383324787, 1]
+    handlers = bot._TBot__next_step_handlers
+    assert list(handlers) == [2, 3, 4]
+    assert handlers.evicted == 2
+
+    bot.clear_step_handler_by_chat_id(2)
+    bot.register_next_step_handler_by_chat_id(383324787, called.append, on_expire=expired.append)
+    assert list(handlers) == [3, 4, 383324787]
+    now[0] += 61
+    bot._TBot__retrieve_updates()
+    # the handler of 383324787 expired before its message was processed, 3 and 4 were swept after the poll
+    assert called == []
+    assert expired == [383324787, 1, 383324787, 3, 4]
+    assert len(handlers) == 0 and handlers.expired == 3
+    assert tgbotapi.Saver.return_load_handlers(str(tmp_path / 'step.save'), False) == {}
+
+    bot.register_for_reply_by_message_id(7, called.append, ttl=5)
+    now[0] += 4
+    assert bot._TBot__reply_handlers.sweep() == []
+    now[0] += 1
+    assert [key for key, handler in bot._TBot__reply_handlers.sweep()] == [7]
+    assert 7 not in bot._TBot__reply_handlers
+
+
+def test_handler_store(monkeypatch, tmp_path):
+    monkeypatch.setattr(methods, 'get_updates', lambda *args: make_updates()[:1])
+    filename = str(tmp_path / 'handlers.db')
+    received = []
+
+    def on_message(message, step):
+        received.append((message.text, step))
+
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.register_next_step_handler_by_chat_id(1, on_message, 'migrated')
+    with pytest.raises(ValueError):
+        bot.enable_handler_store(tgbotapi.SqliteHandlerStore(filename))
+    store = tgbotapi.SqliteHandlerStore(filename)
+    store.callback('on_message')(on_message)
+    assert bot.enable_handler_store(store) is store
+    bot.register_next_step_handler_by_chat_id(383324787, on_message, 'name')
+    with pytest.raises(ValueError):
+        bot.register_next_step_handler_by_chat_id(2, lambda message: None)
+    bot.register_for_reply_by_message_id(5, on_message, 'reply', ttl=60)
+    with pytest.raises(ValueError):
+        bot.enable_save_next_step_handlers()
+    bot.stop_bot()
+
+    restarted = tgbotapi.TBot('token', threaded=False)
+    store = tgbotapi.SqliteHandlerStore(filename)
+    store.callback('on_message')(on_message)
+    restarted.enable_handler_store(store)
+    # nothing was loaded, the rows are read by chat when messages arrive
+    assert store.count('next_step') == 2 and store.count('reply') == 1
+    restarted._TBot__retrieve_updates()
+    assert received == [('hi', 'name')]
+    assert store.get('next_step', 383324787) == []
+    assert [handler.args for handler in store.get('next_step', 1)] == [('migrated',)]
+    assert [key for key, handler in restarted._TBot__reply_handlers.sweep(time.time() + 61)] == [5]
+    assert store.count('reply') == 0
+
+    # a callback that isn't registered anymore is dropped when its row is read
+    store.callbacks.clear()
+    assert store.get('next_step', 1) == []
+    restarted.stop_bot()
+
+    # registering doesn't count the rows every time, max_entries holds with the registry's own count
+    store = tgbotapi.SqliteHandlerStore(':memory:')
+    store.callback('on_message')(on_message)
+    counts = []
+    count = store.count
+    monkeypatch.setattr(store, 'count', lambda kind: counts.append(kind) or count(kind))
+    registry = tgbotapi.StoredHandlerRegistry(store, 'next_step', max_entries=3, sweep_every=5, sweep_interval=3600)
+    dropped = []
+    for key in range(8):
+        dropped.extend(registry.add(key, tgbotapi.Handler(on_message, key)))
+        registry.add(key, tgbotapi.Handler(on_message, key))
+    assert len(counts) == 4 and count('next_step') == 3
+    assert sorted(set(key for key, handler in dropped)) == [0, 1, 2, 3, 4]
+    assert registry.take(7)[0] and registry.evicted == 10
+    registry.add(8, tgbotapi.Handler(on_message, 8))
+    assert count('next_step') == 3 and len(counts) == 4
+
+
+def test_concurrent_handler_registry(tmp_path):
+    bot = tgbotapi.TBot('token', threaded=False)
+    # the handlers are pickled on the timer thread while the workers change them
+    bot.enable_save_next_step_handlers(delay=0.001, filename=str(tmp_path / 'step.save'))
+    chat = {"id": 0, "type": "private"}
+    called = []
+
+    def work(worker):
+        for i in range(200):
+            chat_id = worker * 1000 + i % 20
+            bot.register_next_step_handler_by_chat_id(chat_id, called.append)
+            if i % 3 == 0:
+                bot.clear_step_handler_by_chat_id(chat_id)
+            if i % 5 == 0:
+                message = tgbotapi.types.Message.de_json({"message_id": i, "date": 0, "text": "x",
+                                                           "chat": dict(chat, id=chat_id)})
+                bot._notify_next_handlers([message])
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    bot._TBot__next_step_saver.close()
+    handlers = bot._TBot__next_step_handlers
+    saved = tgbotapi.Saver.return_load_handlers(str(tmp_path / 'step.save'), False)
+    assert {key: len(value) for key, value in saved.items()} == {key: len(value) for key, value in handlers.items()}
+    assert len(handlers) == len(set(handlers)) > 0
+
+    # one pass over the batch, the messages of chats with a next step handler are removed in place
+    bot.register_next_step_handler_by_chat_id(-1, called.append)
+    messages = [tgbotapi.types.Message.de_json({"message_id": i, "date": 0, "text": str(i),
+                                                "chat": dict(chat, id=-1 if i == 3 else -2)}) for i in range(6)]
+    bot._notify_next_handlers(messages)
+    assert [message.text for message in messages] == ['0', '1', '2', '4', '5']
+    assert called[-1].text == '3'
+
+
+def test_states(tmp_path):
+    for storage in (tgbotapi.utils.MemoryStateStorage(max_entries=2),
+                    tgbotapi.utils.SqliteStateStorage(str(tmp_path / 'states.db')),
+                    tgbotapi.utils.FileStateStorage(str(tmp_path / 'states.jsonl'))):
+        storage.set(1, 1, 'name', {'a': 1})
+        storage.set(1, 2, 'age', {})
+        assert storage.get(1, 1) == ('name', {'a': 1})
+        storage.delete(1, 2)
+        assert storage.get(1, 2) == (None, {})
+        assert len(storage) == 1
+        storage.close()
+    # the file and SQLite storages survive a restart
+    assert tgbotapi.utils.FileStateStorage(str(tmp_path / 'states.jsonl')).get(1, 1) == ('name', {'a': 1})
+    assert tgbotapi.utils.SqliteStateStorage(str(tmp_path / 'states.db')).get(1, 1) == ('name', {'a': 1})
+
+    bot = tgbotapi.TBot('token', threaded=False)
+    with pytest.raises(ValueError):
+        bot.set_state(1, 1, 'name')
+    bot.enable_states(tgbotapi.utils.FileStateStorage(str(tmp_path / 'bot.jsonl')))
+    received = []
+
+    @bot.state_handler('name')
+    def on_name(message):
+        bot.update_state_data(message.chat.id, message.from_user.id, name=message.text)
+        bot.set_state(message.chat.id, message.from_user.id, 'age')
+
+    @bot.state_handler('age', regexp=r'^\d+$')
+    def on_age(message):
+        received.append(dict(bot.get_state_data(message.chat.id, message.from_user.id), age=message.text))
+        bot.finish_state(message.chat.id, message.from_user.id)
+
+    @bot.message_handler(func=lambda message: True)
+    def on_message(message):
+        received.append(message.text)
+
+    user = {"id": 7, "is_bot": False, "first_name": "A"}
+    messages = [tgbotapi.types.Message.de_json({"message_id": i, "date": 0, "text": text, "from": user,
+                                                "chat": {"id": 7, "type": "private"}})
+                for i, text in enumerate(['Ali', 'old', '30', 'hi'])]
+    bot.set_state(7, 7, 'name', {'step': 1})
+    for message in messages:
+        bot._TBot__process_new_messages([message])
+    # 'old' isn't accepted in the age state and goes on to the message handlers
+    assert received == ['old', {'step': 1, 'name': 'Ali', 'age': '30'}, 'hi']
+    assert bot.get_state(7, 7) is None
+
+
+def test_offset_checkpoint(monkeypatch, tmp_path):
+    store = tgbotapi.utils.FileOffsetStore(str(tmp_path / 'offset'))
+    checkpoint = tgbotapi.utils.OffsetCheckpoint(store, interval=3600)
+    first, second = checkpoint.begin(10), checkpoint.begin(12)
+    slow, fast = checkpoint.wrap(first, lambda: None), checkpoint.wrap(second, lambda: None)
+    checkpoint.dispatched(first)
+    checkpoint.dispatched(second)
+    fast()
+    # the first batch is still being handled
+    assert checkpoint.committed == 0
+    slow()
+    assert checkpoint.committed == 12 and store.load() == 12
+    # then written at most every interval seconds
+    checkpoint.dispatched(checkpoint.begin(13))
+    assert checkpoint.committed == 13 and store.load() == 12
+    checkpoint.flush(force=True)
+    assert store.load() == 13 and checkpoint.writes == 2
+
+    offsets = []
+
+    def get_updates(token, proxies, offset, limit, timeout, allowed_updates):
+        offsets.append(offset)
+        return [update for update in make_updates() if update['update_id'] >= offset]
+
+    monkeypatch.setattr(methods, 'get_updates', get_updates)
+    received = []
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.enable_offset_store(tgbotapi.utils.SqliteOffsetStore(str(tmp_path / 'offset.db')), interval=3600)
+
+    @bot.message_handler(func=lambda message: True)
+    def on_message(message):
+        received.append(message.text)
+
+    bot._TBot__retrieve_updates()
+    bot._TBot__retrieve_updates(timeout=0)
+    # the second poll got nothing new, the first batch was confirmed by asking for the updates after it
+    assert offsets == [1, 14] and received == ['hi']
+    bot.stop_bot()
+
+    restarted = tgbotapi.TBot('token', threaded=False)
+    assert restarted.enable_offset_store(tgbotapi.utils.SqliteOffsetStore(str(tmp_path / 'offset.db'))).committed == 13
+    restarted._TBot__retrieve_updates()
+    assert offsets == [1, 14, 14]
+
+
+def test_outbox(monkeypatch, tmp_path):
+    filename = str(tmp_path / 'outbox.log')
+    sent = []
+
+    def send_message(token, proxies, chat_id, text, parse_mode, disable_web_page_preview, disable_notification,
+                     reply_to_message_id, reply_markup):
+        sent.append((chat_id, text, reply_markup))
+
+    monkeypatch.setattr(methods, 'send_message', send_message)
+    release = threading.Event()
+
+    def stuck(method, args):
+        release.wait()
+        raise requests.ConnectionError('down')
+
+    # the process "dies" before anything is sent
+    dead = tgbotapi.utils.Outbox(filename, stuck, num_threads=1, max_attempts=1)
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot._TBot__outbox = dead
+    keyboard = tgbotapi.types.InlineKeyboardMarkup()
+    keyboard.add(tgbotapi.types.InlineKeyboardButton('a', callback_data='a'))
+    assert bot.enqueue('send_message', 1, 'first') == 1
+    assert bot.enqueue('send_message', 1, 'second', reply_markup=keyboard) == 2
+    with pytest.raises(ValueError):
+        bot.enqueue('send_photo', 1, b'bytes')
+    with pytest.raises(ValueError):
+        bot.enqueue('download_file', 'path')
+    assert dead.backlog == 2 and dead.oldest_age() >= 0
+
+    bot = tgbotapi.TBot('token', threaded=False)
+    outbox = bot.enable_outbox(filename, num_threads=4)
+    deadline = time.time() + 5
+    while outbox.backlog and time.time() < deadline:
+        time.sleep(0.01)
+    # replayed in order, the calls to one chat go through the same sender
+    assert [args[1] for args in sent] == ['first', 'second']
+    assert sent[1][-1] == keyboard.to_json()
+    assert outbox.stats()['sent'] == 2 and outbox.stats()['backlog'] == 0
+    bot.stop_bot()
+    release.set()
+    dead.close()
+
+    attempts = []
+
+    def flaky(method, args):
+        attempts.append(args[0])
+        if args[0] == 'retry' and len(attempts) == 1:
+            raise requests.ConnectionError('down')
+        if args[0] == 'bad':
+            raise tgbotapi.utils.ApiException('Bad Request', method, FakeResponse(b'{}', status_code=400))
+
+    outbox = tgbotapi.utils.Outbox(filename, flaky, num_threads=1, retry_delay=0)
+    outbox.put('x', ['retry'])
+    outbox.put('x', ['bad'])
+    deadline = time.time() + 5
+    while outbox.backlog and time.time() < deadline:
+        time.sleep(0.01)
+    assert attempts == ['retry', 'retry', 'bad']
+    assert (outbox.sent, outbox.failed, outbox.retries) == (1, 1, 1)
+    outbox.close()
+    # nothing left to send, the log is emptied when it is opened again
+    outbox = tgbotapi.utils.Outbox(filename, flaky)
+    assert outbox.backlog == 0 and os.path.getsize(filename) == 0
+    outbox.close()
+
+
+def test_warm_start(monkeypatch, tmp_path):
+    calls = []
+
+    def get_me(token, proxies):
+        calls.append('get_me')
+        return {'id': 7, 'is_bot': True, 'first_name': 'bot'}
+
+    def get_file(token, proxies, file_id):
+        calls.append(file_id)
+        return {'file_id': file_id, 'file_unique_id': 'u', 'file_path': 'p/' + file_id}
+
+    monkeypatch.setattr(methods, 'get_me', get_me)
+    monkeypatch.setattr(methods, 'get_file', get_file)
+    filename = str(tmp_path / 'warm.snapshot')
+
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.enable_get_file_cache(ttl=60)
+    bot.enable_upload_cache(filename=None).put('hash', 'uploaded')
+    bot.enable_file_id_index().add('F', 'file', 'document')
+    bot.enable_states()
+    # nothing to restore yet
+    assert bot.enable_warm_start(filename) is None
+    bot.set_state(1, 2, 'asking', {'step': 1})
+    assert bot.get_me().id == bot.get_me().id == 7
+    bot.get_file('A')
+    bot._TBot__last_update_id = 41
+    bot.stop_bot()
+    assert calls == ['get_me', 'A']
+
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.enable_get_file_cache(ttl=60)
+    uploads = bot.enable_upload_cache(filename=None)
+    index = bot.enable_file_id_index()
+    bot.enable_states()
+    # set after the snapshot was taken, kept
+    bot.set_state(1, 2, 'done')
+    bot.set_state(3, 4, 'asking')
+    bot.enable_warm_start(filename).join()
+    assert bot._TBot__last_update_id == 41
+    assert bot.get_me().first_name == 'bot' and bot.get_file('A').file_path == 'p/A'
+    assert calls == ['get_me', 'A']
+    assert uploads.get('hash') == 'uploaded' and index.resolve('F') == 'file'
+    assert bot.get_state(1, 2) == 'done' and bot.get_state(3, 4) == 'asking'
+
+    # a conversation ended before the background restore reached it stays ended
+    storage = tgbotapi.utils.MemoryStateStorage()
+    storage.begin_restore()
+    storage.set(5, 6, 'asking', {})
+    storage.delete(5, 6)
+    storage.restore([(5, 6, 'old', {}), (7, 8, 'old', {})])
+    storage.end_restore()
+    assert storage.get(5, 6) == (None, {}) and storage.get(7, 8) == ('old', {})
+
+    # stale sections are skipped, a torn end of file ends the snapshot
+    with open(filename, 'ab') as file:
+        file.write(b'\x80\x04torn')
+    bot = tgbotapi.TBot('token', threaded=False)
+    cache = bot.enable_get_file_cache(ttl=60)
+    assert bot.enable_warm_start(filename, max_age={'offset': -1}, background=False) is None
+    assert bot._TBot__last_update_id == 0 and len(cache) == 1
+    assert bot.save_warm_start() == os.path.getsize(filename)
+
+
+def test_stop_bot_waits_for_polling(monkeypatch, tmp_path):
+    polled = threading.Event()
+    release = threading.Event()
+
+    def get_updates(token, proxies, offset, limit, timeout, allowed_updates):
+        polled.set()
+        release.wait()
+        return [update for update in make_updates() if update['update_id'] >= offset]
+
+    monkeypatch.setattr(methods, 'get_updates', get_updates)
+    received = []
+    bot = tgbotapi.TBot('token', threaded=False)
+    offsets = bot.enable_offset_store(tgbotapi.utils.SqliteOffsetStore(str(tmp_path / 'offset.db')))
+    bot.message_handler(func=lambda message: True)(received.append)
+    errors = []
+
+    def poll():
+        try:
+            bot.polling(none_stop=True)
+        except Exception as e:
+            errors.append(e)
+
+    polling = threading.Thread(target=poll)
+    polling.start()
+    polled.wait()
+    stopping = threading.Thread(target=bot.stop_bot)
+    stopping.start()
+    time.sleep(0.05)
+    # the store stays open while getUpdates is running
+    assert stopping.is_alive()
+    release.set()
+    stopping.join()
+    polling.join()
+    assert errors == [] and len(received) == 1
+    assert tgbotapi.utils.SqliteOffsetStore(str(tmp_path / 'offset.db')).load() == offsets.committed == 13
+
+    # stop_bot called by a handler on a worker thread closes the bot once the polling loop ends
+    index_file = str(tmp_path / 'file_ids.json')
+    bot = tgbotapi.TBot('token', threaded=True)
+    bot.enable_file_id_index(filename=index_file)
+    store = tgbotapi.utils.SqliteOffsetStore(str(tmp_path / 'threaded.db'))
+    bot.enable_offset_store(store)
+    bot.message_handler(func=lambda message: True)(lambda message: bot.stop_bot())
+    bot.polling()
+    assert os.path.isfile(index_file)
+    assert tgbotapi.utils.SqliteOffsetStore(str(tmp_path / 'threaded.db')).load() == 13
+
+    # stop_bot called by a handler closes the bot once the polling loop ends
+    bot = tgbotapi.TBot('token', threaded=False)
+    store = tgbotapi.utils.SqliteOffsetStore(str(tmp_path / 'handler.db'))
+    bot.enable_offset_store(store)
+    bot.message_handler(func=lambda message: True)(lambda message: bot.stop_bot())
+    bot.polling()
+    assert tgbotapi.utils.SqliteOffsetStore(str(tmp_path / 'handler.db')).load() == 13
+
+
+def test_update_dedup(tmp_path):
+    window = tgbotapi.utils.UpdateWindow(size=10)
+    assert window.size == 16
+    assert [window.add(update_id) for update_id in (5, 6, 5, 4, 20, 6)] == [True, True, False, True, True, False]
+    # 4 left the window when 20 came, taken as a reset
+    assert window.add(4) and window.stats() == {'new': 5, 'duplicates': 2, 'resets': 1}
+    assert not window.add(4) and window.add(21) and not window.add(21)
+
+    bot = tgbotapi.TBot('token', threaded=False)
+    handled = []
+    bot.message_handler(func=lambda message: True)(handled.append)
+    window = bot.enable_update_dedup()
+    chat = {"id": 1, "type": "private"}
+    update = {"update_id": 3, "message": {"message_id": 1, "chat": chat, "date": 0, "text": "hi"}}
+    # a webhook retry
+    bot.process_new_updates(update)
+    bot.process_new_updates([update, dict(update, update_id=4)])
+    assert [message.message_id for message in handled] == [1, 1]
+    assert window.duplicates == 1
+
+    # the window survives a restart through the warm start snapshot
+    filename = str(tmp_path / 'warm.snapshot')
+    bot.enable_warm_start(filename)
+    bot.stop_bot()
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.message_handler(func=lambda message: True)(handled.append)
+    window = bot.enable_update_dedup()
+    bot.enable_warm_start(filename)
+    bot.process_new_updates([update, dict(update, update_id=5)])
+    assert len(handled) == 3 and window.duplicates == 1
+
+
+def test_update_dedup_restart(monkeypatch, tmp_path):
+    chat = {"id": 1, "type": "private"}
+    updates = [{"update_id": update_id, "message": {"message_id": update_id, "chat": chat, "date": 0, "text": "hi"}}
+               for update_id in (1, 2)]
+    available = updates[:1]
+    monkeypatch.setattr(methods, 'get_updates', lambda token, proxies, offset, limit, timeout, allowed_updates: [
+        update for update in available if update['update_id'] >= offset])
+    offset_file = str(tmp_path / 'offset')
+    snapshot = str(tmp_path / 'warm.snapshot')
+    release = threading.Event()
+
+    def on_message(message):
+        release.wait()
+
+    bot = tgbotapi.TBot('token', threaded=True, num_threads=1)
+    bot.message_handler(func=lambda message: True)(on_message)
+    bot.enable_offset_store(tgbotapi.utils.FileOffsetStore(offset_file))
+    bot.enable_update_dedup()
+    bot.enable_warm_start(snapshot)
+    bot._TBot__retrieve_updates(timeout=0)
+    available = updates
+    bot._TBot__retrieve_updates(timeout=0)
+    # update 1 is being handled and update 2 is queued when the bot stops, the queue is dropped
+    stopping = threading.Thread(target=bot.stop_bot)
+    stopping.start()
+    while bot._TBot__worker_pool.workers[0]._running:
+        time.sleep(0.01)
+    release.set()
+    stopping.join()
+
+    handled = []
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.message_handler(func=lambda message: True)(lambda message: handled.append(message.message_id))
+    offsets = bot.enable_offset_store(tgbotapi.utils.FileOffsetStore(offset_file))
+    window = bot.enable_update_dedup()
+    bot.enable_warm_start(snapshot)
+    assert offsets.committed == 1
+    bot._TBot__retrieve_updates(timeout=0)
+    assert handled == [2] and window.duplicates == 0 and offsets.committed == 2
+    bot.stop_bot()
+
+
+def test_saver_flusher(tmp_path):
+    filename = str(tmp_path / 'step.save')
+    bot = tgbotapi.TBot('token', threaded=False)
+    bot.enable_save_next_step_handlers(delay=3600, filename=filename, every_changes=3, fsync=True)
+    saver = bot._TBot__next_step_saver
+    flushers = sum(thread.name == 'SaverFlusher' for thread in threading.enumerate())
+    for chat_id in range(2):
+        bot.register_next_step_handler_by_chat_id(chat_id, on_step)
+    time.sleep(0.05)
+    assert os.listdir(str(tmp_path)) == [] and saver.dirty == 2
+    # one flusher for every change, it saves once the third change is waiting
+    bot.register_next_step_handler_by_chat_id(2, on_step)
+    assert sum(thread.name == 'SaverFlusher' for thread in threading.enumerate()) == flushers + 1
+    for _ in range(100):
+        if saver.flushes:
+            break
+        time.sleep(0.01)
+    assert saver.flushes == 1 and saver.bytes_written == os.path.getsize(filename)
+    assert os.listdir(str(tmp_path)) == ['step.save']
+    assert sorted(tgbotapi.Saver.return_load_handlers(filename, False)) == [0, 1, 2]
+    for chat_id in range(3, 5):
+        bot.register_next_step_handler_by_chat_id(chat_id, on_step)
+
+    # the changes still waiting are saved on shutdown
+    bot.stop_bot()
+    assert saver.dirty == 0 and saver.stats()['flushes'] == 2
+    assert sorted(tgbotapi.Saver.return_load_handlers(filename, False)) == [0, 1, 2, 3, 4]
+    assert sum(thread.name == 'SaverFlusher' for thread in threading.enumerate()) == flushers
+    # after close a change is saved at once
+    bot.register_next_step_handler_by_chat_id(5, on_step)
+    assert saver.dirty == 0 and saver.flushes == 3
+
+
+def test_saver_atexit(monkeypatch, tmp_path):
+    registered = []
+    monkeypatch.setattr(atexit, 'register', registered.append)
+    monkeypatch.setattr(atexit, 'unregister', registered.remove)
+    bot = tgbotapi.TBot('token', threaded=False)
+    for _ in range(3):
+        bot.enable_save_next_step_handlers(delay=3600, filename=str(tmp_path / 'step.save'))
+        bot.register_next_step_handler_by_chat_id(1, on_step)
+    # only the saver in use is saved at exit
+    assert registered == [bot._TBot__next_step_saver.close]
+    bot.disable_save_next_step_handlers()
+    assert registered == []
@@ -50,6 +50,64 @@ def test_update():
     assert obj.poll_answer is None
 
 
+def test_update_binary():
+    dic = {
+        "update_id": 938203,
+        "message": {
+            "message_id": 241,
+            "from": {"id": 383324787, "is_bot": False, "first_name": "Mustafa", "username": "MA24th"},
+            "chat": {"id": -1001405936102, "title": "GRID9", "type": "supergroup"},
+            "date": 1441447009,
+            "photo": [
+                {"file_id": "AgADBAADr6cxG0mxAAFT", "file_unique_id": "AQADmN", "width": 90, "height": 67,
+                 "file_size": 1234},
+                {"file_id": "AgADBAADr6cxG0mxAAFU", "file_unique_id": "AQADmO", "width": 320, "height": 240,
+                 "file_size": 22345}
+            ],
+            "caption": "عطلة \U0001f334 #holiday",
+            "caption_entities": [{"type": "hashtag", "offset": 7, "length": 8}]
+        }}
+    data = types.Update.de_json(dic).to_bytes()
+    assert isinstance(data, bytes)
+    obj = types.Update.from_bytes(bytearray(data))
+    assert obj.update_id == 938203
+    assert obj.message.message_id == 241
+    assert obj.message.from_user.is_bot is False
+    assert obj.message.from_user.first_name == 'Mustafa'
+    assert obj.message.from_user.last_name is None
+    assert obj.message.chat.id == -1001405936102
+    assert obj.message.chat.type == 'supergroup'
+    assert obj.message.content_type == 'photo'
+    assert obj.message.photo[0].file_size == 1234
+    assert obj.message.photo[1].file_size == 22345
+    assert obj.message.caption == "عطلة \U0001f334 #holiday"
+    assert obj.message.caption_entities[0].type == 'hashtag'
+    assert obj.message.caption_entities[0].length == 8
+    assert obj.message.reply_to_message is None
+    assert obj.edited_message is None
+    assert vars(obj.message.chat) == vars(types.Update.de_json(dic).message.chat)
+
+
+class Unknown(object):
+    def __init__(self):
+        self.value = 1
+
+
+def test_update_binary_invalid():
+    data = types.Update.de_json({"update_id": 1, "poll_answer": {
+        "poll_id": "5", "user": {"id": 1, "is_bot": False, "first_name": "A"}, "option_ids": [0, 2]}}).to_bytes()
+    assert types.Update.from_bytes(data).poll_answer.option_ids == [0, 2]
+    user = types.User.de_json({"id": 1, "is_bot": False, "first_name": "A"})
+    for payload in (b'', b'XYZ' + data[3:], data[:3] + b'\x09' + data[4:], data[:-1], data + b'\x00',
+                    types.to_binary(user), types.to_binary(Unknown())):
+        try:
+            types.Update.from_bytes(payload)
+        except types.BinaryFormatError:
+            pass
+        else:
+            assert False, payload
+
+
 def test_webhook_info():
     dic = {
         'url': 'weburl',
@@ -649,6 +707,79 @@ def test_inline_keyboard_markup():
     assert obj == r'{"inline_keyboard": [[{"text": "bt1"}], [{"text": "bt2"}], [{"text": "bt3"}]]}'
 
 
+def test_json_backends():
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(text='عطلة 🌴', url='https://t.me/x'))
+    for backend in ('orjson', 'ujson', 'json'):
+        try:
+            types.set_json_backend(backend)
+        except ValueError:
+            continue
+        assert types.get_json_backend() == backend
+        assert types.json_loads(markup.to_json()) == {
+            "inline_keyboard": [[{"text": "عطلة 🌴", "url": "https://t.me/x"}]]}
+        assert types.json_loads(types.json_dumps({1: 2 ** 70})) == {"1": 2 ** 70}
+        assert types.Update.de_json('{"update_id": 5}').update_id == 5
+
+
+def test_frozen_markup():
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(types.InlineKeyboardButton(text='bt1', callback_data='1'),
+               types.InlineKeyboardButton(text='bt2', url='https://t.me/x'))
+    frozen = markup.freeze()
+    assert frozen.to_json() == r'{"inline_keyboard": [[{"text": "bt1", "callback_data": "1"}, {"text": "bt2", "url": "https://t.me/x"}]]}'
+    assert types.convert_markup(frozen) is frozen.to_json()
+    markup.add(types.InlineKeyboardButton(text='bt3', callback_data='3'))
+    assert frozen.to_dict() == {"inline_keyboard": [[{"text": "bt1", "callback_data": "1"},
+                                                     {"text": "bt2", "url": "https://t.me/x"}]]}
+    try:
+        frozen.json_string = '{}'
+    except AttributeError:
+        pass
+    else:
+        assert False
+    assert types.ForceReply(selective=True).freeze().to_json() == r'{"force_reply": true, "selective": true}'
+    assert types.ReplyKeyboardRemove().freeze().to_json() == r'{"remove_keyboard": true}'
+
+
+def test_frozen_markup_registry():
+    menu = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    menu.add('Help', 'Settings')
+    frozen = menu.freeze('test_main_menu')
+    assert frozen.name == 'test_main_menu'
+    assert types.get_frozen_markup('test_main_menu') is frozen
+    same = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    same.add('Help', 'Settings')
+    assert same.freeze('test_main_menu') is frozen
+    # another layout can't take a name already used
+    other = types.ReplyKeyboardMarkup()
+    other.add('Help')
+    try:
+        other.freeze('test_main_menu')
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert types.get_frozen_markup('test_main_menu') is frozen
+    assert types.get_frozen_markup('test_missing') is None
+
+
+def test_frozen_markup_invalid():
+    too_long = types.InlineKeyboardMarkup()
+    too_long.add(types.InlineKeyboardButton(text='bt', callback_data='x' * 65))
+    two_fields = types.InlineKeyboardMarkup()
+    two_fields.add(types.InlineKeyboardButton(text='bt', callback_data='x', url='https://t.me/x'))
+    no_text = types.ReplyKeyboardMarkup()
+    no_text.add('')
+    for markup in (types.ReplyKeyboardMarkup(), types.InlineKeyboardMarkup(), too_long, two_fields, no_text):
+        try:
+            markup.freeze()
+        except ValueError:
+            pass
+        else:
+            assert False, markup.to_dict()
+
+
 def test_inline_keyboard_button():
     obj = types.InlineKeyboardButton(text='text', url='url', callback_data='callback_data',
                                      switch_inline_query='switch_inline_query',
@@ -986,6 +1117,33 @@ def test_inline_query_result():
     pass
 
 
+def test_convert_list_json_serializable():
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(text='open', url='https://t.me/x'))
+    results = [types.InlineQueryResult().Article(id=str(i), title='article {0}'.format(i),
+                                                 input_message_content=types.InputMessageContent().Text('عطلة'),
+                                                 reply_markup=markup, description='d' * 100) for i in range(3)]
+    results.append(types.InlineQueryResult().CachedSticker(type='sticker', id='s', sticker_file_id='f',
+                                                            reply_markup=markup))
+    obj = types.convert_list_json_serializable(results)
+    assert types.json_loads(obj) == [
+        {"type": "article", "id": str(i), "title": "article {0}".format(i),
+         "input_message_content": {"message_text": "عطلة"},
+         "reply_markup": {"inline_keyboard": [[{"text": "open", "url": "https://t.me/x"}]]},
+         "description": "d" * 100} for i in range(3)] + [
+        {"type": "sticker", "id": "s", "sticker_file_id": "f",
+         "reply_markup": {"inline_keyboard": [[{"text": "open", "url": "https://t.me/x"}]]}}]
+    assert types.convert_list_json_serializable([]) == '[]'
+    for kwargs in ({'max_items': 3}, {'max_bytes': len(obj.encode('utf-8')) - 1}):
+        try:
+            types.convert_list_json_serializable(results, **kwargs)
+        except ValueError:
+            pass
+        else:
+            assert False, kwargs
+    assert types.convert_list_json_serializable(results, max_items=4, max_bytes=len(obj.encode('utf-8'))) == obj
+
+
 def test_inline_query_result_article():
     dic = r'{"type": "article", "id": 24, "title": "article", "input_message_content": "any"}'
     obj = types.InlineQueryResult().Article(id=24, title='article', input_message_content='any').to_json()
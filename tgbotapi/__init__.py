@@ -1,5 +1,13 @@
+import concurrent.futures
+import atexit
+import collections
+import inspect
+import itertools
+import heapq
 import threading
 import pickle
+import sqlite3
+import copy
 import time
 import six
 import os
@@ -15,12 +23,27 @@ Module : tgbotapi
 logger = utils.logger
 async_dec = utils.async_dec
 
+# update kinds carrying a Message
+_MESSAGE_KINDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+# result of TBot.download_many for one file, content is None and error set if it failed
+DownloadResult = collections.namedtuple('DownloadResult', ['index', 'file', 'content', 'error'])
+
+# seconds a section of the warm start snapshot stays usable, None for ever, see TBot.enable_warm_start
+_WARM_START_MAX_AGE = {'offset': 86400, 'updates': 86400, 'me': 86400, 'get_file': 3000, 'uploads': None,
+                       'file_ids': None, 'states': None}
+
 
 class Handler:
     """
     Class for (next step|reply) handlers
     """
 
+    # time.time() after which the handler is dropped instead of called, None for never
+    expires = None
+    # called with the key and the handler's args when it expires or is evicted
+    on_expire = None
+
     def __init__(self, callback, *args, **kwargs):
         self.callback = callback
         self.args = args
@@ -29,28 +52,348 @@ class Handler:
     def __getitem__(self, item):
         return getattr(self, item)
 
+    def expired(self, now=None):
+        return self.expires is not None and (time.time() if now is None else now) >= self.expires
+
+
+def _split_expired(key, handlers, now):
+    """
+    :return: (handlers alive at now, (key, handler) pairs of the expired ones)
+    """
+    return ([handler for handler in handlers if not handler.expired(now)],
+            [(key, handler) for handler in handlers if handler.expired(now)])
+
+
+class _HandlerShard:
+    """
+    One stripe of a HandlerRegistry, its lock guards all of its fields
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> handler list, least recently registered first
+        self.entries = collections.OrderedDict()
+        # key -> sequence number of its last registration
+        self.registered = {}
+        # heap of (expires, sequence number, key)
+        self.deadlines = []
+        self.expired = 0
+        self.evicted = 0
+
+
+class HandlerRegistry:
+    """
+    Class for the (next step|reply) handlers of TBot, key -> handler list.
+    Keys are spread over stripes with a lock each, so threads registering and dispatching for different chats
+    don't wait for each other. Expired handlers are swept through a heap of deadlines per stripe, and past
+    max_entries keys the least recently registered ones are evicted. Both return the dropped (key, handler) pairs
+    instead of calling on_expire themselves, TBot runs the callbacks like any other handler.
+    It has the mapping methods Saver uses, returns copies of the handler lists and pickles as a plain dict.
+    """
+
+    def __init__(self, max_entries=None, stripes=32):
+        self.max_entries = max_entries
+        self.shards = [_HandlerShard() for _ in range(stripes)]
+        self.counter = itertools.count()
+
+    def shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    @property
+    def expired(self):
+        return sum(shard.expired for shard in self.shards)
+
+    @property
+    def evicted(self):
+        return sum(shard.evicted for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
+
+    def __bool__(self):
+        return any(shard.entries for shard in self.shards)
+
+    def __contains__(self, key):
+        return key in self.shard(key).entries
+
+    def __iter__(self):
+        return iter([key for key, handlers in self.items()])
+
+    def __getitem__(self, key):
+        shard = self.shard(key)
+        with shard.lock:
+            return list(shard.entries[key])
+
+    def __setitem__(self, key, handlers):
+        shard = self.shard(key)
+        with shard.lock:
+            self.__set(shard, key, list(handlers))
+
+    def __reduce__(self):
+        # saved as a plain dict, so Saver files stay readable without the registry
+        return dict, (dict(self.items()),)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        """
+        :return: list of (key, handlers), least recently registered first
+        """
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                items.extend((shard.registered[key], key, list(handlers)) for key, handlers in shard.entries.items())
+        items.sort(key=lambda item: item[0])
+        return [(key, handlers) for sequence, key, handlers in items]
+
+    def update(self, handlers):
+        for key, key_handlers in handlers.items():
+            self[key] = key_handlers
+
+    def pop(self, key, default=None):
+        shard = self.shard(key)
+        with shard.lock:
+            shard.registered.pop(key, None)
+            return shard.entries.pop(key, default)
+
+    def __set(self, shard, key, handlers):
+        shard.entries[key] = handlers
+        shard.entries.move_to_end(key)
+        shard.registered[key] = next(self.counter)
+        for handler in handlers:
+            self.__schedule(shard, key, handler)
+
+    @staticmethod
+    def __schedule(shard, key, handler):
+        if handler.expires is not None:
+            heapq.heappush(shard.deadlines, (handler.expires, id(handler), key))
+
+    def add(self, key, handler):
+        """
+        Appends handler to the handlers of key and makes key the most recently registered one
+        :return: list of (key, handler) dropped to make room or because they expired in the stripe of key
+        """
+        shard = self.shard(key)
+        with shard.lock:
+            if key in shard.entries:
+                shard.entries[key].append(handler)
+                shard.entries.move_to_end(key)
+                shard.registered[key] = next(self.counter)
+                self.__schedule(shard, key, handler)
+            else:
+                self.__set(shard, key, [handler])
+        return self.__expire(shard, time.time()) + self.__evict()
+
+    def take(self, key):
+        """
+        Removes the handlers of key
+        :return: (handlers to call, (key, handler) pairs that expired before being called)
+        """
+        shard = self.shard(key)
+        with shard.lock:
+            shard.registered.pop(key, None)
+            live, expired = _split_expired(key, shard.entries.pop(key, None) or [], time.time())
+            shard.expired += len(expired)
+        return live, expired
+
+    def sweep(self, now=None):
+        """
+        Removes the expired handlers, then the least recently registered keys past max_entries
+        :return: list of dropped (key, handler)
+        """
+        now = time.time() if now is None else now
+        dropped = []
+        for shard in self.shards:
+            dropped.extend(self.__expire(shard, now))
+        return dropped + self.__evict()
+
+    @staticmethod
+    def __expire(shard, now):
+        dropped = []
+        with shard.lock:
+            while shard.deadlines and shard.deadlines[0][0] <= now:
+                key = heapq.heappop(shard.deadlines)[2]
+                handlers = shard.entries.get(key)
+                if not handlers:
+                    # cleared or called before it expired
+                    continue
+                live, expired = _split_expired(key, handlers, now)
+                if expired:
+                    dropped.extend(expired)
+                    if live:
+                        shard.entries[key] = live
+                    else:
+                        del shard.entries[key]
+                        del shard.registered[key]
+            shard.expired += len(dropped)
+        return dropped
+
+    def __evict(self):
+        dropped = []
+        while self.max_entries is not None and len(self) > self.max_entries:
+            # every stripe is in registration order, the oldest key is the oldest of their first keys
+            oldest = None
+            for shard in self.shards:
+                with shard.lock:
+                    if shard.entries:
+                        key = next(iter(shard.entries))
+                        if oldest is None or shard.registered[key] < oldest[0]:
+                            oldest = (shard.registered[key], shard, key)
+            if oldest is None:
+                break
+            sequence, shard, key = oldest
+            with shard.lock:
+                if shard.registered.get(key) != sequence:
+                    # registered again or removed meanwhile
+                    continue
+                del shard.registered[key]
+                handlers = shard.entries.pop(key)
+                shard.evicted += len(handlers)
+            dropped.extend((key, handler) for handler in handlers)
+        return dropped
+
 
 class Saver:
     """
-    Class for saving (next step|reply) handlers
+    Class for saving (next step|reply) handlers,
+    Changes are coalesced by one flusher thread, which rewrites the file delay seconds after the first change
+    not saved yet, or as soon as every_changes changes are waiting, and the pending changes are saved by close(),
+    called by stop_bot and at exit if on_shutdown is set.
     """
 
-    def __init__(self, handlers, filename, delay):
+    def __init__(self, handlers, filename, delay, every_changes=None, fsync=False, on_shutdown=True):
+        """
+        :param handlers: The handlers saved.
+        :param str filename: The save file, replaced atomically.
+        :param float delay: Seconds between the first change not saved yet and the save, 0 or less saves at once.
+        :param int or None every_changes: Save as soon as this many changes are waiting, whatever delay says.
+        :param bool fsync: fsync the file and its directory after every save, so it also survives a power loss.
+        :param bool on_shutdown: Save the pending changes at exit.
+        """
         self.handlers = handlers
         self.filename = filename
         self.delay = delay
-        self.timer = threading.Timer(delay, self.save_handlers)
+        self.every_changes = every_changes
+        self.fsync = fsync
+        self.on_shutdown = on_shutdown
+        # handlers change from worker threads, the file is shared by them and the flusher
+        self.lock = threading.RLock()
+        # changes not saved yet
+        self.dirty = 0
+        self.flushes = 0
+        self.bytes_written = 0
+        self.flush_seconds = 0
+        self.last_flush_duration = 0
+        # time.monotonic() of the first change not saved yet
+        self.__dirty_since = None
+        self.__cond = threading.Condition()
+        self.__flusher = None
+        self.__closed = False
+
+    def changed(self, key):
+        """
+        Called after the handlers of key were registered or cleared
+        """
+        self.start_save_timer()
 
     def start_save_timer(self):
-        if not self.timer.is_alive():
-            if self.delay <= 0:
-                self.save_handlers()
-            else:
-                self.timer = threading.Timer(self.delay, self.save_handlers)
-                self.timer.start()
+        """
+        Marks the handlers changed, they are saved according to delay and every_changes
+        """
+        with self.__cond:
+            self.dirty += 1
+            if self.__dirty_since is None:
+                self.__dirty_since = time.monotonic()
+            if self.delay > 0 and not self.__closed:
+                if self.__flusher is None:
+                    self.__flusher = threading.Thread(target=self.__flush_loop, name="SaverFlusher", daemon=True)
+                    self.__flusher.start()
+                    if self.on_shutdown:
+                        atexit.register(self.close)
+                self.__cond.notify()
+                return
+        self.flush()
+
+    def __flush_loop(self):
+        while True:
+            with self.__cond:
+                while not self.__closed:
+                    if self.__dirty_since is not None:
+                        if self.every_changes and self.dirty >= self.every_changes:
+                            break
+                        left = self.__dirty_since + self.delay - time.monotonic()
+                        if left <= 0:
+                            break
+                        self.__cond.wait(left)
+                    else:
+                        self.__cond.wait()
+                if self.__closed:
+                    return
+            self.__flush_logged()
+
+    def __flush_logged(self):
+        try:
+            self.flush()
+        except Exception as e:
+            # e.g. a lambda callback, the changes are lost but the bot keeps working
+            logger.error("CAN'T SAVE THE HANDLERS TO {0}: {1!r}".format(self.filename, e))
+
+    def flush(self, force=False):
+        """
+        Saves the handlers if they changed since the last save
+        :param bool force: Save them anyway.
+        :return: True if they were saved
+        :rtype: bool
+        """
+        with self.lock:
+            with self.__cond:
+                if not self.dirty and not force:
+                    return False
+                # changes made while saving are saved by the next flush
+                self.dirty = 0
+                self.__dirty_since = None
+            started = time.monotonic()
+            size = self.save_handlers()
+            self.last_flush_duration = time.monotonic() - started
+            self.flush_seconds += self.last_flush_duration
+            self.flushes += 1
+            self.bytes_written += size
+        return True
+
+    def close(self):
+        """
+        Stops the flusher and saves the pending changes if on_shutdown is set,
+        later changes are saved at once by the thread making them
+        """
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        # a replaced or disabled saver must not write its file at exit
+        atexit.unregister(self.close)
+        if self.__flusher is not None and self.__flusher is not threading.current_thread():
+            self.__flusher.join()
+        if self.on_shutdown:
+            self.__flush_logged()
+
+    def stats(self):
+        """
+        :return: dirty (changes not saved yet), flushes, bytes_written, flush_seconds and last_flush_duration
+        :rtype: dict
+        """
+        return {'dirty': self.dirty, 'flushes': self.flushes, 'bytes_written': self.bytes_written,
+                'flush_seconds': self.flush_seconds, 'last_flush_duration': self.last_flush_duration}
 
     def save_handlers(self):
-        self.dump_handlers(self.handlers, self.filename)
+        """
+        :return: size of the file written in bytes
+        :rtype: int
+        """
+        with self.lock:
+            return self.dump_handlers(self.handlers, self.filename, fsync=self.fsync)
 
     def load_handlers(self, filename, del_file_after_loading=True):
         tmp = self.return_load_handlers(
@@ -59,17 +402,26 @@ class Saver:
             self.handlers.update(tmp)
 
     @staticmethod
-    def dump_handlers(handlers, filename, file_mode="wb"):
+    def dump_handlers(handlers, filename, file_mode="wb", fsync=False):
         dirs = filename.rsplit('/', maxsplit=1)[0]
         os.makedirs(dirs, exist_ok=True)
 
-        with open(filename + ".tmp", file_mode) as file:
-            pickle.dump(handlers, file)
-
-        if os.path.isfile(filename):
-            os.remove(filename)
-
-        os.rename(filename + ".tmp", filename)
+        try:
+            with open(filename + ".tmp", file_mode) as file:
+                pickle.dump(handlers, file)
+                size = file.tell()
+                if fsync:
+                    file.flush()
+                    os.fsync(file.fileno())
+        except Exception:
+            os.remove(filename + ".tmp")
+            raise
+
+        # the old file stays in place until the new one replaces it
+        os.replace(filename + ".tmp", filename)
+        if fsync:
+            _fsync_directory(dirs)
+        return size
 
     @staticmethod
     def return_load_handlers(filename, del_file_after_loading=True):
@@ -83,6 +435,407 @@ class Saver:
             return handlers
 
 
+def _fsync_directory(dirs):
+    """
+    Makes a rename in dirs durable, where directories can be opened
+    """
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(dirs or '.', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class JournalSaver(Saver):
+    """
+    Class for saving (next step|reply) handlers as a snapshot plus an append-only journal,
+    Every change appends the handlers of one key to filename.journal, so saving costs as much as the change
+    instead of the whole dict. The journal is folded into the snapshot only once it has compact_every records
+    or has grown larger than the snapshot (and compact_bytes), delay seconds after a change the journal is
+    only synced. Loading reads the snapshot and replays the journal.
+    """
+
+    def __init__(self, handlers, filename, delay, compact_every=10000, compact_bytes=1048576, **kwargs):
+        Saver.__init__(self, handlers, filename, delay, **kwargs)
+        self.journal_filename = filename + ".journal"
+        self.compact_every = compact_every
+        self.compact_bytes = compact_bytes
+        self.records = 0
+        self.journal_bytes = 0
+        self.snapshot_bytes = os.path.getsize(filename) if os.path.isfile(filename) else 0
+        self.compactions = 0
+        self.journal = None
+
+    def changed(self, key):
+        # read, pickled and appended under one lock, so the records of a key are in the order of its changes
+        with self.lock:
+            try:
+                record = pickle.dumps((key, self.handlers.get(key) or None))
+            except Exception as e:
+                # e.g. a lambda callback, like Saver the change is lost but the bot keeps working
+                logger.error("CAN'T SAVE THE HANDLERS OF {0}: {1}".format(key, e))
+                return
+            if self.journal is None:
+                dirs = os.path.dirname(self.journal_filename)
+                if dirs:
+                    os.makedirs(dirs, exist_ok=True)
+                self.journal = open(self.journal_filename, "ab")
+            self.journal.write(record)
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+            self.records += 1
+            self.journal_bytes += len(record)
+            self.bytes_written += len(record)
+            if self.records >= self.compact_every or \
+                    self.journal_bytes > max(self.snapshot_bytes, self.compact_bytes):
+                try:
+                    self.compact()
+                except Exception as e:
+                    # the journal is kept, so nothing is lost
+                    logger.error("CAN'T COMPACT THE HANDLERS TO {0}: {1!r}".format(self.filename, e))
+        self.start_save_timer()
+
+    def save_handlers(self):
+        """
+        Syncs and closes the journal, the snapshot is only rewritten by compact
+        :return: 0, the journal records are counted in bytes_written as they are appended
+        :rtype: int
+        """
+        with self.lock:
+            if self.journal is not None:
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self.journal.close()
+                self.journal = None
+        return 0
+
+    def compact(self):
+        """
+        Writes the snapshot and empties the journal
+        :return: size of the snapshot in bytes
+        :rtype: int
+        """
+        with self.lock:
+            size = self.dump_handlers({key: handlers for key, handlers in list(self.handlers.items()) if handlers},
+                                      self.filename, fsync=self.fsync)
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if os.path.isfile(self.journal_filename):
+                os.remove(self.journal_filename)
+            self.records = 0
+            self.journal_bytes = 0
+            self.snapshot_bytes = size
+            self.compactions += 1
+            self.bytes_written += size
+        return size
+
+    def load_handlers(self, filename, del_file_after_loading=True):
+        """
+        Loads the snapshot and replays the journal, then folds them into a new snapshot,
+        The files are the live store of the saver so they are kept whatever del_file_after_loading says.
+        """
+        with self.lock:
+            self.handlers.update(self.return_load_handlers(filename, del_file_after_loading=False) or {})
+            for key, handlers in self.return_load_journal(filename + ".journal"):
+                if handlers:
+                    self.handlers[key] = handlers
+                else:
+                    self.handlers.pop(key, None)
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            self.filename, self.journal_filename = filename, filename + ".journal"
+            self.compact()
+
+    @staticmethod
+    def return_load_journal(filename):
+        records = []
+        if os.path.isfile(filename):
+            with open(filename, "rb") as file:
+                while True:
+                    try:
+                        records.append(pickle.load(file))
+                    except EOFError:
+                        break
+                    except (pickle.UnpicklingError, ValueError, TypeError, AttributeError, ImportError):
+                        # torn last record after a crash
+                        logger.warning("IGNORED A DAMAGED RECORD AT THE END OF {0}".format(filename))
+                        break
+        return records
+
+
+class HandlerStore:
+    """
+    Interface of the stores TBot.enable_handler_store keeps (next step|reply) handlers in instead of memory,
+    handler lists by kind ('next_step' or 'reply') and key (chat_id or message_id).
+    Nothing is loaded at startup, the handlers of a key are read when a message for it arrives.
+    Callbacks are stored by the name they were registered with by callback(), not pickled.
+    """
+
+    def __init__(self):
+        self.callbacks = {}
+        self.names = {}
+
+    def callback(self, name=None):
+        """
+        Registers a function that can be stored as the callback or on_expire of a handler, usable as a decorator
+        :param str or None name: Name stored instead of the function, module.qualname by default.
+        """
+
+        def decorator(function):
+            key = name or '{0}.{1}'.format(function.__module__, function.__qualname__)
+            self.callbacks[key] = function
+            self.names[function] = key
+            return function
+
+        return decorator
+
+    def name_of(self, function):
+        if function is None:
+            return None
+        try:
+            return self.names[function]
+        except (KeyError, TypeError):
+            raise ValueError("{0!r} isn't registered, see HandlerStore.callback".format(function))
+
+    def encode(self, handlers):
+        return pickle.dumps([(self.name_of(handler.callback), handler.args, handler.kwargs, handler.expires,
+                              self.name_of(handler.on_expire)) for handler in handlers])
+
+    def decode(self, data):
+        handlers = []
+        for callback, args, kwargs, expires, on_expire in pickle.loads(data):
+            if callback not in self.callbacks or (on_expire is not None and on_expire not in self.callbacks):
+                logger.warning("DROPPED A HANDLER OF THE UNKNOWN CALLBACK {0}".format(callback))
+                continue
+            handler = Handler(self.callbacks[callback], *args, **kwargs)
+            handler.expires = expires
+            handler.on_expire = self.callbacks.get(on_expire)
+            handlers.append(handler)
+        return handlers
+
+    def get(self, kind, key):
+        """
+        :return: the handlers of key, [] if it has none
+        :rtype: list[Handler]
+        """
+        raise NotImplementedError
+
+    def put(self, kind, key, handlers, touch=True):
+        """
+        Replaces the handlers of key, removes key if handlers is empty
+        :param bool touch: Make key the most recently registered one.
+        """
+        raise NotImplementedError
+
+    def take(self, kind, key):
+        """
+        Removes the handlers of key
+        :return: the removed handlers
+        :rtype: list[Handler]
+        """
+        raise NotImplementedError
+
+    def expiring(self, kind, now):
+        """
+        :return: (key, handlers) of the keys having a handler that expires at or before now
+        """
+        raise NotImplementedError
+
+    def pop_oldest(self, kind, count):
+        """
+        Removes the count least recently registered keys
+        :return: their (key, handlers)
+        """
+        raise NotImplementedError
+
+    def count(self, kind):
+        """
+        :return: number of keys with handlers
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SqliteHandlerStore(HandlerStore):
+    """
+    HandlerStore in an SQLite database, one row per key, safe to share between threads
+    """
+
+    def __init__(self, filename="./.handler-saves/handlers.db"):
+        """
+        :param str filename: Database file, ':memory:' for a temporary one.
+        """
+        HandlerStore.__init__(self)
+        dirs = os.path.dirname(filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS handlers (kind TEXT NOT NULL, key NOT NULL, "
+                                "handlers BLOB NOT NULL, expires REAL, registered REAL NOT NULL, "
+                                "PRIMARY KEY (kind, key))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS handlers_expires ON handlers (kind, expires)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS handlers_registered ON handlers (kind, registered)")
+
+    def get(self, kind, key):
+        with self.lock:
+            row = self.connection.execute("SELECT handlers FROM handlers WHERE kind = ? AND key = ?",
+                                          (kind, key)).fetchone()
+        return [] if row is None else self.decode(row[0])
+
+    def put(self, kind, key, handlers, touch=True):
+        if not handlers:
+            with self.lock:
+                self.connection.execute("DELETE FROM handlers WHERE kind = ? AND key = ?", (kind, key))
+            return
+        data = self.encode(handlers)
+        deadlines = [handler.expires for handler in handlers if handler.expires is not None]
+        expires = min(deadlines) if deadlines else None
+        with self.lock:
+            if touch:
+                self.connection.execute("INSERT OR REPLACE INTO handlers VALUES (?, ?, ?, ?, ?)",
+                                        (kind, key, data, expires, time.time()))
+            else:
+                self.connection.execute("UPDATE handlers SET handlers = ?, expires = ? WHERE kind = ? AND key = ?",
+                                        (data, expires, kind, key))
+
+    def take(self, kind, key):
+        with self.lock:
+            row = self.connection.execute("SELECT handlers FROM handlers WHERE kind = ? AND key = ?",
+                                          (kind, key)).fetchone()
+            if row is not None:
+                self.connection.execute("DELETE FROM handlers WHERE kind = ? AND key = ?", (kind, key))
+        return [] if row is None else self.decode(row[0])
+
+    def expiring(self, kind, now):
+        with self.lock:
+            rows = self.connection.execute("SELECT key, handlers FROM handlers WHERE kind = ? AND expires <= ?",
+                                           (kind, now)).fetchall()
+        return [(key, self.decode(data)) for key, data in rows]
+
+    def pop_oldest(self, kind, count):
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                rows = self.connection.execute("SELECT key, handlers FROM handlers WHERE kind = ? "
+                                               "ORDER BY registered LIMIT ?", (kind, count)).fetchall()
+                self.connection.executemany("DELETE FROM handlers WHERE kind = ? AND key = ?",
+                                            [(kind, key) for key, data in rows])
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return [(key, self.decode(data)) for key, data in rows]
+
+    def count(self, kind):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM handlers WHERE kind = ?", (kind,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class StoredHandlerRegistry:
+    """
+    HandlerRegistry counterpart for TBot.enable_handler_store, nothing is kept in memory
+    Registering only sweeps the store every sweep_every registrations or sweep_interval seconds,
+    max_entries is enforced in between with a count of the keys kept up to date by this registry.
+    """
+
+    def __init__(self, store, kind, max_entries=None, stripes=32, sweep_every=256, sweep_interval=1.0):
+        self.store = store
+        self.kind = kind
+        self.max_entries = max_entries
+        self.sweep_every = sweep_every
+        self.sweep_interval = sweep_interval
+        self.lock = threading.RLock()
+        # registering reads then writes the handlers of a key, like HandlerRegistry they're locked by stripe
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.expired = 0
+        self.evicted = 0
+        # number of keys, read from the store by sweep and counted in between, None until first needed
+        self.__size = None
+        self.__adds = 0
+        self.__swept_at = time.monotonic()
+
+    def __len__(self):
+        return self.store.count(self.kind)
+
+    def __contains__(self, key):
+        return bool(self.store.get(self.kind, key))
+
+    def add(self, key, handler):
+        with self.locks[hash(key) % len(self.locks)]:
+            handlers = self.store.get(self.kind, key)
+            self.store.put(self.kind, key, handlers + [handler])
+        with self.lock:
+            self.__adds += 1
+            if self.__adds >= self.sweep_every or time.monotonic() - self.__swept_at >= self.sweep_interval:
+                return self.sweep()
+            if not handlers:
+                self.__resize(1)
+            return self.__evict()
+
+    def pop(self, key, default=None):
+        handlers = self.store.take(self.kind, key)
+        if handlers:
+            self.__resize(-1)
+        return handlers or default
+
+    def take(self, key):
+        handlers = self.store.take(self.kind, key)
+        if handlers:
+            self.__resize(-1)
+        live, expired = _split_expired(key, handlers, time.time())
+        self.expired += len(expired)
+        return live, expired
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        dropped = []
+        with self.lock:
+            for key, handlers in self.store.expiring(self.kind, now):
+                live, expired = _split_expired(key, handlers, now)
+                dropped.extend(expired)
+                self.store.put(self.kind, key, live, touch=False)
+            self.expired += len(dropped)
+            self.__size = len(self)
+            self.__adds = 0
+            self.__swept_at = time.monotonic()
+            return dropped + self.__evict()
+
+    def __resize(self, change):
+        with self.lock:
+            if self.__size is not None:
+                self.__size = max(0, self.__size + change)
+
+    def __evict(self):
+        dropped = []
+        if self.max_entries is None:
+            return dropped
+        with self.lock:
+            if self.__size is None:
+                self.__size = len(self)
+            extra = self.__size - self.max_entries
+            if extra > 0:
+                for key, handlers in self.store.pop_oldest(self.kind, extra):
+                    dropped.extend((key, handler) for handler in handlers)
+                    self.evicted += len(handlers)
+                    self.__size -= 1
+        return dropped
+
+
 class TBot:
     """ This is TBot Class """
 
@@ -104,14 +857,55 @@ class TBot:
 
         self.__update_listener = []
         self.__stop_polling = threading.Event()
+        # set while no polling loop runs, stop_bot waits for it before closing the stores
+        self.__polling_done = threading.Event()
+        self.__polling_done.set()
+        # thread running the polling loop, and whether stop_bot was called from one of its handlers
+        self.__polling_thread = None
+        self.__close_on_stop = False
+        # hands the closing over between stop_bot and the end of the polling loop
+        self.__stop_lock = threading.Lock()
         self.__last_update_id = 0
         self.__exc_info = None
+        # commits the update_id of handled updates, see enable_offset_store
+        self.__offsets = None
+        # batch of the updates being dispatched by this thread
+        self.__dispatching = threading.local()
+        # update_ids seen lately, see enable_update_dedup
+        self.__update_window = None
+        # durable log of the calls made by enqueue, see enable_outbox
+        self.__outbox = None
+        # snapshot file written by stop_bot, see enable_warm_start
+        self.__warm_start = None
+        # get_me result, cached while warm start is enabled
+        self.__me = None
+
+        # key: update kind, value: count of updates skipped without decoding them
+        self.__skipped_updates = {}
+
+        # content hash of uploaded files -> file_id, see enable_upload_cache
+        self.__upload_cache = None
+        # file_unique_id -> downloaded file, see enable_file_cache
+        self.__file_cache = None
+        # file_id -> File, see enable_get_file_cache
+        self.__get_file_cache = None
+        # file_unique_id -> freshest file_id seen, see enable_file_id_index
+        self.__file_id_index = None
 
         # key: message_id, value: handler list
-        self.__reply_handlers = {}
+        self.__reply_handlers = HandlerRegistry()
 
         # key: chat_id, value: handler list
-        self.__next_step_handlers = {}
+        self.__next_step_handlers = HandlerRegistry()
+        # seconds (next step|reply) handlers live when registered without a ttl, see enable_handler_expiry
+        self.__handler_ttl = None
+        # where (next step|reply) handlers are kept instead of memory, see enable_handler_store
+        self.__handler_store = None
+
+        # (chat_id, user_id) -> conversation state and data, see enable_states
+        self.__state_storage = None
+        # key: state, value: handler list
+        self.__state_handlers = {}
         self.__next_step_saver = None
         self.__reply_saver = None
 
@@ -143,20 +937,82 @@ class TBot:
             updates.append(types.Update.de_json(x))
         return updates
 
+    def get_skipped_updates(self):
+        """
+        Counts of the updates the polling loop received but didn't decode, because no handler or listener
+        was registered for their kind.
+        :return: key: update kind (message, edited_message, ...), value: count of skipped updates
+        :rtype: dict
+        """
+        return dict(self.__skipped_updates)
+
+    def __consumed_update_kinds(self):
+        """
+        Update kinds that have at least one handler or listener registered
+        :return: set of update kinds
+        """
+        consumers = {
+            'message': self.__message_handlers or self.__update_listener or self.__next_step_handlers or
+            self.__reply_handlers or self.__state_handlers,
+            'edited_message': self.__edited_message_handlers,
+            'channel_post': self.__channel_post_handlers,
+            'edited_channel_post': self.__edited_channel_post_handlers,
+            'inline_query': self.__inline_query_handlers,
+            'chosen_inline_result': self.__chosen_inline_handlers,
+            'callback_query': self.__callback_query_handlers,
+            'shipping_query': self.__shipping_query_handlers,
+            'pre_checkout_query': self.__pre_checkout_query_handlers,
+            'poll': self.__poll_handlers,
+            'poll_answer': self.__poll_answer_handlers
+        }
+        return {kind for kind, handlers in consumers.items() if handlers}
+
+    def __decode_updates(self, objs):
+        """
+        Decodes the updates of consumed kinds, the others only move the offset forward and are counted as skipped
+        :param list objs: raw updates returned by getUpdates
+        :return: An Array of Update objects.
+        :rtype: list[types.Update]
+        """
+        kinds = self.__consumed_update_kinds()
+        index = self.__file_id_index
+        window = self.__update_window
+        updates = []
+        duplicates = 0
+        for obj in objs:
+            if window is not None and not window.add(obj['update_id']):
+                if obj['update_id'] > self.__last_update_id:
+                    self.__last_update_id = obj['update_id']
+                duplicates += 1
+                continue
+            kind = next((key for key in obj if key != 'update_id'), None)
+            if index is not None and kind in _MESSAGE_KINDS:
+                index.harvest(obj[kind])
+            if kind in kinds:
+                updates.append(types.Update.de_json(obj))
+            else:
+                if obj['update_id'] > self.__last_update_id:
+                    self.__last_update_id = obj['update_id']
+                self.__skipped_updates[kind] = self.__skipped_updates.get(kind, 0) + 1
+        if duplicates:
+            logger.debug('DROPPED {0} UPDATES RECEIVED TWICE'.format(duplicates))
+        if len(updates) + duplicates < len(objs):
+            logger.debug('SKIPPED {0} UPDATES WITHOUT HANDLERS'.format(len(objs) - len(updates) - duplicates))
+        return updates
+
     def __skip_updates(self):
         """
         Get and discard all pending updates before first poll of the bot
         :return: total updates skipped
         """
         total = 0
-        updates = self.get_updates(offset=self.__last_update_id, timeout=1)
-        while updates:
-            total += len(updates)
-            for update in updates:
-                if update.update_id > self.__last_update_id:
-                    self.__last_update_id = update.update_id
-            updates = self.get_updates(
-                offset=self.__last_update_id + 1, timeout=1)
+        objs = methods.get_updates(self.__token, self.__proxies, self.__last_update_id, None, 1, None)
+        while objs:
+            total += len(objs)
+            for obj in objs:
+                if obj['update_id'] > self.__last_update_id:
+                    self.__last_update_id = obj['update_id']
+            objs = methods.get_updates(self.__token, self.__proxies, self.__last_update_id + 1, None, 1, None)
         return total
 
     def __retrieve_updates(self, timeout=20):
@@ -165,13 +1021,45 @@ class TBot:
         Registered listeners and applicable message handlers will be notified when a new message arrives.
         :raises ApiException when a call has failed.
         """
+        offsets = self.__offsets
         if self.__skip_pending:
             logger.info('SKIPPED {0} PENDING MESSAGES'.format(
                 self.__skip_updates()))
             self.__skip_pending = False
-        updates = self.get_updates(
-            offset=(self.__last_update_id + 1), timeout=timeout)
-        self.__process_new_updates(updates)
+            if offsets is not None:
+                offsets.dispatched(offsets.begin(self.__last_update_id))
+        if offsets is None:
+            objs = methods.get_updates(self.__token, self.__proxies, self.__last_update_id + 1, None, timeout, None)
+            self.__process_new_updates(self.__decode_updates(objs))
+        else:
+            # updates are confirmed to Telegram only once handled, those still being handled come again
+            committed = offsets.committed
+            objs = methods.get_updates(self.__token, self.__proxies, committed + 1, None, timeout, None)
+            new_objs = [obj for obj in objs if obj['update_id'] > self.__last_update_id]
+            if new_objs:
+                batch = offsets.begin(max(obj['update_id'] for obj in new_objs))
+                self.__dispatching.batch = batch
+                try:
+                    self.__process_new_updates(self.__decode_updates(new_objs))
+                finally:
+                    self.__dispatching.batch = None
+                    offsets.dispatched(batch)
+            elif objs:
+                # nothing new before the handlers of the pending updates finish
+                offsets.wait(committed, timeout)
+            offsets.flush()
+        # every poll, so sessions time out even if their chat stays silent
+        self.__drop_handlers(self.__next_step_handlers.sweep(), self.__next_step_saver)
+        self.__drop_handlers(self.__reply_handlers.sweep(), self.__reply_saver)
+
+    def process_new_updates(self, objs):
+        """
+        Handles updates received by a webhook, those already handled are dropped if enable_update_dedup was called.
+        :param list objs: The updates as decoded from the JSON Telegram posted, a dict for one update.
+        """
+        if isinstance(objs, dict):
+            objs = [objs]
+        self.__process_new_updates(self.__decode_updates(objs))
 
     def __process_new_updates(self, updates):
         new_messages = []
@@ -239,6 +1127,7 @@ class TBot:
     def __process_new_messages(self, new_messages):
         self._notify_next_handlers(new_messages)
         self._notify_reply_handlers(new_messages)
+        self._notify_state_handlers(new_messages)
         self.__notify_update(new_messages)
         self._notify_command_handlers(self.__message_handlers, new_messages)
 
@@ -306,10 +1195,20 @@ class TBot:
         :param timeout: Integer: Timeout in seconds for long polling.
         :return:
         """
-        if self.__threaded:
-            self.__threaded_polling(none_stop, interval, timeout)
-        else:
-            self.__non_threaded_polling(none_stop, interval, timeout)
+        self.__polling_done.clear()
+        self.__polling_thread = threading.current_thread()
+        try:
+            if self.__threaded:
+                self.__threaded_polling(none_stop, interval, timeout)
+            else:
+                self.__non_threaded_polling(none_stop, interval, timeout)
+        finally:
+            with self.__stop_lock:
+                self.__polling_thread = None
+                self.__polling_done.set()
+                close, self.__close_on_stop = self.__close_on_stop, False
+            if close:
+                self.__close()
 
     def __threaded_polling(self, none_stop=False, interval=0, timeout=3):
         logger.info('STARTED POLLING')
@@ -377,6 +1276,9 @@ class TBot:
         logger.info('STOPPED POLLING')
 
     def _exec_task(self, task, *args, **kwargs):
+        batch = getattr(self.__dispatching, 'batch', None)
+        if batch is not None:
+            task = self.__offsets.wrap(batch, task)
         if self.__threaded:
             self.__worker_pool.put(task, *args, **kwargs)
         else:
@@ -387,8 +1289,42 @@ class TBot:
 
     def stop_bot(self):
         self.stop_polling()
-        if self.__worker_pool:
+        current = threading.current_thread()
+        in_handler = current is self.__polling_thread or \
+            (self.__threaded and current in self.__worker_pool.workers)
+        if in_handler:
+            with self.__stop_lock:
+                if not self.__polling_done.is_set():
+                    # the polling loop closes the bot once its current updates are handled
+                    self.__close_on_stop = True
+                    return
+        else:
+            # the stores can't be closed while the polling loop still uses them
+            self.__polling_done.wait()
+        self.__close()
+
+    def __close(self):
+        if self.__threaded and self.__worker_pool:
             self.__worker_pool.close()
+        if self.__warm_start is not None:
+            try:
+                self.save_warm_start()
+            except OSError as e:
+                logger.error("CAN'T WRITE THE SNAPSHOT {0}: {1}".format(self.__warm_start, e))
+        if self.__offsets is not None:
+            self.__offsets.flush(force=True)
+            self.__offsets.store.close()
+        if self.__outbox is not None:
+            self.__outbox.close()
+        if self.__file_id_index is not None and self.__file_id_index.filename is not None:
+            self.__file_id_index.save()
+        for saver in (self.__next_step_saver, self.__reply_saver):
+            if saver is not None:
+                saver.close()
+        if self.__handler_store is not None:
+            self.__handler_store.close()
+        if self.__state_storage is not None:
+            self.__state_storage.close()
 
     def set_update_listener(self, listener):
         self.__update_listener.append(listener)
@@ -427,7 +1363,12 @@ class TBot:
         :return: a User object.
         :rtype: types.User
         """
-        return types.User.de_json(methods.get_me(self.__token, self.__proxies))
+        if self.__warm_start is not None and self.__me is not None:
+            return self.__me
+        me = types.User.de_json(methods.get_me(self.__token, self.__proxies))
+        if self.__warm_start is not None:
+            self.__me = me
+        return me
 
     def send_message(self, chat_id, text, parse_mode=None, disable_web_page_preview=False, disable_notification=False,
                      reply_to_message_id=None, reply_markup=None):
@@ -461,6 +1402,159 @@ class TBot:
             methods.forward_message(self.__token, self.__proxies, chat_id, from_chat_id, message_id,
                                     disable_notification))
 
+    def enable_upload_cache(self, filename="./.upload-cache/uploads.cache", max_entries=10000):
+        """
+        Enable the upload cache (by default disabled): after a file is uploaded with send_photo, send_audio,
+        send_document, send_video, send_sticker or send_media_group, sending the same content again passes
+        the file_id Telegram returned instead of uploading it.
+
+        :param str or None filename: File the cache is persisted to, None keeps it in memory only.
+        :param int max_entries: Maximum number of file_ids kept, least recently used are evicted first.
+        :return: the cache, see utils.UploadCache
+        :rtype: utils.UploadCache
+        """
+        self.__upload_cache = utils.UploadCache(filename, max_entries)
+        return self.__upload_cache
+
+    def disable_upload_cache(self):
+        """
+        Disable the upload cache (by default disabled)
+        """
+        self.__upload_cache = None
+
+    def enable_file_cache(self, directory="./.file-cache", max_bytes=1073741824, memory_bytes=0):
+        """
+        Enable the download cache (by default disabled): files fetched with download_media are kept on disk
+        by file_unique_id, so the same sticker, avatar or document is read from disk the next time,
+        without calling getFile or downloading it.
+
+        :param str directory: Directory the files are stored in.
+        :param int max_bytes: Maximum total size on disk, least recently used files are removed first.
+        :param int memory_bytes: Maximum total size of the most recently used files also kept in memory.
+        :return: the cache, see utils.FileCache
+        :rtype: utils.FileCache
+        """
+        self.__file_cache = utils.FileCache(directory, max_bytes, memory_bytes)
+        return self.__file_cache
+
+    def disable_file_cache(self):
+        """
+        Disable the download cache (by default disabled)
+        """
+        self.__file_cache = None
+
+    def enable_get_file_cache(self, ttl=3000, max_entries=10000):
+        """
+        Enable caching get_file results (by default disabled): the file_path Telegram returns stays valid
+        for at least an hour, so get_file answers from memory for ttl seconds, concurrent calls for the same
+        file_id share one getFile request, and a download failing with 400 or 404 drops the cached path.
+
+        :param float ttl: Seconds a result is reused, keep it under an hour.
+        :param int max_entries: Maximum number of results kept.
+        :return: the cache, see utils.TTLCache
+        :rtype: utils.TTLCache
+        """
+        self.__get_file_cache = utils.TTLCache(ttl, max_entries)
+        return self.__get_file_cache
+
+    def disable_get_file_cache(self):
+        """
+        Disable caching get_file results (by default disabled)
+        """
+        self.__get_file_cache = None
+
+    def enable_file_id_index(self, max_entries=100000, filename=None):
+        """
+        Enable the file_id index (by default disabled): the files of every incoming and sent message are recorded
+        by file_unique_id, so bot.file_id_index.resolve(file_unique_id or your own key) gives a file_id to send
+        them again, and send_photo, send_document, ... given a received PhotoSize, Document, ... use the freshest one.
+
+        :param int max_entries: Maximum number of files kept, the least recently seen are dropped first.
+        :param str or None filename: Snapshot file, loaded now and saved by stop_bot.
+        :return: the index, see utils.FileIdIndex
+        :rtype: utils.FileIdIndex
+        """
+        self.__file_id_index = utils.FileIdIndex(max_entries, filename)
+        return self.__file_id_index
+
+    def disable_file_id_index(self):
+        """
+        Disable the file_id index (by default disabled)
+        """
+        self.__file_id_index = None
+
+    @property
+    def file_id_index(self):
+        """
+        :return: the index enabled by enable_file_id_index or None.
+        :rtype: utils.FileIdIndex or None
+        """
+        return self.__file_id_index
+
+    def __upload(self, kind, data, send):
+        index = self.__file_id_index
+        if index is not None:
+            send = self.__harvesting(send, index)
+        if hasattr(data, 'file_unique_id') and hasattr(data, 'file_id'):
+            # a PhotoSize, Document, ... received before, sent with the freshest file_id known for it
+            data = (index.resolve(data.file_unique_id) if index is not None else None) or data.file_id
+        cache = self.__upload_cache
+        key = cache.key(kind, data) if cache is not None else None
+        if key is None:
+            return send(data)
+        file_id = cache.get(key)
+        if file_id is not None:
+            try:
+                return send(file_id)
+            except utils.ApiException as e:
+                if not re.search(r'wrong.*file|file.*temporarily unavailable', str(e), re.IGNORECASE):
+                    raise
+                # the file_id is no longer usable, upload the content again
+                cache.discard(key)
+        result = send(data)
+        self.__remember_upload(key, kind, result)
+        return result
+
+    @staticmethod
+    def __harvesting(send, index):
+        def wrapper(data):
+            result = send(data)
+            index.harvest(result)
+            return result
+
+        return wrapper
+
+    def __remember_upload(self, key, kind, result):
+        sent = result.get(kind)
+        if isinstance(sent, list):
+            # photos come back in several sizes, the largest one is the original
+            sent = sent[-1] if sent else None
+        if sent and 'file_id' in sent and self.__upload_cache is not None:
+            self.__upload_cache.put(key, sent['file_id'])
+
+    def __cached_media(self, media):
+        cache = self.__upload_cache
+        index = self.__file_id_index
+        if (cache is None and index is None) or utils.is_string(media):
+            return media, None
+        items = []
+        keys = []
+        for item in media:
+            key = file_id = None
+            value = getattr(item, 'media', '')
+            if hasattr(value, 'file_unique_id'):
+                file_id = index.resolve(value.file_unique_id) if index is not None else None
+            elif cache is not None and not utils.is_string(value):
+                key = cache.key(item.type, value)
+                file_id = cache.get(key) if key is not None else None
+            if file_id is not None:
+                item = copy.copy(item)
+                item.media = file_id
+                key = None
+            items.append(item)
+            keys.append(key)
+        return items, keys
+
     def send_photo(self, chat_id, photo, caption=None, parse_mode=None, disable_notification=False,
                    reply_to_message_id=None, reply_markup=None):
         """
@@ -476,8 +1570,9 @@ class TBot:
         :rtype: types.Message
         """
         return types.Message.de_json(
-            methods.send_photo(self.__token, self.__proxies, chat_id, photo, caption, parse_mode, disable_notification,
-                               reply_to_message_id, reply_markup))
+            self.__upload('photo', photo, lambda photo: methods.send_photo(
+                self.__token, self.__proxies, chat_id, photo, caption, parse_mode, disable_notification,
+                reply_to_message_id, reply_markup)))
 
     def send_audio(self, chat_id, audio, caption=None, parse_mode=None, duration=None, performer=None, title=None,
                    thumb=None, disable_notification=False, reply_to_message_id=None, reply_markup=None):
@@ -498,9 +1593,9 @@ class TBot:
         :rtype: types.Message
         """
         return types.Message.de_json(
-            methods.send_audio(self.__token, self.__proxies, chat_id, audio, caption, parse_mode, duration, performer,
-                               title, thumb,
-                               disable_notification, reply_to_message_id, reply_markup))
+            self.__upload('audio', audio, lambda audio: methods.send_audio(
+                self.__token, self.__proxies, chat_id, audio, caption, parse_mode, duration, performer, title, thumb,
+                disable_notification, reply_to_message_id, reply_markup)))
 
     def send_document(self, chat_id, document, thumb=None, caption=None, parse_mode=None, disable_notification=False,
                       reply_to_message_id=None, reply_markup=None):
@@ -518,9 +1613,9 @@ class TBot:
         :rtype: types.Message
         """
         return types.Message.de_json(
-            methods.send_document(self.__token, self.__proxies, chat_id, document, thumb, caption, parse_mode,
-                                  disable_notification,
-                                  reply_to_message_id, reply_markup))
+            self.__upload('document', document, lambda document: methods.send_document(
+                self.__token, self.__proxies, chat_id, document, thumb, caption, parse_mode, disable_notification,
+                reply_to_message_id, reply_markup)))
 
     def send_video(self, chat_id, video, duration=None, width=None, height=None, thumb=None, caption=None,
                    parse_mode=None, supports_streaming=None, disable_notification=False, reply_to_message_id=None,
@@ -543,9 +1638,9 @@ class TBot:
         :rtype: types.Message
         """
         return types.Message.de_json(
-            methods.send_video(self.__token, self.__proxies, chat_id, video, duration, width, height, thumb, caption,
-                               parse_mode,
-                               supports_streaming, disable_notification, reply_to_message_id, reply_markup))
+            self.__upload('video', video, lambda video: methods.send_video(
+                self.__token, self.__proxies, chat_id, video, duration, width, height, thumb, caption, parse_mode,
+                supports_streaming, disable_notification, reply_to_message_id, reply_markup)))
 
     def send_animation(self, chat_id, animation, duration=None, width=None, height=None, thumb=None, caption=None,
                        parse_mode=None, disable_notification=False, reply_to_message_id=None, reply_markup=None):
@@ -615,19 +1710,56 @@ class TBot:
         """
         Use this method to send a group of photos or videos as an album.
         :param int or str chat_id: Unique identifier for the target chat or username of the target channel.
-        :param list media: A JSON-serialized array of [InputMediaPhoto or InputMediaVideo] to be sent, must include 2–10 items
+        :param list media: A JSON-serialized array of [InputMediaPhoto or InputMediaVideo] to be sent, must include 2–10 items,
+            or a list of them, files given as media or thumb are uploaded as attachments of the same request.
         :param bool disable_notification: Sends the message silently. Users will receive a notification with no sound.
         :param int or None reply_to_message_id: If the message is a reply, ID of the original message.
         :return: a Messages object.
         :rtype: types.Message
         """
+        media, keys = self.__cached_media(media)
         result = methods.send_media_group(
             self.__token, self.__proxies, chat_id, media, disable_notification, reply_to_message_id)
+        if keys and len(result) == len(media):
+            for key, item, msg in zip(keys, media, result):
+                if key is not None:
+                    self.__remember_upload(key, item.type, msg)
+        if self.__file_id_index is not None:
+            for msg in result:
+                self.__file_id_index.harvest(msg)
         ret = []
         for msg in result:
             ret.append(types.Message.de_json(msg))
         return ret
 
+    def send_media_groups(self, albums, num_threads=4, disable_notification=False):
+        """
+        Use this method to send several albums, usually to different chats, uploading up to num_threads at once.
+        With the upload cache enabled the first album is sent alone, so albums sharing its files reuse their file_ids.
+        Albums sent at the same time must not share file objects, pass bytes to share content between them.
+        :param list albums: (chat_id, media) pairs, media as for send_media_group.
+        :param int num_threads: Maximum number of albums uploaded at the same time.
+        :param bool disable_notification: Sends the messages silently. Users will receive a notification with no sound.
+        :return: for each album in order, its list of Messages or the exception that made it fail.
+        :rtype: list
+        """
+        albums = list(albums)
+        results = [None] * len(albums)
+
+        def send(i):
+            try:
+                results[i] = self.send_media_group(albums[i][0], albums[i][1], disable_notification)
+            except Exception as e:
+                results[i] = e
+
+        pending = list(range(len(albums)))
+        if self.__upload_cache is not None and pending:
+            send(pending.pop(0))
+        if pending:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(num_threads, len(pending)))) as pool:
+                list(pool.map(send, pending))
+        return results
+
     def send_location(self, chat_id, latitude, longitude, live_period=None, disable_notification=False,
                       reply_to_message_id=None, reply_markup=None):
         """
@@ -795,16 +1927,173 @@ class TBot:
         :return: a File object.
         :rtype: types.File
         """
-        return types.File.de_json(methods.get_file(self.__token, self.__proxies, file_id))
+        cache = self.__get_file_cache
+        if cache is None:
+            return types.File.de_json(methods.get_file(self.__token, self.__proxies, file_id))
+        return cache.get(file_id, lambda: types.File.de_json(methods.get_file(self.__token, self.__proxies, file_id)))
 
-    def download_file(self, file_path):
+    def download_file(self, file_path, destination=None, chunk_size=65536):
         """
         Use this method to download file with specified file_path.
         :param str file_path: File path, User https://api.telegram.org/file/bot<token>/<file_path> to get the file.
-        :return: any, On success.
-        :rtype: bytearray
-        """
-        return methods.download_file(self.__token, self.__proxies, file_path)
+        :param destination: If passed, the file is streamed into it instead of being returned, a path,
+            a binary file-like object or a callable receiving each chunk.
+        :param int chunk_size: Size of the chunks streamed into destination.
+        :return: the file content, or the number of bytes written if destination is passed.
+        :rtype: bytes or int
+        """
+        try:
+            if destination is None:
+                return methods.download_file(self.__token, self.__proxies, file_path)
+            return methods.download_file_to(self.__token, self.__proxies, file_path, destination, chunk_size)
+        except utils.ApiException as e:
+            self.__expire_file_path(e, file_path)
+            raise
+
+    def iter_download_file(self, file_path, chunk_size=65536):
+        """
+        Use this method to download file with specified file_path chunk by chunk.
+        :param str file_path: File path, User https://api.telegram.org/file/bot<token>/<file_path> to get the file.
+        :param int chunk_size: Maximum size of each chunk.
+        :return: an iterator of bytes chunks.
+        :rtype: collections.Iterator[bytes]
+        """
+        return methods.iter_download_file(self.__token, self.__proxies, file_path, chunk_size)
+
+    def download_file_into(self, file, buffer=None):
+        """
+        Use this method to download a file into memory without extra copies, into a bytearray preallocated
+        from File.file_size or into a buffer you pass.
+        :param file: File identifier, or the File object returned by get_file.
+        :type file: str or types.File
+        :param buffer: Writable bytes-like object (bytearray, memoryview, mmap, ...) receiving the file.
+        :return: a view of the part of the buffer holding the file, memoryview.obj is the buffer.
+        :rtype: memoryview
+        """
+        file_id = None
+        if not isinstance(file, types.File):
+            file_id, file = file, self.get_file(file)
+        try:
+            return methods.download_file_into(self.__token, self.__proxies, file.file_path, buffer, file.file_size)
+        except utils.ApiException as e:
+            if file_id is None or not self.__expire_file_path(e, file.file_path):
+                raise
+        # the cached file_path has expired
+        file = self.get_file(file_id)
+        return methods.download_file_into(self.__token, self.__proxies, file.file_path, buffer, file.file_size)
+
+    def download_file_ranged(self, file, destination, segment_size=4194304, num_threads=4, retries=2):
+        """
+        Use this method to download a large file in parallel Range segments, resuming where a previous call stopped.
+        :param file: File identifier, or the File object returned by get_file.
+        :type file: str or types.File
+        :param destination: Path of the downloaded file, destination.part and destination.ranges are used meanwhile.
+        :param int segment_size: Size of each Range request in bytes.
+        :param int num_threads: Number of segments downloaded at the same time.
+        :param int retries: Number of times a failed segment is requested again.
+        :return: the number of bytes written.
+        :rtype: int
+        """
+        file_id = None
+        if not isinstance(file, types.File):
+            file_id, file = file, self.get_file(file)
+        try:
+            return methods.download_file_ranged(self.__token, self.__proxies, file.file_path, destination,
+                                                file.file_size, segment_size, num_threads, retries,
+                                                file_unique_id=file.file_unique_id)
+        except utils.ApiException as e:
+            if file_id is None or not self.__expire_file_path(e, file.file_path):
+                raise
+        # the cached file_path has expired, completed segments are kept
+        file = self.get_file(file_id)
+        return methods.download_file_ranged(self.__token, self.__proxies, file.file_path, destination,
+                                            file.file_size, segment_size, num_threads, retries,
+                                            file_unique_id=file.file_unique_id)
+
+    def download_media(self, media):
+        """
+        Use this method to download a file you received, served from the download cache if it is enabled.
+        :param media: PhotoSize, Animation, Audio, Document, Video, Voice, VideoNote, Sticker or File,
+            anything with file_id and file_unique_id, or a file_id.
+        :return: the file content.
+        :rtype: bytes
+        """
+        cache = self.__file_cache
+        file_id = media if utils.is_string(media) else media.file_id
+        file_unique_id = getattr(media, 'file_unique_id', None)
+        if cache is not None and file_unique_id is not None:
+            data = cache.get(file_unique_id)
+            if data is not None:
+                return data
+        if isinstance(media, types.File) and media.file_path:
+            file = media
+        else:
+            file = self.get_file(file_id)
+            if cache is not None and file_unique_id is None:
+                # a plain file_id, only getFile tells which file it is
+                data = cache.get(file.file_unique_id)
+                if data is not None:
+                    return data
+        try:
+            data = methods.download_file(self.__token, self.__proxies, file.file_path)
+        except utils.ApiException as e:
+            if file is media or not self.__expire_file_path(e, file.file_path):
+                raise
+            # the cached file_path has expired
+            file = self.get_file(file_id)
+            data = methods.download_file(self.__token, self.__proxies, file.file_path)
+        if cache is not None:
+            cache.put(file_unique_id or file.file_unique_id, data)
+        return data
+
+    def download_many(self, files, num_threads=4, ordered=False):
+        """
+        Use this method to download several files, e.g. the media of an album, up to num_threads at once,
+        getFile requests of some files overlap with the downloads of others.
+        Each file goes through download_media, so the download and get_file caches apply.
+        :param files: file_ids, File objects, or PhotoSize, Document, ... objects, any iterable.
+        :param int num_threads: Maximum number of files fetched at the same time.
+        :param bool ordered: Yield the results in the order of files instead of as they complete.
+        :return: an iterator of DownloadResult(index, file, content, error), one per file,
+            content is None and error the exception if that file failed.
+        :rtype: collections.Iterator[DownloadResult]
+        """
+        def fetch(index, file):
+            try:
+                return DownloadResult(index, file, self.download_media(file), None)
+            except Exception as e:
+                return DownloadResult(index, file, None, e)
+
+        num_threads = max(1, num_threads)
+        files = enumerate(files)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+        # at most two files per thread are submitted ahead, so files can be a long or endless iterator
+        pending = collections.deque(executor.submit(fetch, *item) for item in itertools.islice(files, 2 * num_threads))
+        try:
+            while pending:
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    future = next(concurrent.futures.as_completed(pending))
+                    pending.remove(future)
+                result = future.result()
+                pending.extend(executor.submit(fetch, *item) for item in itertools.islice(files, 1))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def __expire_file_path(self, e, file_path):
+        """
+        Drops the get_file results holding file_path when its download failed with 400 or 404.
+        :return: True if file_path was dropped and get_file will ask Telegram again.
+        """
+        cache = self.__get_file_cache
+        if cache is None or getattr(e.result, 'status_code', None) not in (400, 404):
+            return False
+        cache.invalidate_if(lambda file: file.file_path == file_path)
+        return True
 
     def kick_chat_member(self, chat_id, user_id, until_date=None):
         """
@@ -1168,9 +2457,9 @@ class TBot:
         :rtype: tgbotapi.types.Message
         """
         return types.Message.de_json(
-            methods.send_sticker(self.__token, self.__proxies, chat_id, sticker, disable_notification,
-                                 reply_to_message_id,
-                                 reply_markup))
+            self.__upload('sticker', sticker, lambda sticker: methods.send_sticker(
+                self.__token, self.__proxies, chat_id, sticker, disable_notification, reply_to_message_id,
+                reply_markup)))
 
     def get_sticker_set(self, name):
         """
@@ -1405,19 +2694,358 @@ class TBot:
             ret.append(types.GameHighScore.de_json(r))
         return ret
 
-    def enable_save_reply_handlers(self, delay=120, filename="./.handler-saves/reply.save"):
+    def enable_handler_expiry(self, ttl=None, max_entries=None):
+        """
+        Bound the next step and reply handlers (by default they live until called or cleared): handlers registered
+        without their own ttl= expire ttl seconds later, and past max_entries chats (next step) or messages (reply)
+        the least recently registered are dropped. The on_expire= callback of a dropped handler is called with
+        the chat_id (next step) or message_id (reply) and the handler's args, e.g. to tell the user that the
+        session timed out. Expired handlers are swept on every poll and registration.
+
+        :param int or float or None ttl: Default lifetime of a handler in seconds, None for unlimited.
+        :param int or None max_entries: Maximum number of chats and of messages with handlers, None for unlimited.
+        """
+        self.__handler_ttl = ttl
+        self.__next_step_handlers.max_entries = max_entries
+        self.__reply_handlers.max_entries = max_entries
+
+    def enable_handler_store(self, store=None):
+        """
+        Keep next step and reply handlers in a store instead of memory (by default in memory): nothing is loaded
+        at startup, the handlers of a chat or message are read when a message for it arrives, and every change
+        is written at once, so saving them with enable_save_next_step_handlers/enable_save_reply_handlers isn't
+        needed and is disabled. Callbacks and on_expire are stored by name, register them first with
+        @store.callback(). Handlers registered until now are moved to the store.
+
+        :param HandlerStore or None store: The store, a SqliteHandlerStore in ./.handler-saves/handlers.db by default.
+        :return: the store
+        :rtype: HandlerStore
+        """
+        store = SqliteHandlerStore() if store is None else store
+        registries = []
+        for kind, handlers in (('next_step', self.__next_step_handlers), ('reply', self.__reply_handlers)):
+            registry = StoredHandlerRegistry(store, kind, handlers.max_entries)
+            if isinstance(handlers, HandlerRegistry):
+                for key, key_handlers in list(handlers.items()):
+                    store.put(kind, key, key_handlers)
+            registries.append(registry)
+        self.__next_step_handlers, self.__reply_handlers = registries
+        self.__next_step_saver = self.__reply_saver = None
+        self.__handler_store = store
+        return store
+
+    def enable_offset_store(self, store=None, interval=1.0):
+        """
+        Enable update offset checkpointing (by default disabled): the update_id of updates whose handlers all
+        finished is saved, polling resumes after it on startup, and updates are only confirmed to Telegram once
+        handled, so a crash replays the updates being handled instead of losing them (at-least-once).
+        Handlers that raise count as finished.
+
+        :param utils.OffsetStore or None store: Where the update_id is saved, utils.FileOffsetStore by default,
+            or utils.SqliteOffsetStore.
+        :param float interval: Minimum number of seconds between two saves, stop_bot saves the last one.
+        :return: the checkpoint, its committed attribute is the last update_id handled
+        :rtype: utils.OffsetCheckpoint
+        """
+        self.__offsets = utils.OffsetCheckpoint(utils.FileOffsetStore() if store is None else store, interval)
+        self.__last_update_id = max(self.__last_update_id, self.__offsets.committed)
+        return self.__offsets
+
+    def enable_outbox(self, filename="./.state-saves/outbox.log", num_threads=2, fsync=False):
+        """
+        Enable the durable outbox (by default disabled) used by enqueue: calls are logged to filename before
+        enqueue returns, sent by num_threads sender threads and marked done once sent, the calls left in the log
+        by a crash are sent when it is enabled again. See utils.Outbox for the backlog metrics.
+
+        :param str filename: The log file.
+        :param int num_threads: Number of sender threads, the calls to one chat are sent in order by one of them.
+        :param bool fsync: fsync the log after every write, so calls also survive a power loss.
+        :return: the outbox
+        :rtype: utils.Outbox
+        """
+        if self.__outbox is not None:
+            self.__outbox.close()
+        self.__outbox = utils.Outbox(filename, self.__send_logged, num_threads, fsync)
+        return self.__outbox
+
+    def __send_logged(self, method, args):
+        getattr(methods, method)(self.__token, self.__proxies, *args)
+
+    def enqueue(self, method, *args, **kwargs):
+        """
+        Calls method through the outbox, see enable_outbox: the call is logged, then sent in the background,
+        after a restart if the process dies first. Its arguments must be JSON serializable once markups are
+        converted, so file_ids can be sent but not files to upload.
+
+        :param str method: Name of the TBot method, like 'send_message'.
+        :param args: Arguments of method.
+        :param kwargs: Arguments of method.
+        :return: the sequence number of the call in the outbox
+        :rtype: int
+        """
+        if self.__outbox is None:
+            raise ValueError("the outbox is disabled, see enable_outbox")
+        function, api_function = getattr(TBot, method, None), getattr(methods, method, None)
+        if function is None or api_function is None:
+            raise ValueError("{0} isn't an API method".format(method))
+        signature = inspect.signature(function)
+        if list(signature.parameters)[1:] != list(inspect.signature(api_function).parameters)[2:]:
+            # the TBot method does more than passing its arguments to the API
+            raise ValueError("{0} can't be sent through the outbox".format(method))
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        values = [utils.convert_markup(value) for value in arguments.arguments.values()]
+        return self.__outbox.put(method, values[1:])
+
+    def enable_update_dedup(self, size=65536):
+        """
+        Enable update de-duplication (by default disabled): the update_ids of the last size updates are
+        remembered with one bit each, and an update seen again, like a webhook retry, is dropped before it is
+        decoded. Polling with enable_offset_store still replays the updates a crash or stop_bot interrupted,
+        the update_ids it didn't commit are left out of the window enable_warm_start keeps across a restart.
+
+        :param int size: Number of update_ids remembered.
+        :return: the window, see its new, duplicates and resets counters
+        :rtype: utils.UpdateWindow
+        """
+        self.__update_window = utils.UpdateWindow(size)
+        return self.__update_window
+
+    def enable_warm_start(self, filename="./.state-saves/warm.snapshot", max_age=None, background=True):
+        """
+        Enable warm starts (by default disabled): stop_bot writes the get_me result, the update offset and the
+        caches kept in memory to filename, and this call restores them so a restarted bot doesn't start cold.
+        Call it after enabling the caches and before polling: the update offset and update_ids are restored first,
+        the rest is read section by section from a memory map of the file, by default in a background thread.
+        get_me results are cached while warm start is enabled.
+        Restored are the update_ids of enable_update_dedup, the get_file cache, the upload cache and the file_id index when they have no file of their own,
+        and the states of a utils.MemoryStateStorage, except those handlers set or deleted before they were read.
+        The offset isn't restored if enable_offset_store was called.
+
+        :param str filename: The snapshot file.
+        :param dict or None max_age: Seconds after which a section is ignored, by name ('offset', 'updates', 'me',
+            'get_file', 'uploads', 'file_ids', 'states'), None for no limit, merged with the defaults.
+        :param bool background: Restore the caches in a daemon thread instead of before returning.
+        :return: the thread restoring the caches, None if background is False
+        :rtype: threading.Thread or None
+        """
+        self.__warm_start = filename
+        limits = dict(_WARM_START_MAX_AGE)
+        limits.update(max_age or {})
+        states = self.__state_storage if isinstance(self.__state_storage, utils.MemoryStateStorage) else None
+        if states is not None:
+            # handlers may end conversations before the states section is read, they must stay ended
+            states.begin_restore()
+        try:
+            sections = utils.read_snapshot(filename, limits)
+            # the offset and update_ids are written first
+            section = next(sections, None)
+            while section is not None and section[0] in ('offset', 'updates'):
+                self.__restore_section(*section)
+                section = next(sections, None)
+        except BaseException:
+            if states is not None:
+                states.end_restore()
+            raise
+        if section is None:
+            if states is not None:
+                states.end_restore()
+            return None
+
+        def restore():
+            try:
+                self.__restore_section(*section)
+                for name, age, data in sections:
+                    self.__restore_section(name, age, data)
+            finally:
+                if states is not None:
+                    states.end_restore()
+
+        if not background:
+            restore()
+            return None
+        thread = threading.Thread(target=restore, name="WarmStart", daemon=True)
+        thread.start()
+        return thread
+
+    def __restore_section(self, name, age, data):
+        if name == 'offset':
+            if self.__offsets is None:
+                self.__last_update_id = max(self.__last_update_id, data)
+        elif name == 'updates':
+            if self.__update_window is not None:
+                # the updates the offset store didn't commit are fetched again and must not be taken as duplicates
+                handled = self.__offsets.committed if self.__offsets is not None else None
+                self.__update_window.restore(data, handled)
+        elif name == 'me':
+            self.__me = self.__me or data
+        elif name == 'get_file':
+            if self.__get_file_cache is not None:
+                self.__get_file_cache.restore(data, age)
+        elif name == 'uploads':
+            if self.__upload_cache is not None and self.__upload_cache.filename is None:
+                self.__upload_cache.restore(data)
+        elif name == 'file_ids':
+            if self.__file_id_index is not None and self.__file_id_index.filename is None:
+                self.__file_id_index.restore(data)
+        elif name == 'states':
+            if isinstance(self.__state_storage, utils.MemoryStateStorage):
+                self.__state_storage.restore(data)
+
+    def __snapshot_sections(self):
+        offset = self.__offsets.committed if self.__offsets is not None else self.__last_update_id
+        yield 'offset', offset
+        if self.__update_window is not None:
+            yield 'updates', self.__update_window.snapshot(offset if self.__offsets is not None else None)
+        if self.__me is not None:
+            yield 'me', self.__me
+        if self.__get_file_cache is not None:
+            yield 'get_file', self.__get_file_cache.snapshot()
+        if self.__upload_cache is not None and self.__upload_cache.filename is None:
+            yield 'uploads', self.__upload_cache.snapshot()
+        if self.__file_id_index is not None and self.__file_id_index.filename is None:
+            yield 'file_ids', self.__file_id_index.snapshot()
+        if isinstance(self.__state_storage, utils.MemoryStateStorage):
+            yield 'states', self.__state_storage.snapshot()
+
+    def save_warm_start(self):
+        """
+        Writes the warm start snapshot now, stop_bot does it too, see enable_warm_start
+        :return: size of the snapshot in bytes
+        :rtype: int
+        """
+        if self.__warm_start is None:
+            raise ValueError("warm start is disabled, see enable_warm_start")
+        return utils.write_snapshot(self.__warm_start, self.__snapshot_sections())
+
+    def enable_states(self, storage=None):
+        """
+        Enable conversation states (by default disabled): every (chat, user) can be put in a named state with a data
+        dict by set_state, and its messages are routed to the state_handler()s of that state with one lookup,
+        instead of chaining register_next_step_handler calls.
+
+        :param utils.StateStorage or None storage: Where states are kept, utils.MemoryStateStorage by default,
+            utils.SqliteStateStorage or utils.FileStateStorage keep them across restarts.
+        :return: the storage
+        :rtype: utils.StateStorage
+        """
+        self.__state_storage = utils.MemoryStateStorage() if storage is None else storage
+        return self.__state_storage
+
+    def __states(self):
+        if self.__state_storage is None:
+            raise ValueError("conversation states are disabled, see enable_states")
+        return self.__state_storage
+
+    def set_state(self, chat_id, user_id, state, data=None):
+        """
+        Puts the user in state, its next messages go to the state_handler()s of state.
+
+        :param int chat_id: The chat of the conversation.
+        :param int user_id: The user, the chat_id again for chats without users like channels.
+        :param str state: The new state.
+        :param dict or None data: Replaces the data of the conversation, None keeps it.
+        """
+        storage = self.__states()
+        if data is None:
+            data = storage.get(chat_id, user_id)[1]
+        storage.set(chat_id, user_id, state, data)
+
+    def get_state(self, chat_id, user_id):
+        """
+        :return: the state of the user, None if it isn't in a conversation
+        :rtype: str or None
+        """
+        return self.__states().get(chat_id, user_id)[0]
+
+    def get_state_data(self, chat_id, user_id):
+        """
+        :return: a copy of the data of the conversation, {} if there's none
+        :rtype: dict
+        """
+        return self.__states().get(chat_id, user_id)[1]
+
+    def update_state_data(self, chat_id, user_id, **data):
+        """
+        Adds data to the data of the conversation, keeping the state
+        """
+        storage = self.__states()
+        state, old = storage.get(chat_id, user_id)
+        if state is None:
+            raise ValueError("{0} of chat {1} isn't in a conversation".format(user_id, chat_id))
+        old.update(data)
+        storage.set(chat_id, user_id, state, old)
+
+    def finish_state(self, chat_id, user_id):
         """
-        Enable saving reply handlers (by default saving disable)
+        Ends the conversation, removing its state and data
+        """
+        self.__states().delete(chat_id, user_id)
+
+    def _notify_state_handlers(self, new_messages):
+        """
+        Passes the messages of users in a state to the first matching handler of the state, those are removed
+        :param list new_messages:
+        """
+        storage = self.__state_storage
+        if storage is None or not self.__state_handlers:
+            return
+        remaining = []
+        for message in new_messages:
+            user_id = message.from_user.id if message.from_user is not None else message.chat.id
+            state = storage.get(message.chat.id, user_id)[0]
+            for handler in self.__state_handlers.get(state, ()):
+                if self._test_message_handler(handler, message):
+                    self._exec_task(handler['function'], message)
+                    break
+            else:
+                remaining.append(message)
+        new_messages[:] = remaining
+
+    def __new_handler(self, callback, ttl, on_expire, args, kwargs):
+        handler = Handler(callback, *args, **kwargs)
+        ttl = self.__handler_ttl if ttl is None else ttl
+        if ttl is not None:
+            handler.expires = time.time() + ttl
+        handler.on_expire = on_expire
+        return handler
+
+    def __drop_handlers(self, dropped, saver):
+        """
+        Runs the on_expire callbacks of the (key, handler) pairs a HandlerRegistry dropped and saves their keys
+        """
+        for key, handler in dropped:
+            if handler.on_expire is not None:
+                self._exec_task(handler.on_expire, key, *handler.args, **handler.kwargs)
+        if saver is not None:
+            for key in set(key for key, handler in dropped):
+                saver.changed(key)
+
+    def enable_save_reply_handlers(self, delay=120, filename="./.handler-saves/reply.save", journal=False,
+                                   every_changes=None, fsync=False):
+        """
+        Enable saving reply handlers (by default saving disable), not available with enable_handler_store
 
         :param delay: Integer: Required, Delay between changes in handlers and saving
         :param filename: Data: Required, Filename of save file
+        :param journal: Boolean: Append every change to filename.journal at once, and only rewrite the whole
+            file once the journal has grown past it, see JournalSaver
+        :param every_changes: Integer: Save as soon as this many changes are waiting, even before delay
+        :param fsync: Boolean: fsync the file and its directory after every save, so it survives a power loss
         """
-        self.__reply_saver = Saver(self.__reply_handlers, filename, delay)
+        if self.__handler_store is not None:
+            raise ValueError("reply handlers are kept by the handler store")
+        if self.__reply_saver is not None:
+            self.__reply_saver.close()
+        saver = JournalSaver if journal else Saver
+        self.__reply_saver = saver(self.__reply_handlers, filename, delay, every_changes=every_changes, fsync=fsync)
 
     def disable_save_reply_handlers(self):
         """
         Disable saving next step handlers (by default saving disable)
         """
+        if self.__reply_saver is not None:
+            self.__reply_saver.close()
         self.__reply_saver = None
 
     def load_reply_handlers(self, filename="./.handler-saves/reply.save", del_file_after_loading=True):
@@ -1443,7 +3071,7 @@ class TBot:
         self.register_for_reply_by_message_id(
             message_id, callback, *args, **kwargs)
 
-    def register_for_reply_by_message_id(self, message_id, callback, *args, **kwargs):
+    def register_for_reply_by_message_id(self, message_id, callback, *args, ttl=None, on_expire=None, **kwargs):
         """
         Registers a callback function to be notified when a reply to `message` arrives.
 
@@ -1452,15 +3080,13 @@ class TBot:
         :param message_id:  The id of the message for which we are awaiting a reply.
         :param callback:    The callback function to be called when a reply arrives. Must accept one `message`
                             parameter, which will contain the replied message.
+        :param ttl:         Seconds after which the handler expires, defaults to the ttl of enable_handler_expiry
+        :param on_expire:   Called with message_id, *args and **kwargs if the handler expires or is evicted
         """
-        if message_id in self.__reply_handlers.keys():
-            self.__reply_handlers[message_id].append(
-                Handler(callback, *args, **kwargs))
-        else:
-            self.__reply_handlers[message_id] = [
-                Handler(callback, *args, **kwargs)]
+        dropped = self.__reply_handlers.add(message_id, self.__new_handler(callback, ttl, on_expire, args, kwargs))
         if self.__reply_saver is not None:
-            self.__reply_saver.start_save_timer()
+            self.__reply_saver.changed(message_id)
+        self.__drop_handlers(dropped, self.__reply_saver)
 
     def clear_reply_handlers(self, message):
         """
@@ -1477,10 +3103,10 @@ class TBot:
 
         :param message_id: The message id for which we want to clear reply handlers
         """
-        self.__reply_handlers[message_id] = []
+        self.__reply_handlers.pop(message_id, None)
 
         if self.__reply_saver is not None:
-            self.__reply_saver.start_save_timer()
+            self.__reply_saver.changed(message_id)
 
     def _notify_reply_handlers(self, new_messages):
         """
@@ -1491,29 +3117,41 @@ class TBot:
         for message in new_messages:
             if message.reply_to_message is not None:
                 reply_mid = message.reply_to_message.message_id
-                if reply_mid in self.__reply_handlers.keys():
-                    handlers = self.__reply_handlers[reply_mid]
+                if reply_mid in self.__reply_handlers:
+                    handlers, expired = self.__reply_handlers.take(reply_mid)
                     for handler in handlers:
                         self._exec_task(
                             handler["callback"], message, *handler["args"], **handler["kwargs"])
-                    self.__reply_handlers.pop(reply_mid)
+                    self.__drop_handlers(expired, None)
                     if self.__reply_saver is not None:
-                        self.__reply_saver.start_save_timer()
+                        self.__reply_saver.changed(reply_mid)
 
-    def enable_save_next_step_handlers(self, delay=120, filename="./.handler-saves/step.save"):
+    def enable_save_next_step_handlers(self, delay=120, filename="./.handler-saves/step.save", journal=False,
+                                       every_changes=None, fsync=False):
         """
-        Enable saving next step handlers (by default saving disable)
+        Enable saving next step handlers (by default saving disable), not available with enable_handler_store
 
         :param delay: Integer: Required, Delay between changes in handlers and saving
         :param filename: Data: Required, Filename of save file
+        :param journal: Boolean: Append every change to filename.journal at once, and only rewrite the whole
+            file once the journal has grown past it, see JournalSaver
+        :param every_changes: Integer: Save as soon as this many changes are waiting, even before delay
+        :param fsync: Boolean: fsync the file and its directory after every save, so it survives a power loss
         """
-        self.__next_step_saver = Saver(
-            self.__next_step_handlers, filename, delay)
+        if self.__handler_store is not None:
+            raise ValueError("next step handlers are kept by the handler store")
+        if self.__next_step_saver is not None:
+            self.__next_step_saver.close()
+        saver = JournalSaver if journal else Saver
+        self.__next_step_saver = saver(self.__next_step_handlers, filename, delay, every_changes=every_changes,
+                                       fsync=fsync)
 
     def disable_save_next_step_handlers(self):
         """
         Disable saving next step handlers (by default saving disable)
         """
+        if self.__next_step_saver is not None:
+            self.__next_step_saver.close()
         self.__next_step_saver = None
 
     def load_next_step_handlers(self, filename="./.handler-saves/step.save", del_file_after_loading=True):
@@ -1540,7 +3178,7 @@ class TBot:
         self.register_next_step_handler_by_chat_id(
             chat_id, callback, *args, **kwargs)
 
-    def register_next_step_handler_by_chat_id(self, chat_id, callback, *args, **kwargs):
+    def register_next_step_handler_by_chat_id(self, chat_id, callback, *args, ttl=None, on_expire=None, **kwargs):
         """
         Registers a callback function to be notified when new message arrives after `message`.
 
@@ -1549,17 +3187,15 @@ class TBot:
         :param chat_id:     The chat for which we want to handle new message.
         :param callback:    The callback function which next new message arrives.
         :param args:        Args to pass in callback func
+        :param ttl:         Seconds after which the handler expires, defaults to the ttl of enable_handler_expiry
+        :param on_expire:   Called with chat_id, *args and **kwargs if the handler expires or is evicted
         :param kwargs:      Args to pass in callback func
         """
-        if chat_id in self.__next_step_handlers.keys():
-            self.__next_step_handlers[chat_id].append(
-                Handler(callback, *args, **kwargs))
-        else:
-            self.__next_step_handlers[chat_id] = [
-                Handler(callback, *args, **kwargs)]
+        dropped = self.__next_step_handlers.add(chat_id, self.__new_handler(callback, ttl, on_expire, args, kwargs))
 
         if self.__next_step_saver is not None:
-            self.__next_step_saver.start_save_timer()
+            self.__next_step_saver.changed(chat_id)
+        self.__drop_handlers(dropped, self.__next_step_saver)
 
     def clear_step_handler(self, message):
         """
@@ -1576,10 +3212,10 @@ class TBot:
 
         :param chat_id: The chat for which we want to clear next step handlers
         """
-        self.__next_step_handlers[chat_id] = []
+        self.__next_step_handlers.pop(chat_id, None)
 
         if self.__next_step_saver is not None:
-            self.__next_step_saver.start_save_timer()
+            self.__next_step_saver.changed(chat_id)
 
     def _notify_next_handlers(self, new_messages):
         """
@@ -1587,24 +3223,23 @@ class TBot:
         :param new_messages:
         :return:
         """
-        i = 0
-        while i < len(new_messages):
-            message = new_messages[i]
+        remaining = []
+        for message in new_messages:
             chat_id = message.chat.id
-            was_poped = False
-            if chat_id in self.__next_step_handlers.keys():
-                handlers = self.__next_step_handlers.pop(chat_id, None)
+            if chat_id in self.__next_step_handlers:
+                handlers, expired = self.__next_step_handlers.take(chat_id)
+                self.__drop_handlers(expired, None)
+                if self.__next_step_saver is not None:
+                    self.__next_step_saver.changed(chat_id)
                 if handlers:
                     for handler in handlers:
                         self._exec_task(
                             handler["callback"], message, *handler["args"], **handler["kwargs"])
-                    # removing message that detects with next_step_handler
-                    new_messages.pop(i)
-                    was_poped = True
-                if self.__next_step_saver is not None:
-                    self.__next_step_saver.start_save_timer()
-            if not was_poped:
-                i += 1
+                    # message that detects with next_step_handler isn't passed to the other handlers
+                    continue
+            remaining.append(message)
+        # in place in one pass, popping every detected message was quadratic
+        new_messages[:] = remaining
 
     @staticmethod
     def _build_handler_dict(handler, **filters):
@@ -1655,6 +3290,36 @@ class TBot:
         """
         self.__message_handlers.append(handler_dict)
 
+    def state_handler(self, state, commands=None, regexp=None, func=None, content_types=None, **kwargs):
+        """
+        Conversation state handler decorator, see enable_states.
+        This decorator can be used to decorate functions that must handle the messages of users in the given state,
+        They are tried before message handlers, a message none of them accepts goes on to the message handlers.
+        :param str state: The state the handler is bound to.
+        :param str commands: Bot Commands like (/start, /help).
+        :param str regexp: Sequence of characters that define a search pattern.
+        :param str func: any python function that return True On success like (lambda).
+        :param str content_types: This commands' supported content types. Must be a list. Defaults to ['text'].
+        :return: filtered Message.
+        """
+
+        if content_types is None:
+            content_types = ["text"]
+
+        def decorator(handler):
+            handler_dict = self._build_handler_dict(handler,
+                                                    commands=commands,
+                                                    regexp=regexp,
+                                                    func=func,
+                                                    content_types=content_types,
+                                                    **kwargs)
+
+            self.__state_handlers.setdefault(state, []).append(handler_dict)
+
+            return handler
+
+        return decorator
+
     def edited_message_handler(self, commands=None, regexp=None, func=None, content_types=None, **kwargs):
         """
         Edited message handler decorator.
@@ -1985,12 +3650,74 @@ class AsyncTBot(TBot):
         TBot.__init__(self, *args, **kwargs)
 
     @async_dec()
-    def enable_save_next_step_handlers(self, delay=120, filename="./.handler-saves/step.save"):
-        return TBot.enable_save_next_step_handlers(self, delay, filename)
+    def enable_handler_expiry(self, *args, **kwargs):
+        return TBot.enable_handler_expiry(self, *args, **kwargs)
+
+    @async_dec()
+    def enable_handler_store(self, *args, **kwargs):
+        return TBot.enable_handler_store(self, *args, **kwargs)
+
+    @async_dec()
+    def enable_offset_store(self, *args, **kwargs):
+        return TBot.enable_offset_store(self, *args, **kwargs)
+
+    @async_dec()
+    def enable_outbox(self, *args, **kwargs):
+        return TBot.enable_outbox(self, *args, **kwargs)
+
+    @async_dec()
+    def enqueue(self, *args, **kwargs):
+        return TBot.enqueue(self, *args, **kwargs)
+
+    @async_dec()
+    def enable_update_dedup(self, *args, **kwargs):
+        return TBot.enable_update_dedup(self, *args, **kwargs)
+
+    @async_dec()
+    def process_new_updates(self, *args, **kwargs):
+        return TBot.process_new_updates(self, *args, **kwargs)
+
+    @async_dec()
+    def enable_warm_start(self, *args, **kwargs):
+        return TBot.enable_warm_start(self, *args, **kwargs)
+
+    @async_dec()
+    def save_warm_start(self):
+        return TBot.save_warm_start(self)
+
+    @async_dec()
+    def enable_states(self, *args, **kwargs):
+        return TBot.enable_states(self, *args, **kwargs)
+
+    @async_dec()
+    def set_state(self, *args, **kwargs):
+        return TBot.set_state(self, *args, **kwargs)
+
+    @async_dec()
+    def get_state(self, *args, **kwargs):
+        return TBot.get_state(self, *args, **kwargs)
+
+    @async_dec()
+    def get_state_data(self, *args, **kwargs):
+        return TBot.get_state_data(self, *args, **kwargs)
+
+    @async_dec()
+    def update_state_data(self, *args, **kwargs):
+        return TBot.update_state_data(self, *args, **kwargs)
+
+    @async_dec()
+    def finish_state(self, *args, **kwargs):
+        return TBot.finish_state(self, *args, **kwargs)
+
+    @async_dec()
+    def enable_save_next_step_handlers(self, delay=120, filename="./.handler-saves/step.save", journal=False,
+                                       every_changes=None, fsync=False):
+        return TBot.enable_save_next_step_handlers(self, delay, filename, journal, every_changes, fsync)
 
     @async_dec()
-    def enable_save_reply_handlers(self, delay=120, filename="./.handler-saves/reply.save"):
-        return TBot.enable_save_reply_handlers(self, delay, filename)
+    def enable_save_reply_handlers(self, delay=120, filename="./.handler-saves/reply.save", journal=False,
+                                   every_changes=None, fsync=False):
+        return TBot.enable_save_reply_handlers(self, delay, filename, journal, every_changes, fsync)
 
     @async_dec()
     def disable_save_next_step_handlers(self):
@@ -2008,6 +3735,38 @@ class AsyncTBot(TBot):
     def load_reply_handlers(self, filename="./.handler-saves/reply.save", del_file_after_loading=True):
         return TBot.load_reply_handlers(self, filename, del_file_after_loading)
 
+    @async_dec()
+    def enable_upload_cache(self, *args, **kwargs):
+        return TBot.enable_upload_cache(self, *args, **kwargs)
+
+    @async_dec()
+    def disable_upload_cache(self):
+        return TBot.disable_upload_cache(self)
+
+    @async_dec()
+    def enable_file_cache(self, *args, **kwargs):
+        return TBot.enable_file_cache(self, *args, **kwargs)
+
+    @async_dec()
+    def disable_file_cache(self):
+        return TBot.disable_file_cache(self)
+
+    @async_dec()
+    def enable_get_file_cache(self, *args, **kwargs):
+        return TBot.enable_get_file_cache(self, *args, **kwargs)
+
+    @async_dec()
+    def disable_get_file_cache(self):
+        return TBot.disable_get_file_cache(self)
+
+    @async_dec()
+    def enable_file_id_index(self, *args, **kwargs):
+        return TBot.enable_file_id_index(self, *args, **kwargs)
+
+    @async_dec()
+    def disable_file_id_index(self):
+        return TBot.disable_file_id_index(self)
+
     @async_dec()
     def get_me(self):
         return TBot.get_me(self)
@@ -2052,6 +3811,10 @@ class AsyncTBot(TBot):
     def send_media_group(self, *args, **kwargs):
         return TBot.send_media_group(self, *args, **kwargs)
 
+    @async_dec()
+    def send_media_groups(self, *args, **kwargs):
+        return TBot.send_media_groups(self, *args, **kwargs)
+
     @async_dec()
     def send_location(self, *args, **kwargs):
         return TBot.send_location(self, *args, **kwargs)
@@ -2093,8 +3856,24 @@ class AsyncTBot(TBot):
         return TBot.get_file(self, *args)
 
     @async_dec()
-    def download_file(self, *args):
-        return TBot.download_file(self, *args)
+    def download_file(self, *args, **kwargs):
+        return TBot.download_file(self, *args, **kwargs)
+
+    @async_dec()
+    def download_file_into(self, *args, **kwargs):
+        return TBot.download_file_into(self, *args, **kwargs)
+
+    @async_dec()
+    def download_file_ranged(self, *args, **kwargs):
+        return TBot.download_file_ranged(self, *args, **kwargs)
+
+    @async_dec()
+    def download_media(self, *args, **kwargs):
+        return TBot.download_media(self, *args, **kwargs)
+
+    @async_dec()
+    def download_many(self, *args, **kwargs):
+        return list(TBot.download_many(self, *args, **kwargs))
 
     @async_dec()
     def kick_chat_member(self, *args, **kwargs):
@@ -1,5 +1,9 @@
 from .utils import *
-import json
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import os
+
+FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
 
 """ Telegram Available methods
     All methods in the Bot API are case-insensitive. We support GET and POST HTTP methods. 
@@ -32,7 +36,7 @@ def get_updates(token, proxies, offset, limit, timeout, allowed_updates):
     if timeout:
         params['timeout'] = timeout
     if allowed_updates:
-        params['allowed_updates'] = json.dumps(allowed_updates)
+        params['allowed_updates'] = json_dumps(allowed_updates)
     return make_request(method, api_url, api_method, files, params, proxies)
 
 
@@ -57,7 +61,7 @@ def set_webhook(token, proxies, url, certificate, max_connections, allowed_updat
     if max_connections:
         params['max_connections'] = max_connections
     if allowed_updates:
-        params['allowed_updates'] = json.dumps(allowed_updates)
+        params['allowed_updates'] = json_dumps(allowed_updates)
     return make_request(method, api_url, api_method, files, params, proxies)
 
 
@@ -484,7 +488,7 @@ def send_media_group(token, proxies, chat_id, media, disable_notification, reply
     files = None
     params = {'chat_id': chat_id}
     if not is_string(media):
-        files = {'media': media}
+        params['media'], files = convert_input_media_array(media)
     else:
         params['media'] = media
     if disable_notification:
@@ -800,8 +804,8 @@ def download_file(token, proxies, file_path):
     :type file_path: str
     :rtype: any
     """
-    api_url = "https://api.telegram.org/file/bot{0}/{1}".format(token, file_path)
-    result = get_req_session().get(api_url, proxies)
+    api_url = FILE_URL.format(token, file_path)
+    result = get_req_session().get(api_url, proxies=proxies)
     if result.status_code != 200:
         msg = 'The server returned HTTP {0} {1}. Response body:\n[{2}]' \
             .format(result.status_code, result.reason, result.text)
@@ -809,6 +813,239 @@ def download_file(token, proxies, file_path):
     return result.content
 
 
+def iter_download_file(token, proxies, file_path, chunk_size=65536):
+    """
+    Use this method to download file with specified file_path chunk by chunk, without buffering it in memory.
+    The request is made when the iteration starts and the connection is released when it ends.
+    :type token: str
+    :type proxies: dict or None
+    :type file_path: str
+    :type chunk_size: int
+    :rtype: collections.Iterator[bytes]
+    """
+    api_url = FILE_URL.format(token, file_path)
+    result = get_req_session().get(api_url, proxies=proxies, stream=True)
+    try:
+        if result.status_code != 200:
+            msg = 'The server returned HTTP {0} {1}. Response body:\n[{2}]' \
+                .format(result.status_code, result.reason, result.text)
+            raise ApiException(msg, 'Download file', result)
+        for chunk in result.iter_content(chunk_size):
+            if chunk:
+                yield chunk
+    finally:
+        result.close()
+
+
+def download_file_to(token, proxies, file_path, destination, chunk_size=65536):
+    """
+    Use this method to stream file with specified file_path into destination, at most chunk_size bytes are held in memory.
+    A path is written to path + '.tmp' first and renamed once the download is complete.
+    :type token: str
+    :type proxies: dict or None
+    :type file_path: str
+    :param destination: path, binary file-like object (anything with write) or callable receiving each chunk
+    :type chunk_size: int
+    :return: number of bytes written
+    :rtype: int
+    """
+    chunks = iter_download_file(token, proxies, file_path, chunk_size)
+    if callable(getattr(destination, 'write', None)):
+        return _write_chunks(chunks, destination.write)
+    if callable(destination):
+        return _write_chunks(chunks, destination)
+    path = os.fspath(destination)
+    try:
+        with open(path + '.tmp', 'wb') as file:
+            size = _write_chunks(chunks, file.write)
+        os.replace(path + '.tmp', path)
+    finally:
+        if os.path.isfile(path + '.tmp'):
+            os.remove(path + '.tmp')
+    return size
+
+
+def download_file_into(token, proxies, file_path, buffer=None, file_size=None, chunk_size=65536):
+    """
+    Use this method to download file with specified file_path straight into one preallocated buffer,
+    The body is read from the response stream with readinto, the file is copied once instead of being
+    joined into a bytes object.
+    :type token: str
+    :type proxies: dict or None
+    :type file_path: str
+    :param buffer: writable bytes-like object (bytearray, memoryview, mmap, ...) receiving the file,
+        by default a bytearray of file_size bytes, grown if the file turns out larger.
+    :param int or None file_size: expected size of the file, File.file_size, the Content-Length is used if None.
+    :param int chunk_size: maximum number of bytes read at once.
+    :return: a view of the part of the buffer holding the file.
+    :rtype: memoryview
+    """
+    api_url = FILE_URL.format(token, file_path)
+    result = get_req_session().get(api_url, proxies=proxies, stream=True)
+    try:
+        if result.status_code != 200:
+            msg = 'The server returned HTTP {0} {1}. Response body:\n[{2}]' \
+                .format(result.status_code, result.reason, result.text)
+            raise ApiException(msg, 'Download file', result)
+        growable = buffer is None
+        if growable:
+            if file_size is None and 'Content-Encoding' not in result.headers:
+                file_size = int(result.headers.get('Content-Length', 0))
+            buffer = bytearray(file_size or 0)
+        if 'Content-Encoding' in result.headers:
+            # compressed body, only iter_content decodes it
+            chunks = result.iter_content(chunk_size)
+            readinto = None
+        else:
+            chunks = iter(lambda: result.raw.read(chunk_size), b'')
+            readinto = result.raw.readinto
+        view = memoryview(buffer).cast('B')
+        size = 0
+        while True:
+            if readinto is not None and size < len(view):
+                count = readinto(view[size:size + chunk_size])
+                if not count:
+                    break
+                size += count
+                continue
+            chunk = next(chunks, b'')
+            if not chunk:
+                break
+            if size + len(chunk) > len(view):
+                if not growable:
+                    raise ValueError('The file is larger than the {0} bytes buffer'.format(len(view)))
+                view.release()
+                del buffer[size:]
+                buffer.extend(chunk)
+                view = memoryview(buffer)
+            else:
+                view[size:size + len(chunk)] = chunk
+            size += len(chunk)
+        return view[:size]
+    finally:
+        result.close()
+
+
+def download_file_ranged(token, proxies, file_path, destination, file_size, segment_size=4194304, num_threads=4,
+                         retries=2, chunk_size=65536, file_unique_id=None):
+    """
+    Use this method to download a large file with specified file_path in parallel HTTP Range segments.
+    Segments are written straight into destination + '.part', preallocated to file_size, and every completed segment
+    is recorded in destination + '.ranges', so calling it again after a failure only fetches the missing segments.
+    A segment is recorded only once all of its bytes are written, a short segment fails like an HTTP error.
+    The checkpoint is kept only for the same file (file_unique_id, or file_path if it isn't given) and file_size,
+    otherwise the whole file is downloaded again.
+    The file is renamed to destination once every segment is written.
+    :type token: str
+    :type proxies: dict or None
+    :type file_path: str
+    :param destination: path of the downloaded file
+    :param int file_size: size of the file in bytes, File.file_size from getFile
+    :param int segment_size: size of each Range request
+    :param int num_threads: number of segments downloaded at the same time
+    :param int retries: number of times a failed segment is requested again before giving up
+    :type chunk_size: int
+    :param str or None file_unique_id: identifies the file in the checkpoint, so it resumes after file_path changed
+    :return: number of bytes of the file
+    :rtype: int
+    """
+    if not file_size or file_size < 0:
+        raise ValueError('file_size must be a positive number, got {0!r}'.format(file_size))
+    if segment_size <= 0:
+        raise ValueError('segment_size must be a positive number, got {0!r}'.format(segment_size))
+    path = os.fspath(destination)
+    part_path = path + '.part'
+    ranges_path = path + '.ranges'
+    api_url = FILE_URL.format(token, file_path)
+    segments = [(start, min(start + segment_size, file_size) - 1) for start in range(0, file_size, segment_size)]
+
+    source = file_unique_id or file_path
+    done = _load_ranges(ranges_path, source, file_size, segment_size)
+    if not done or not os.path.isfile(part_path):
+        done = set()
+        with open(part_path, 'wb') as file:
+            file.truncate(file_size)
+    lock = threading.Lock()
+
+    def fetch(segment):
+        start, end = segment
+        for attempt in range(retries + 1):
+            try:
+                _download_range(api_url, proxies, part_path, start, end, file_size, chunk_size)
+                break
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                logger.warning("Range {0}-{1} of {2} failed, retrying: {3}".format(start, end, file_path, e))
+        with lock:
+            done.add(start)
+            _save_ranges(ranges_path, source, file_size, segment_size, done)
+
+    pending = [segment for segment in segments if segment[0] not in done]
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, min(num_threads, len(pending)))) as executor:
+            futures = [executor.submit(fetch, segment) for segment in pending]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise errors[0]
+
+    os.replace(part_path, path)
+    os.remove(ranges_path)
+    return file_size
+
+
+def _download_range(api_url, proxies, part_path, start, end, file_size, chunk_size):
+    headers = {'Range': 'bytes={0}-{1}'.format(start, end)}
+    result = get_req_session().get(api_url, proxies=proxies, headers=headers, stream=True)
+    try:
+        if result.status_code != 206:
+            msg = 'The server returned HTTP {0} {1} for Range {2}. Response body:\n[{3}]' \
+                .format(result.status_code, result.reason, headers['Range'], result.text)
+            raise ApiException(msg, 'Download file', result)
+        content_range = result.headers.get('Content-Range', '')
+        if content_range.rpartition('/')[2] != str(file_size):
+            # another file than the one the other segments come from
+            raise ApiException('Range {0} returned Content-Range {1!r} for a file of {2} bytes'
+                               .format(headers['Range'], content_range, file_size), 'Download file', result)
+        expected = end - start + 1
+        with open(part_path, 'r+b') as file:
+            file.seek(start)
+            # the part file is preallocated, so only the bytes written tell whether the segment is complete
+            size = _write_chunks(result.iter_content(chunk_size), file.write)
+        if size != expected:
+            raise ApiException('Range {0} returned {1} of {2} bytes'.format(headers['Range'], size, expected),
+                               'Download file', result)
+    finally:
+        result.close()
+
+
+def _load_ranges(ranges_path, source, file_size, segment_size):
+    try:
+        with open(ranges_path, 'rb') as file:
+            state = json_loads(file.read())
+    except (OSError, ValueError):
+        return set()
+    if state.get('source') != source or state.get('file_size') != file_size \
+            or state.get('segment_size') != segment_size:
+        return set()
+    return set(state.get('done', ()))
+
+
+def _save_ranges(ranges_path, source, file_size, segment_size, done):
+    with open(ranges_path + '.tmp', 'w') as file:
+        file.write(json_dumps({'source': source, 'file_size': file_size, 'segment_size': segment_size,
+                               'done': sorted(done)}))
+    os.replace(ranges_path + '.tmp', ranges_path)
+
+
+def _write_chunks(chunks, write):
+    size = 0
+    for chunk in chunks:
+        write(chunk)
+        size += len(chunk)
+    return size
+
+
 def kick_chat_member(token, proxies, chat_id, user_id, until_date):
     """
     Use this method to kick a user from a group, a supergroup or a channel.
@@ -1330,7 +1567,8 @@ def edit_message_media(token, proxies, media, chat_id, message_id, inline_messag
     files = None
     params = {}
     if not is_string(media):
-        files = {'media': media}
+        media, files = convert_input_media(media)
+        params['media'] = json_dumps(media)
     else:
         params = {'media': media}
     if chat_id:
@@ -1498,7 +1736,7 @@ def create_new_sticker_set(token, proxies, user_id, name, title, png_sticker, tg
     else:
         params['png_sticker'] = png_sticker
     if not is_string(tgs_sticker):
-        files = {'tgs_sticker', tgs_sticker}
+        files = {'tgs_sticker': tgs_sticker}
     if contains_masks:
         params['contains_masks'] = contains_masks
     if mask_position:
@@ -1595,7 +1833,7 @@ def answer_inline_query(token, proxies, inline_query_id, results, cache_time, is
     :type token: str
     :type proxies: dict or None
     :type inline_query_id: str
-    :type results: list[dict]
+    :type results: list[InlineQueryResult] or str
     :type cache_time: int or None
     :type is_personal: bool
     :type next_offset: str or None
@@ -1607,6 +1845,9 @@ def answer_inline_query(token, proxies, inline_query_id, results, cache_time, is
     api_method = r'answerInlineQuery'
     api_url = 'https://api.telegram.org/bot{0}/{1}'.format(token, api_method)
     files = None
+    if not isinstance(results, str):
+        # the Bot API accepts no more than 50 results per query
+        results = convert_list_json_serializable(results, max_items=50)
     params = {'inline_query_id': inline_query_id, 'results': results}
     if cache_time is not None:
         params['cache_time'] = cache_time
@@ -1,5 +1,5 @@
 from .utils import *
-import json
+import threading
 
 """ Telegram Available types
     All types used in the Bot API responses are represented as JSON-objects.
@@ -85,6 +85,37 @@ class Update(JsonDeserializable):
         return cls(update_id, message, edited_message, channel_post, edited_channel_post, inline_query,
                    chosen_inline_result, callback_query, shipping_query, pre_checkout_query, poll, poll_answer)
 
+    def to_bytes(self):
+        """
+        Serializes this update and all of its nested objects to the compact binary format,
+        Useful to hand updates over to worker processes without JSON or pickle.
+        :return: bytes
+        """
+        return to_binary(self)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :param bytes or bytearray or memoryview data: a payload produced by Update.to_bytes
+        :return: Update
+        """
+        obj = from_binary(data, _resolve_type)
+        if not isinstance(obj, cls):
+            raise BinaryFormatError("Payload does not contain an Update.")
+        return obj
+
+
+def _resolve_type(name):
+    """
+    Maps a class name stored in a binary payload to a Telegram type of this module.
+    :param str name:
+    :return: the class, None if name is not a Telegram type
+    """
+    cls = globals().get(name)
+    if isinstance(cls, type) and issubclass(cls, (JsonDeserializable, JsonSerializable)):
+        return cls
+    return None
+
 
 class WebhookInfo(JsonDeserializable):
     """ Contains information about the current status of a webhook """
@@ -399,7 +430,7 @@ class Message(JsonDeserializable):
         if 'caption' in obj:
             opts['caption'] = obj['caption']
         if 'contact' in obj:
-            opts['contact'] = Contact.de_json(json.dumps(obj['contact']))
+            opts['contact'] = Contact.de_json(obj['contact'])
             content_type = 'contact'
         if 'location' in obj:
             opts['location'] = Location.de_json(obj['location'])
@@ -952,7 +983,95 @@ class File(JsonDeserializable):
         return cls(file_id, file_unique_id, file_size, file_path)
 
 
-class ReplyKeyboardMarkup(JsonSerializable):
+class FreezableMarkup(object):
+    """
+    Reply markups that can be frozen: validated and serialized once into an immutable FrozenMarkup.
+    """
+
+    def freeze(self, name=None):
+        """
+        Validates the layout and returns an immutable FrozenMarkup holding the JSON of this markup,
+        Later changes to this object don't affect the frozen copy.
+        :param str or None name: Registers the frozen markup under this name (see get_frozen_markup),
+            If the same layout is already registered with this name, the registered markup is returned.
+        :raises ValueError: when the layout is invalid or another layout is registered with this name.
+        :return: FrozenMarkup
+        """
+        obj = self.to_dict()
+        _validate_markup(obj)
+        json_string = json_dumps(obj)
+        frozen = FrozenMarkup(json_string, name)
+        if name is not None:
+            with _frozen_markups_lock:
+                frozen = _frozen_markups.setdefault(name, frozen)
+            if frozen.json_string != json_string:
+                raise ValueError("Another markup is already frozen with the name {0!r}.".format(name))
+        return frozen
+
+
+class FrozenMarkup(Dictionaryable, JsonSerializable):
+    """
+    An immutable reply markup made by freeze(), its JSON is computed once and reused on every send.
+    """
+
+    def __init__(self, json_string, name=None):
+        object.__setattr__(self, 'json_string', json_string)
+        object.__setattr__(self, 'name', name)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("FrozenMarkup is immutable.")
+
+    def __delattr__(self, key):
+        raise AttributeError("FrozenMarkup is immutable.")
+
+    def to_json(self):
+        return self.json_string
+
+    def to_dict(self):
+        return json_loads(self.json_string)
+
+
+# key: name, value: FrozenMarkup
+_frozen_markups = {}
+_frozen_markups_lock = threading.Lock()
+
+
+def get_frozen_markup(name):
+    """
+    :param str name: Name given to freeze().
+    :return: the FrozenMarkup registered under name, None if there is none.
+    :rtype: FrozenMarkup or None
+    """
+    return _frozen_markups.get(name)
+
+
+def _validate_markup(obj):
+    """
+    Checks the layout of a keyboard dict as documented in the Bot API
+    :param dict obj: to_dict() of a markup
+    :raises ValueError: when the layout is invalid.
+    """
+    inline = 'inline_keyboard' in obj
+    rows = obj['inline_keyboard'] if inline else obj.get('keyboard')
+    if rows is None:
+        return
+    if not rows:
+        raise ValueError("Keyboard has no buttons.")
+    for row in rows:
+        if not isinstance(row, list) or not row:
+            raise ValueError("Keyboard rows must be non-empty lists of buttons.")
+        for button in row:
+            if not isinstance(button, dict) or not is_string(button.get('text')) or not button['text']:
+                raise ValueError("Button {0} has no text.".format(button))
+            if inline:
+                if len(button) != 2:
+                    raise ValueError("Inline button {0} must use exactly one of the optional fields.".format(
+                        button['text']))
+                if len(str(button.get('callback_data', '')).encode('utf-8')) > 64:
+                    raise ValueError("callback_data of button {0} is longer than 64 bytes.".format(button['text']))
+
+
+class ReplyKeyboardMarkup(FreezableMarkup, JsonSerializable):
     """
         This object represents a custom keyboard with reply options (see Introduction to bots for details and examples)
     """
@@ -1022,7 +1141,7 @@ class ReplyKeyboardMarkup(JsonSerializable):
         return obj
 
     def to_json(self):
-        return json.dumps(self.to_dict())
+        return json_dumps(self.to_dict())
 
 
 class KeyboardButton(Dictionaryable, JsonSerializable):
@@ -1050,7 +1169,7 @@ class KeyboardButton(Dictionaryable, JsonSerializable):
         return obj
 
     def to_json(self):
-        return json.dumps(self.to_dict())
+        return json_dumps(self.to_dict())
 
 
 class KeyboardButtonPollType(JsonDeserializable):
@@ -1069,7 +1188,7 @@ class KeyboardButtonPollType(JsonDeserializable):
         return cls(type)
 
 
-class ReplyKeyboardRemove(JsonSerializable):
+class ReplyKeyboardRemove(FreezableMarkup, JsonSerializable):
     """ 
     Upon receiving a message with this object, 
     Telegram clients will remove the current custom keyboard and display the default letter-keyboard,
@@ -1080,14 +1199,17 @@ class ReplyKeyboardRemove(JsonSerializable):
     def __init__(self, selective=None):
         self.selective = selective
 
-    def to_json(self):
+    def to_dict(self):
         obj = {'remove_keyboard': True}
         if self.selective:
             obj['selective'] = True
-        return json.dumps(obj)
+        return obj
+
+    def to_json(self):
+        return json_dumps(self.to_dict())
 
 
-class InlineKeyboardMarkup(Dictionaryable, JsonSerializable):
+class InlineKeyboardMarkup(FreezableMarkup, Dictionaryable, JsonSerializable):
     """ This object represents an inline keyboard that appears right next to the message it belongs to. """
 
     def __init__(self, row_width=3):
@@ -1136,7 +1258,7 @@ class InlineKeyboardMarkup(Dictionaryable, JsonSerializable):
         :return:
         """
         obj = {'inline_keyboard': self.keyboard}
-        return json.dumps(obj)
+        return json_dumps(obj)
 
     def to_dict(self):
         obj = {'inline_keyboard': self.keyboard}
@@ -1179,7 +1301,7 @@ class InlineKeyboardButton(JsonSerializable):
         return obj
 
     def to_json(self):
-        return json.dumps(self.to_dict())
+        return json_dumps(self.to_dict())
 
 
 class LoginUrl(JsonSerializable):
@@ -1205,7 +1327,7 @@ class LoginUrl(JsonSerializable):
         return obj
 
     def to_json(self):
-        return json.dumps(self.to_dict())
+        return json_dumps(self.to_dict())
 
 
 class CallbackQuery(JsonDeserializable):
@@ -1243,7 +1365,7 @@ class CallbackQuery(JsonDeserializable):
         return cls(id, from_user, data, chat_instance, message, inline_message_id, game_short_name)
 
 
-class ForceReply(JsonSerializable):
+class ForceReply(FreezableMarkup, JsonSerializable):
     """
     Upon receiving a message with this object, 
     Telegram clients will display a reply interface to the user,
@@ -1255,11 +1377,14 @@ class ForceReply(JsonSerializable):
     def __init__(self, selective=None):
         self.selective = selective
 
-    def to_json(self):
+    def to_dict(self):
         obj = {'force_reply': True}
         if self.selective:
             obj['selective'] = True
-        return json.dumps(obj)
+        return obj
+
+    def to_json(self):
+        return json_dumps(self.to_dict())
 
 
 class ChatPhoto(JsonDeserializable):
@@ -1486,7 +1611,7 @@ class InputMedia:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InputMediaVideo(JsonSerializable):
         def __init__(self, type, media, thumb=None, caption=None, parse_mode=None, width=None, height=None,
@@ -1519,7 +1644,7 @@ class InputMedia:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InputMediaAnimation(JsonSerializable):
         def __init__(self, type, media, thumb=None, caption=None, parse_mode=None, width=None, height=None,
@@ -1550,7 +1675,7 @@ class InputMedia:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InputMediaAudio(JsonSerializable):
         def __init__(self, type, media, thumb=None, caption=None, parse_mode=None, width=None, height=None,
@@ -1587,7 +1712,7 @@ class InputMedia:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InputMediaDocument(JsonSerializable):
         def __init__(self, type, media, thumb=None, caption=None, parse_mode=None):
@@ -1608,7 +1733,7 @@ class InputMedia:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
 
 # InputFile
@@ -1707,7 +1832,7 @@ class MaskPosition(JsonDeserializable, JsonSerializable):
         return cls(point, x_shift, y_shift, scale)
 
     def to_json(self):
-        return json.dumps(self.to_dict())
+        return json_dumps(self.to_dict())
 
     def to_dict(self):
         return {'point': self.point, 'x_shift': self.x_shift, 'y_shift': self.y_shift, 'scale': self.scale}
@@ -1802,7 +1927,7 @@ class InlineQueryResult:
             self.thumb_width = thumb_width
             self.thumb_height = thumb_height
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id, 'title': self.title,
                    'input_message_content': self.input_message_content}
             if self.reply_markup:
@@ -1819,7 +1944,10 @@ class InlineQueryResult:
                 obj['thumb_width'] = self.thumb_width
             if self.thumb_height:
                 obj['thumb_height'] = self.thumb_height
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultAudio(JsonSerializable):
         """ Represents a link to an MP3 audio file.
@@ -1840,7 +1968,7 @@ class InlineQueryResult:
             self.reply_markup = reply_markup
             self.input_message_content = input_message_content
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id,
                    'audio_url': self.audio_url, 'title': self.title}
             if self.caption:
@@ -1855,7 +1983,10 @@ class InlineQueryResult:
                 obj['reply_markup'] = self.reply_markup.to_dict()
             if self.input_message_content:
                 obj['input_message_content'] = self.input_message_content.to_dict()
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultCachedAudio(JsonSerializable):
         """ Represents a link to an MP3 audio file stored on the Telegram servers.
@@ -1893,7 +2024,7 @@ class InlineQueryResult:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultCachedDocument(JsonSerializable):
         """ Represents a link to a file stored on the Telegram servers.
@@ -1931,7 +2062,7 @@ class InlineQueryResult:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultCachedGif(JsonSerializable):
         """ Represents a link to an animated GIF file stored on the Telegram servers.
@@ -1966,7 +2097,7 @@ class InlineQueryResult:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultCachedMpeg4Gif(JsonSerializable):
         """ Represents a link to a video animation (H.264/MPEG-4 AVC video without sound) stored on the Telegram servers.
@@ -2001,7 +2132,7 @@ class InlineQueryResult:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultCachedPhoto(JsonSerializable):
         """ Represents a link to a photo. By default, this photo will be sent by the user with optional caption.
@@ -2041,7 +2172,7 @@ class InlineQueryResult:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultCachedSticker(JsonSerializable):
         """ Represents a link to a sticker stored on the Telegram servers.
@@ -2066,7 +2197,7 @@ class InlineQueryResult:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultCachedVideo(JsonSerializable):
         """ Represents a link to a video file stored on the Telegram servers.
@@ -2104,7 +2235,7 @@ class InlineQueryResult:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultCachedVoice(JsonSerializable):
         """ Represents a link to a voice message stored on the Telegram servers.
@@ -2142,7 +2273,7 @@ class InlineQueryResult:
             return obj
 
         def to_json(self):
-            return json.dumps(self.to_dict())
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultContact(JsonSerializable):
         """ Represents a contact with a phone number.
@@ -2163,7 +2294,7 @@ class InlineQueryResult:
             self.thumb_width = thumb_width
             self.thumb_height = thumb_height
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id,
                    'phone_number': self.phone_number, 'first_name': self.first_name}
             if self.last_name:
@@ -2178,7 +2309,10 @@ class InlineQueryResult:
                 obj['reply_markup'] = self.reply_markup
             if self.input_message_content:
                 obj['input_message_content'] = self.input_message_content
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultGame(JsonSerializable):
         """ Represents a Game """
@@ -2189,12 +2323,15 @@ class InlineQueryResult:
             self.game_short_name = game_short_name
             self.reply_markup = reply_markup
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id,
                    'game_short_name': self.game_short_name}
             if self.reply_markup:
                 obj['reply_markup'] = self.reply_markup.to_dict()
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultDocument(JsonSerializable):
         """ Represents a link to a file.
@@ -2220,7 +2357,7 @@ class InlineQueryResult:
             self.thumb_width = thumb_width
             self.thumb_height = thumb_height
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id, 'title': self.title, 'document_url': self.document_url,
                    'mime_type': self.mime_type}
             if self.caption:
@@ -2239,7 +2376,10 @@ class InlineQueryResult:
                 obj['reply_markup'] = self.reply_markup.to_dict()
             if self.input_message_content:
                 obj['input_message_content'] = self.input_message_content.to_dict()
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultGif(JsonSerializable):
         """ Represents a link to an animated GIF file.
@@ -2262,7 +2402,7 @@ class InlineQueryResult:
             self.reply_markup = reply_markup
             self.input_message_content = input_message_content
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id,
                    'gif_url': self.gif_url, 'thumb_url': self.thumb_url}
             if self.gif_height:
@@ -2283,7 +2423,10 @@ class InlineQueryResult:
                 obj['reply_markup'] = self.reply_markup.to_dict()
             if self.input_message_content:
                 obj['input_message_content'] = self.input_message_content.to_dict()
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultLocation(JsonSerializable):
         """ Represents a location on a map.
@@ -2305,7 +2448,7 @@ class InlineQueryResult:
             self.thumb_width = thumb_width
             self.thumb_height = thumb_height
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id, 'title': self.title,
                    'latitude': self.latitude, 'longitude': self.longitude}
             if self.live_period:
@@ -2320,7 +2463,10 @@ class InlineQueryResult:
                 obj['reply_markup'] = self.reply_markup.to_dict()
             if self.input_message_content:
                 obj['input_message_content'] = self.input_message_content.to_dict()
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultMpeg4Gif(JsonSerializable):
         """ Represents a link to a video animation (H.264/MPEG-4 AVC video without sound).
@@ -2345,7 +2491,7 @@ class InlineQueryResult:
             self.reply_markup = reply_markup
             self.input_message_content = input_message_content
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id,
                    'mpeg4_url': self.mpeg4_url, 'thumb_url': self.thumb_url}
             if self.mpeg4_width:
@@ -2364,7 +2510,10 @@ class InlineQueryResult:
                 obj['input_message_content'] = self.input_message_content.to_dict()
             if self.mpeg4_duration:
                 obj['mpeg4_duration '] = self.mpeg4_duration
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultPhoto(JsonSerializable):
         """ Represents a link to a photo.
@@ -2387,7 +2536,7 @@ class InlineQueryResult:
             self.reply_markup = reply_markup
             self.input_message_content = input_message_content
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id,
                    'photo_url': self.photo_url, 'thumb_url': self.thumb_url}
             if self.photo_width:
@@ -2406,7 +2555,10 @@ class InlineQueryResult:
                 obj['reply_markup'] = self.reply_markup.to_dict()
             if self.input_message_content:
                 obj['input_message_content'] = self.input_message_content.to_dict()
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultVenue(JsonSerializable):
         """ Represents a venue.
@@ -2429,7 +2581,7 @@ class InlineQueryResult:
             self.thumb_width = thumb_width
             self.thumb_height = thumb_height
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id, 'title': self.title, 'latitude': self.latitude,
                    'longitude': self.longitude, 'address': self.address}
             if self.foursquare_id:
@@ -2444,7 +2596,10 @@ class InlineQueryResult:
                 obj['reply_markup'] = self.reply_markup.to_dict()
             if self.input_message_content:
                 obj['input_message_content'] = self.input_message_content.to_dict()
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultVideo(JsonSerializable):
         """ Represents a link to a page containing an embedded video player or a video file.
@@ -2473,7 +2628,7 @@ class InlineQueryResult:
             self.input_message_content = input_message_content
             self.reply_markup = reply_markup
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id, 'video_url': self.video_url, 'mime_type': self.mime_type,
                    'thumb_url': self.thumb_url, 'title': self.title}
             if self.video_width:
@@ -2492,7 +2647,10 @@ class InlineQueryResult:
                 obj['reply_markup'] = self.reply_markup.to_dict()
             if self.input_message_content:
                 obj['input_message_content'] = self.input_message_content.to_dict()
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
     class __InlineQueryResultVoice(JsonSerializable):
         """ Represents a link to a voice recording in an .ogg container encoded with OPUS.
@@ -2513,7 +2671,7 @@ class InlineQueryResult:
             self.reply_markup = reply_markup
             self.input_message_content = input_message_content
 
-        def to_json(self):
+        def to_dict(self):
             obj = {'type': self.type, 'id': self.id,
                    'voice_url': self.voice_url, 'title': self.title}
             if self.caption:
@@ -2528,7 +2686,10 @@ class InlineQueryResult:
                 obj['reply_markup'] = self.reply_markup.to_dict()
             if self.input_message_content:
                 obj['input_message_content'] = self.input_message_content.to_dict()
-            return json.dumps(obj)
+            return obj
+
+        def to_json(self):
+            return json_dumps(self.to_dict())
 
 
 class InputMessageContent:
@@ -2648,7 +2809,7 @@ class LabeledPrice(JsonSerializable):
         self.amount = amount
 
     def to_json(self):
-        return json.dumps(self.to_dict())
+        return json_dumps(self.to_dict())
 
     def to_dict(self):
         return {'label': self.label, 'amount': self.amount}
@@ -2746,7 +2907,7 @@ class ShippingOption(JsonSerializable):
         price_list = []
         for p in self.prices:
             price_list.append(p.to_dict())
-        obj = json.dumps(
+        obj = json_dumps(
             {'id': self.id, 'title': self.title, 'prices': price_list})
         return obj
 
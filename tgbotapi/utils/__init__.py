@@ -1,6 +1,13 @@
 from .extra import *
 from .logger import *
+from .tgbinary import *
+from .tgcache import *
 from .tgjson import *
+from .tgmultipart import *
+from .tgoffset import *
+from .tgoutbox import *
+from .tgsnapshot import *
+from .tgstate import *
 from .worker import *
 
 """
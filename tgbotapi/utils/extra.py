@@ -3,7 +3,7 @@ import random
 import string
 
 from six import string_types
-from .tgjson import JsonSerializable
+from .tgjson import JsonSerializable, Dictionaryable, json_dumps, json_loads
 
 
 class ApiException(Exception):
@@ -89,33 +89,71 @@ def split_string(text, chars_per_string):
     return [text[i:i + chars_per_string] for i in range(0, len(text), chars_per_string)]
 
 
-def convert_list_json_serializable(results):
-    ret = ''
+def convert_list_json_serializable(results, max_items=None, max_bytes=None):
+    """
+    Encodes results (e.g. InlineQueryResult objects) to one JSON array in a single pass,
+    Nested objects like reply markups and input message contents are written in the same pass.
+    :param list results: JsonSerializable, Dictionaryable or dict items, other items are skipped.
+    :param int or None max_items: raise ValueError if there are more items than this.
+    :param int or None max_bytes: raise ValueError if the UTF-8 encoded array is larger than this.
+    :return: a JSON array string.
+    :rtype: str
+    """
+    items = []
     for r in results:
-        if isinstance(r, JsonSerializable):
-            ret = ret + r.to_json() + ','
-    if len(ret) > 0:
-        ret = ret[:-1]
-    return '[' + ret + ']'
-
-
-# def convert_input_media(media):
-#     if isinstance(media, InputMedia):
-#         return media.convert_input_media()
-#     return None, None
-
-
-# def convert_input_media_array(array):
-#     media = []
-#     files = {}
-#     for input_media in array:
-#         if isinstance(input_media, InputMedia):
-#             media_dict = input_media.to_dict()
-#             if media_dict['media'].startswith('attach://'):
-#                 key = media_dict['media'].replace('attach://', '')
-#                 files[key] = input_media.media
-#             media.append(media_dict)
-#     return json.dumps(media), files
+        if isinstance(r, (JsonSerializable, Dictionaryable)):
+            items.append(r.to_dict() if hasattr(r, 'to_dict') else json_loads(r.to_json()))
+        elif isinstance(r, dict):
+            items.append(r)
+    if max_items is not None and len(items) > max_items:
+        raise ValueError("{0} items exceed the limit of {1}.".format(len(items), max_items))
+    ret = json_dumps(items)
+    if max_bytes is not None:
+        size = len(ret.encode('utf-8'))
+        if size > max_bytes:
+            raise ValueError("{0} bytes exceed the limit of {1}.".format(size, max_bytes))
+    return ret
+
+
+def convert_input_media(media, files=None, name='file0'):
+    """
+    Converts one InputMedia (or a dict of its fields) to a dict for the Bot API,
+    A media or thumb that is not a string (file object, bytes, ...) is moved to files and referenced as attach://name.
+    A received PhotoSize, Document, ... given as media or thumb is sent by its file_id.
+    :param media: an InputMedia.Photo, .Video, ... object or a dict.
+    :param dict or None files: where the attachments are put, a new dict if None.
+    :param str name: attachment name, thumbnails are attached as name + '_thumb'.
+    :return: (dict, files)
+    :rtype: tuple
+    """
+    if files is None:
+        files = {}
+    obj = dict(media) if isinstance(media, dict) else media.to_dict()
+    for field, key in (('media', name), ('thumb', name + '_thumb')):
+        value = obj.get(field)
+        if value is None or is_string(value):
+            continue
+        if hasattr(value, 'file_id') and hasattr(value, 'file_unique_id'):
+            obj[field] = value.file_id
+        else:
+            files[key] = value
+            obj[field] = 'attach://' + key
+    return obj, files
+
+
+def convert_input_media_array(array):
+    """
+    Converts a list of InputMedia to the JSON array and the attachments of one multipart request, see
+    convert_input_media.
+    :param list array:
+    :return: (JSON array string, files dict)
+    :rtype: tuple
+    """
+    media = []
+    files = {}
+    for i, input_media in enumerate(array):
+        media.append(convert_input_media(input_media, files, 'file{0}'.format(i))[0])
+    return json_dumps(media), files
 
 
 def no_encode(func):
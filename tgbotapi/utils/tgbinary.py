@@ -0,0 +1,400 @@
+import struct
+from itertools import accumulate
+
+""" Compact binary serialization for Telegram types
+
+    A payload is b'TGB' + version byte, the string table and one tagged value (little-endian throughout).
+
+    The string table holds every string of the payload once (the end offset of each string followed
+    by all of them as one utf-8 blob), values refer to it by index.
+    Objects are written by shape: a shape is the class, the attribute names and the kind of every
+    attribute value (None, bool, int64, float, string or nested value). The first object of
+    a shape writes its definition, every object then writes all of its scalars and string indexes
+    as one struct-packed block followed by its nested values, so decoding an object is a single
+    unpack_from no matter how many fields it has.
+    Objects are rebuilt without calling __init__ and only classes returned by the resolver
+    can be created, so unlike pickle a payload can't instantiate arbitrary classes.
+"""
+
+BINARY_MAGIC = b'TGB'
+BINARY_VERSION = 1
+
+_NONE = 0
+_TRUE = 1
+_FALSE = 2
+_INT = 3
+_BIGINT = 4
+_FLOAT = 5
+_STR = 6
+_LIST = 7
+_DICT = 8
+_OBJECT = 9
+_SHAPE_NEW = 10
+_SHAPE_STATIC = 11
+_BYTES = 12
+
+_HEADER = struct.Struct('<3sBII')
+_H = struct.Struct('<H')
+_I = struct.Struct('<I')
+_q = struct.Struct('<q')
+_d = struct.Struct('<d')
+_TAG_I = struct.Struct('<BI')
+_TAG_IH = struct.Struct('<BIH')
+_TAG_BH = struct.Struct('<BBH')
+_TAG_q = struct.Struct('<Bq')
+_TAG_d = struct.Struct('<Bd')
+
+# Attribute kinds, kinds listed in _PACKED are stored in the struct block in field order,
+# followed by one uint32 string index per 's' field, 'v' fields are tagged values after the block.
+_KINDS = 'n?qdsv'
+_PACKED = '?qd'
+
+# Names of the incoming update types and their fields, preloaded into every string table so they
+# cost a 1 byte reference instead of being spelled out, this tuple is part of the format: only
+# append to it together with a BINARY_VERSION bump.
+_STATIC_STRINGS = (
+    'Update', 'Message', 'User', 'Chat', 'MessageEntity', 'PhotoSize', 'Audio', 'Document', 'Video', 'Animation',
+    'Voice', 'VideoNote', 'Contact', 'Location', 'Venue', 'PollOption', 'PollAnswer', 'Poll', 'Dice',
+    'CallbackQuery', 'ChatPhoto', 'ChatPermissions', 'Sticker', 'MaskPosition', 'InlineQuery', 'ChosenInlineResult',
+    'Invoice', 'ShippingAddress', 'OrderInfo', 'SuccessfulPayment', 'ShippingQuery', 'PreCheckoutQuery', 'Game',
+    'InlineKeyboardMarkup', 'File', 'update_id', 'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'inline_query', 'chosen_inline_result', 'callback_query', 'shipping_query', 'pre_checkout_query', 'poll',
+    'poll_answer', 'content_type', 'message_id', 'from_user', 'date', 'chat', 'forward_from_chat',
+    'forward_from_message_id', 'forward_from', 'forward_date', 'reply_to_message', 'via_bot', 'edit_date',
+    'media_group_id', 'author_signature', 'text', 'entities', 'caption_entities', 'audio', 'document', 'photo',
+    'sticker', 'video', 'video_note', 'voice', 'caption', 'contact', 'location', 'venue', 'animation',
+    'new_chat_members', 'left_chat_member', 'new_chat_title', 'new_chat_photo', 'delete_chat_photo',
+    'group_chat_created', 'supergroup_chat_created', 'channel_chat_created', 'migrate_to_chat_id',
+    'migrate_from_chat_id', 'pinned_message', 'invoice', 'successful_payment', 'connected_website', 'reply_markup',
+    'forward_sender_name', 'forward_signature', 'game', 'dice', 'passport_data', 'id', 'is_bot', 'first_name',
+    'username', 'last_name', 'language_code', 'can_join_groups', 'can_read_all_group_messages',
+    'supports_inline_queries', 'type', 'title', 'description', 'invite_link', 'permissions', 'slow_mode_delay',
+    'sticker_set_name', 'can_set_sticker_set', 'offset', 'length', 'url', 'user', 'language', 'file_id',
+    'file_unique_id', 'width', 'height', 'file_size', 'duration', 'performer', 'mime_type', 'thumb', 'file_name',
+    'phone_number', 'user_id', 'vcard', 'longitude', 'latitude', 'address', 'foursquare_id', 'foursquare_type',
+    'voter_count', 'poll_id', 'option_ids', 'question', 'options', 'total_voter_count', 'is_closed', 'is_anonymous',
+    'allows_multiple_answers', 'correct_option_id', 'explanation', 'explanation_entities', 'open_period',
+    'close_date', 'value', 'emoji', 'game_short_name', 'chat_instance', 'data', 'inline_message_id',
+    'small_file_id', 'small_file_unique_id', 'big_file_id', 'big_file_unique_id', 'can_send_messages',
+    'can_send_media_messages', 'can_send_polls', 'can_send_other_messages', 'can_add_web_page_previews',
+    'can_change_info', 'can_invite_users', 'can_pin_messages', 'set_name', 'mask_position', 'is_animated', 'point',
+    'x_shift', 'y_shift', 'scale', 'query', 'result_id', 'start_parameter', 'currency', 'total_amount',
+    'country_code', 'state', 'city', 'post_code', 'name', 'email', 'shipping_address', 'invoice_payload',
+    'shipping_option_id', 'order_info', 'telegram_payment_charge_id', 'provider_payment_charge_id', 'text_entities',
+    'row_width', 'keyboard', 'file_path', 'inline_keyboard', 'callback_data', 'private', 'group', 'supergroup',
+    'channel', 'bot_command', 'mention', 'hashtag', 'text_link', 'regular', 'quiz')
+_STATIC_INDEX = {value: idx for idx, value in enumerate(_STATIC_STRINGS)}
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+
+# Shape layouts are shared by all payloads, both caches are cleared when they grow past the limit
+# so payloads with unusual shapes can't grow them without bound.
+_CACHE_LIMIT = 4096
+_encode_shapes = {}
+_decode_shapes = {}
+
+
+class BinaryFormatError(ValueError):
+    """
+    This class represents an Exception thrown when a binary payload is malformed,
+    Was produced by an unsupported version or references a class the resolver doesn't know.
+    """
+
+
+def _packed_struct(kinds):
+    return struct.Struct('<' + ''.join(k for k in kinds if k in _PACKED) + 'I' * kinds.count('s'))
+
+
+def _encode_layout(key):
+    cls, names, kinds = key
+    idxs = [_STATIC_INDEX.get(name) for name in (cls.__name__,) + names]
+    if None in idxs:
+        definition = None
+    else:
+        definition = _TAG_BH.pack(_SHAPE_STATIC, idxs[0], len(names)) + bytes(idxs[1:]) + kinds.encode('ascii')
+    if len(_encode_shapes) >= _CACHE_LIMIT:
+        _encode_shapes.clear()
+    layout = _encode_shapes[key] = (definition, _packed_struct(kinds))
+    return layout
+
+
+class _Encoder:
+    def __init__(self):
+        self.strings = _STATIC_INDEX.copy()
+        self.shapes = {}
+        self.chunks = []
+
+    def intern(self, value):
+        idx = self.strings.get(value)
+        if idx is None:
+            idx = self.strings[value] = len(self.strings)
+        return idx
+
+    def encode(self, value):
+        out = self.chunks.append
+        if value is None:
+            out(b'\x00')
+        elif value is True:
+            out(b'\x01')
+        elif value is False:
+            out(b'\x02')
+        elif type(value) is str:
+            out(_TAG_I.pack(_STR, self.intern(value)))
+        elif type(value) is int:
+            if _INT64_MIN <= value <= _INT64_MAX:
+                out(_TAG_q.pack(_INT, value))
+            else:
+                out(_TAG_I.pack(_BIGINT, self.intern(str(value))))
+        elif type(value) is float:
+            out(_TAG_d.pack(_FLOAT, value))
+        elif isinstance(value, (list, tuple)):
+            out(_TAG_I.pack(_LIST, len(value)))
+            for item in value:
+                self.encode(item)
+        elif isinstance(value, dict):
+            out(_TAG_I.pack(_DICT, len(value)))
+            for key, item in value.items():
+                out(_I.pack(self.intern(str(key))))
+                self.encode(item)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            out(_TAG_I.pack(_BYTES, len(value)))
+            out(bytes(value))
+        elif hasattr(value, '__dict__'):
+            self.encode_object(value)
+        else:
+            raise BinaryFormatError("Can't encode value of type {0}".format(type(value).__name__))
+
+    def encode_object(self, value):
+        out = self.chunks.append
+        strings = self.strings
+        attrs = value.__dict__
+        kinds = []
+        kind = kinds.append
+        packed = []
+        nested = []
+        refs = []
+        for item in attrs.values():
+            if item is None:
+                kind('n')
+            elif type(item) is str:
+                idx = strings.get(item)
+                if idx is None:
+                    idx = strings[item] = len(strings)
+                kind('s')
+                refs.append(idx)
+            elif type(item) is int and _INT64_MIN <= item <= _INT64_MAX:
+                kind('q')
+                packed.append(item)
+            elif type(item) is bool:
+                kind('?')
+                packed.append(item)
+            elif type(item) is float:
+                kind('d')
+                packed.append(item)
+            else:
+                kind('v')
+                nested.append(item)
+        key = (type(value), tuple(attrs), ''.join(kinds))
+        layout = _encode_shapes.get(key) or _encode_layout(key)
+        idx = self.shapes.get(key)
+        if idx is None:
+            self.shapes[key] = len(self.shapes)
+            self.define_shape(key, layout[0])
+        else:
+            out(_TAG_I.pack(_OBJECT, idx))
+        out(layout[1].pack(*packed, *refs))
+        for item in nested:
+            self.encode(item)
+
+    def define_shape(self, key, definition):
+        out = self.chunks.append
+        if definition is None:
+            cls, names, kinds = key
+            out(_TAG_IH.pack(_SHAPE_NEW, self.intern(cls.__name__), len(names)))
+            out(struct.pack('<{0}I'.format(len(names)), *[self.intern(name) for name in names]))
+            out(kinds.encode('ascii'))
+        else:
+            out(definition)
+
+    def getvalue(self):
+        dynamic = list(self.strings)[len(_STATIC_STRINGS):]
+        blob = ''.join(dynamic).encode('utf-8', 'surrogatepass')
+        return b''.join([_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(dynamic), len(blob)),
+                         struct.pack('<{0}I'.format(len(dynamic)), *accumulate(len(item) for item in dynamic)),
+                         blob] + self.chunks)
+
+
+def _decode_shape(cls, names, kinds):
+    if len(names) != len(kinds) or not set(kinds).issubset(_KINDS):
+        raise BinaryFormatError("Invalid shape for {0}.".format(cls.__name__))
+    scalars = tuple(name for name, k in zip(names, kinds) if k in _PACKED)
+    refs = tuple(name for name, k in zip(names, kinds) if k == 's')
+    nested = tuple(name for name, k in zip(names, kinds) if k == 'v')
+    return cls, _packed_struct(kinds), dict.fromkeys(names), scalars, refs, nested
+
+
+class _Decoder:
+    def __init__(self, data, resolver):
+        self.data = data if isinstance(data, bytes) else bytes(data)
+        self.resolver = resolver
+        self.strings = _STATIC_STRINGS
+        self.shapes = []
+        self.pos = 0
+
+    def read_header(self):
+        data = self.data
+        if len(data) < _HEADER.size:
+            raise BinaryFormatError("Payload is too short.")
+        magic, version, count, size = _HEADER.unpack_from(data, 0)
+        if magic != BINARY_MAGIC:
+            raise BinaryFormatError("Payload is not a tgbotapi binary object.")
+        if version != BINARY_VERSION:
+            raise BinaryFormatError("Unsupported binary version {0}.".format(version))
+        pos = _HEADER.size
+        ends = struct.unpack_from('<{0}I'.format(count), data, pos)
+        pos += 4 * count
+        if pos + size > len(data):
+            raise BinaryFormatError("Truncated string table.")
+        text = str(data[pos:pos + size], 'utf-8', 'surrogatepass')
+        if (ends[-1] if ends else 0) != len(text):
+            raise BinaryFormatError("Corrupted string table.")
+        self.strings = _STATIC_STRINGS + tuple([text[start:end] for start, end in zip((0,) + ends, ends)])
+        self.pos = pos + size
+
+    def resolve(self, name):
+        cls = self.resolver(name)
+        if cls is None:
+            raise BinaryFormatError("Unknown class {0}.".format(name))
+        return cls
+
+    def read_shape(self, tag, pos):
+        data = self.data
+        if tag == _SHAPE_STATIC:
+            count = _H.unpack_from(data, pos + 1)[0]
+            end = pos + 3 + 2 * count
+            key = (self.resolver, data[pos:end])
+            shape = _decode_shapes.get(key)
+            if shape is None:
+                if len(key[1]) != end - pos:
+                    raise BinaryFormatError("Truncated shape at offset {0}.".format(pos))
+                names = tuple(_STATIC_STRINGS[idx] for idx in data[pos + 3:pos + 3 + count])
+                shape = self.cache_shape(key, _STATIC_STRINGS[data[pos]], names, data[pos + 3 + count:end])
+        else:
+            name, count = _I.unpack_from(data, pos)[0], _H.unpack_from(data, pos + 4)[0]
+            idxs = struct.unpack_from('<{0}I'.format(count), data, pos + 6)
+            end = pos + 6 + 5 * count
+            strings = self.strings
+            names = tuple(strings[idx] for idx in idxs)
+            kinds = data[end - count:end]
+            key = (self.resolver, strings[name], names, kinds)
+            shape = _decode_shapes.get(key)
+            if shape is None:
+                shape = self.cache_shape(key, strings[name], names, kinds)
+        self.shapes.append(shape)
+        self.pos = end
+        return shape
+
+    def cache_shape(self, key, name, names, kinds):
+        shape = _decode_shape(self.resolve(name), names, str(kinds, 'ascii'))
+        if len(_decode_shapes) >= _CACHE_LIMIT:
+            _decode_shapes.clear()
+        _decode_shapes[key] = shape
+        return shape
+
+    def decode(self):
+        data = self.data
+        pos = self.pos
+        tag = data[pos]
+        pos += 1
+        if tag == _OBJECT:
+            self.pos = pos + 4
+            return self.decode_object(self.shapes[_I.unpack_from(data, pos)[0]])
+        if tag <= _FALSE:
+            self.pos = pos
+            return None if tag == _NONE else tag == _TRUE
+        if tag == _STR:
+            self.pos = pos + 4
+            return self.strings[_I.unpack_from(data, pos)[0]]
+        if tag == _LIST:
+            self.pos = pos + 4
+            decode = self.decode
+            return [decode() for _ in range(_I.unpack_from(data, pos)[0])]
+        if tag == _SHAPE_STATIC or tag == _SHAPE_NEW:
+            return self.decode_object(self.read_shape(tag, pos))
+        if tag == _INT:
+            self.pos = pos + 8
+            return _q.unpack_from(data, pos)[0]
+        if tag == _FLOAT:
+            self.pos = pos + 8
+            return _d.unpack_from(data, pos)[0]
+        if tag == _DICT:
+            count = _I.unpack_from(data, pos)[0]
+            self.pos = pos + 4
+            result = {}
+            for _ in range(count):
+                key = self.strings[_I.unpack_from(data, self.pos)[0]]
+                self.pos += 4
+                result[key] = self.decode()
+            return result
+        if tag == _BIGINT:
+            self.pos = pos + 4
+            return int(self.strings[_I.unpack_from(data, pos)[0]])
+        if tag == _BYTES:
+            length = _I.unpack_from(data, pos)[0]
+            pos += 4
+            if pos + length > len(data):
+                raise BinaryFormatError("Truncated bytes at offset {0}.".format(pos))
+            self.pos = pos + length
+            return data[pos:pos + length]
+        raise BinaryFormatError("Unknown tag {0} at offset {1}.".format(tag, pos - 1))
+
+    def decode_object(self, shape):
+        cls, packer, template, scalars, refs, nested = shape
+        pos = self.pos
+        values = packer.unpack_from(self.data, pos)
+        self.pos = pos + packer.size
+        obj = cls.__new__(cls)
+        attrs = obj.__dict__
+        attrs.update(template)
+        if scalars:
+            attrs.update(zip(scalars, values))
+        if refs:
+            strings = self.strings
+            attrs.update(zip(refs, [strings[idx] for idx in values[len(scalars):]]))
+        if nested:
+            decode = self.decode
+            for name in nested:
+                attrs[name] = decode()
+        return obj
+
+
+def to_binary(obj):
+    """
+    Serializes obj (an object graph made of Telegram types, lists, dicts and scalars) to bytes.
+    :param any obj: Object to serialize.
+    :return: Versioned binary payload.
+    :rtype: bytes
+    """
+    encoder = _Encoder()
+    encoder.encode(obj)
+    return encoder.getvalue()
+
+
+def from_binary(data, resolver):
+    """
+    Rebuilds an object graph serialized by to_binary.
+    :param bytes or bytearray or memoryview data: Binary payload.
+    :param resolver: Callable that maps a class name to a class, or None if the class is not allowed.
+    :return: the deserialized object.
+    """
+    decoder = _Decoder(data, resolver)
+    try:
+        decoder.read_header()
+        obj = decoder.decode()
+    except BinaryFormatError:
+        raise
+    except (struct.error, IndexError, UnicodeDecodeError, TypeError, ValueError) as e:
+        raise BinaryFormatError("Truncated or corrupted payload: {0}".format(e))
+    if decoder.pos != len(decoder.data):
+        raise BinaryFormatError("Unexpected trailing data at offset {0}.".format(decoder.pos))
+    return obj
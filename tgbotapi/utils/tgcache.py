@@ -0,0 +1,680 @@
+import binascii
+import collections
+import hashlib
+import os
+import re
+import threading
+import time
+
+from .tgjson import json_dumps, json_loads
+
+_EMPTY_DIGEST = hashlib.sha256().hexdigest()
+
+_SAFE_NAME = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+# temporary file of FileCache.put
+_TMP_NAME = re.compile(r'^[A-Za-z0-9_-]{1,128}\.[0-9a-f]{8}\.tmp$')
+
+
+class UploadCache:
+    """
+    Maps the content hash of uploaded files to the file_id Telegram assigned to them,
+    So sending the same bytes again passes the file_id instead of uploading the file.
+    Entries are evicted least recently used first and, if filename is set, persisted in an append-only file
+    that is compacted once it holds twice as many records as max_entries.
+    """
+
+    def __init__(self, filename=None, max_entries=10000):
+        """
+        :param str or None filename: File the cache is loaded from and persisted to, None keeps it in memory only.
+        :param int max_entries: Maximum number of file_ids kept.
+        """
+        if max_entries <= 0:
+            raise ValueError('max_entries must be a positive number, got {0!r}'.format(max_entries))
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.__entries = collections.OrderedDict()
+        self.__records = 0
+        self.__lock = threading.Lock()
+        if filename is not None:
+            self.__load()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @staticmethod
+    def key(kind, data):
+        """
+        Hashes the content of data without consuming it, file objects are rewound to where they were.
+        :param str kind: 'photo', 'document', ... the same bytes get a different file_id for each kind.
+        :param any data: bytes, a seekable binary file object or a (filename, file object) tuple.
+        :return: the cache key, or None if the content can't be hashed (str file_ids, generators, ...).
+        :rtype: str or None
+        """
+        if isinstance(data, tuple) and len(data) >= 2:
+            data = data[1]
+        digest = hashlib.sha256()
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            digest.update(data)
+        elif hasattr(data, 'read') and hasattr(data, 'seek') and hasattr(data, 'tell'):
+            try:
+                position = data.tell()
+            except (OSError, ValueError):
+                return None
+            try:
+                chunk = data.read(1048576)
+                while chunk:
+                    if not isinstance(chunk, bytes):
+                        return None
+                    digest.update(chunk)
+                    chunk = data.read(1048576)
+            finally:
+                data.seek(position)
+        else:
+            return None
+        if digest.hexdigest() == _EMPTY_DIGEST:
+            # nothing left to read, e.g. a file object already consumed by a previous upload
+            return None
+        return '{0}:{1}'.format(kind, digest.hexdigest())
+
+    def get(self, key):
+        """
+        :param str key: a key returned by UploadCache.key
+        :return: the file_id stored for key or None.
+        :rtype: str or None
+        """
+        with self.__lock:
+            file_id = self.__entries.get(key)
+            if file_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return file_id
+
+    def put(self, key, file_id):
+        """
+        Stores file_id for key, evicting the least recently used entry if the cache is full.
+        :param str key: a key returned by UploadCache.key
+        :param str file_id:
+        """
+        with self.__lock:
+            if self.__entries.get(key) == file_id:
+                self.__entries.move_to_end(key)
+                return
+            self.__entries[key] = file_id
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+            self.__append(key, file_id)
+
+    def discard(self, key):
+        """
+        Forgets key, e.g. after Telegram rejected its file_id.
+        :param str key:
+        """
+        with self.__lock:
+            if self.__entries.pop(key, None) is not None:
+                self.__append(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__compact()
+
+    def snapshot(self):
+        """
+        :return: list of [key, file_id], least recently used first
+        """
+        with self.__lock:
+            return [[key, file_id] for key, file_id in self.__entries.items()]
+
+    def restore(self, snapshot):
+        """
+        Adds the entries of a snapshot, older than the ones put since it was taken
+        :param list snapshot: returned by snapshot
+        """
+        with self.__lock:
+            for key, file_id in reversed(snapshot):
+                if key not in self.__entries:
+                    self.__entries[key] = file_id
+                    self.__entries.move_to_end(key, last=False)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def __load(self):
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, 'rb') as file:
+            for line in file:
+                try:
+                    key, file_id = json_loads(line)
+                except ValueError:
+                    # torn last line after a crash
+                    continue
+                self.__records += 1
+                self.__entries.pop(key, None)
+                if file_id is not None:
+                    self.__entries[key] = file_id
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+    def __append(self, key, file_id):
+        if self.filename is None:
+            return
+        if self.__records >= 2 * self.max_entries:
+            self.__compact()
+            return
+        dirs = os.path.dirname(self.filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        with open(self.filename, 'a', encoding='utf-8') as file:
+            file.write(json_dumps([key, file_id]) + '\n')
+        self.__records += 1
+
+    def __compact(self):
+        if self.filename is None:
+            return
+        dirs = os.path.dirname(self.filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        with open(self.filename + '.tmp', 'w', encoding='utf-8') as file:
+            for key, file_id in self.__entries.items():
+                file.write(json_dumps([key, file_id]) + '\n')
+        os.replace(self.filename + '.tmp', self.filename)
+        self.__records = len(self.__entries)
+
+
+class FileCache:
+    """
+    Size-bounded on-disk cache of downloaded files keyed by file_unique_id, which is the same for a file
+    whoever sends or forwards it, with an optional in-memory tier for the most recently used files.
+    Files are written to a temporary name and renamed into place, the least recently used are removed once
+    the total size passes max_bytes. Recency survives restarts through the files' modification times.
+    """
+
+    def __init__(self, directory, max_bytes=1073741824, memory_bytes=0):
+        """
+        :param str directory: Directory the files are stored in, created if missing, best used for nothing else.
+        :param int max_bytes: Maximum total size of the files on disk.
+        :param int memory_bytes: Maximum total size of the files also kept in memory, 0 disables the memory tier.
+        """
+        if max_bytes <= 0:
+            raise ValueError('max_bytes must be a positive number, got {0!r}'.format(max_bytes))
+        self.directory = os.fspath(directory)
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__files = collections.OrderedDict()
+        self.__size = 0
+        self.__memory = collections.OrderedDict()
+        self.__memory_size = 0
+        self.__lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.__scan()
+
+    def __len__(self):
+        return len(self.__files)
+
+    def __contains__(self, file_unique_id):
+        return _file_name(file_unique_id) in self.__files
+
+    @property
+    def size(self):
+        """
+        :return: total size of the files on disk.
+        :rtype: int
+        """
+        return self.__size
+
+    def stats(self):
+        """
+        :return: hit and miss counters, hit_rate and current sizes.
+        :rtype: dict
+        """
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': hits / lookups if lookups else 0.0,
+                'files': len(self.__files), 'bytes': self.__size, 'memory_bytes': self.__memory_size}
+
+    def path(self, file_unique_id):
+        """
+        :return: path the file with file_unique_id is stored at, whether it is cached or not.
+        :rtype: str
+        """
+        return os.path.join(self.directory, _file_name(file_unique_id))
+
+    def get(self, file_unique_id):
+        """
+        :param str file_unique_id:
+        :return: the content of the cached file or None.
+        :rtype: bytes or None
+        """
+        name = _file_name(file_unique_id)
+        with self.__lock:
+            data = self.__memory.get(name)
+            if data is not None:
+                self.memory_hits += 1
+                self.__memory.move_to_end(name)
+                self.__files.move_to_end(name)
+                return data
+            if name not in self.__files:
+                self.misses += 1
+                return None
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as file:
+                data = file.read()
+        except OSError:
+            # removed behind our back
+            with self.__lock:
+                self.__forget(name)
+                self.misses += 1
+            return None
+        with self.__lock:
+            self.disk_hits += 1
+            self.__touch(name)
+            self.__remember(name, data)
+        return data
+
+    def put(self, file_unique_id, data):
+        """
+        Stores a file, replacing the one cached with the same file_unique_id.
+        :param str file_unique_id:
+        :param data: bytes or an iterable of bytes chunks, written as they come.
+        :return: the size of the file, or None if it is larger than max_bytes and wasn't kept.
+        :rtype: int or None
+        """
+        name = _file_name(file_unique_id)
+        path = os.path.join(self.directory, name)
+        tmp = '{0}.{1}.tmp'.format(path, binascii.hexlify(os.urandom(4)).decode('ascii'))
+        size = 0
+        try:
+            with open(tmp, 'wb') as file:
+                for chunk in ((data,) if isinstance(data, (bytes, bytearray, memoryview)) else data):
+                    file.write(chunk)
+                    size += len(chunk)
+            if size > self.max_bytes:
+                return None
+            os.replace(tmp, path)
+        finally:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+        with self.__lock:
+            self.__forget(name)
+            self.__files[name] = size
+            self.__size += size
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                self.__remember(name, bytes(data))
+            self.__evict()
+        return size
+
+    def discard(self, file_unique_id):
+        name = _file_name(file_unique_id)
+        with self.__lock:
+            if name in self.__files:
+                self.__forget(name)
+                self.__remove(name)
+
+    def clear(self):
+        with self.__lock:
+            for name in list(self.__files):
+                self.__forget(name)
+                self.__remove(name)
+
+    def __scan(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            # only the names put makes, other files in the directory are left alone
+            if not entry.is_file():
+                continue
+            if _TMP_NAME.match(entry.name) is not None:
+                # left behind by a crash during put
+                os.remove(entry.path)
+                continue
+            if _SAFE_NAME.match(entry.name) is None:
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.__files[name] = size
+            self.__size += size
+        self.__evict()
+
+    def __touch(self, name):
+        self.__files.move_to_end(name)
+        try:
+            os.utime(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def __remember(self, name, data):
+        if len(data) > self.memory_bytes:
+            return
+        previous = self.__memory.pop(name, None)
+        if previous is not None:
+            self.__memory_size -= len(previous)
+        self.__memory[name] = data
+        self.__memory_size += len(data)
+        while self.__memory_size > self.memory_bytes:
+            self.__memory_size -= len(self.__memory.popitem(last=False)[1])
+
+    def __forget(self, name):
+        self.__size -= self.__files.pop(name, 0)
+        data = self.__memory.pop(name, None)
+        if data is not None:
+            self.__memory_size -= len(data)
+
+    def __remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def __evict(self):
+        while self.__size > self.max_bytes and self.__files:
+            name = next(iter(self.__files))
+            self.__forget(name)
+            self.__remove(name)
+            self.evictions += 1
+
+
+def _file_name(file_unique_id):
+    # file_unique_ids are URL-safe base64, anything else is hashed into a file name
+    if _SAFE_NAME.match(file_unique_id) is None:
+        return hashlib.sha256(file_unique_id.encode('utf-8')).hexdigest()
+    return file_unique_id
+
+
+class TTLCache:
+    """
+    Keeps values for ttl seconds and coalesces concurrent lookups of the same missing key into a single load,
+    The other callers wait for it and get the same value or exception. Failed loads are not cached.
+    """
+
+    def __init__(self, ttl, max_entries=10000):
+        """
+        :param float ttl: Seconds a value stays valid.
+        :param int max_entries: Maximum number of values kept, the oldest are dropped first.
+        """
+        if max_entries <= 0:
+            raise ValueError('max_entries must be a positive number, got {0!r}'.format(max_entries))
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        # key: (expiry time, value), in expiry order since every value lives for ttl
+        self.__entries = collections.OrderedDict()
+        # key: [event set once loaded, value, exception]
+        self.__loading = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, load):
+        """
+        :param key: any hashable
+        :param load: called without arguments to get the value if it isn't cached or has expired.
+        :return: the cached or loaded value.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.hits += 1
+                    return entry[1]
+                del self.__entries[key]
+            flight = self.__loading.get(key)
+            if flight is None:
+                flight = self.__loading[key] = [threading.Event(), None, None]
+                leader = True
+                self.misses += 1
+            else:
+                leader = False
+                self.coalesced += 1
+        if not leader:
+            flight[0].wait()
+            if flight[2] is not None:
+                raise flight[2]
+            return flight[1]
+        try:
+            flight[1] = load()
+        except BaseException as e:
+            # KeyboardInterrupt, SystemExit or a killed greenlet too, the waiters must not take it for a value
+            flight[2] = e
+            raise
+        else:
+            with self.__lock:
+                self.__entries.pop(key, None)
+                self.__entries[key] = (time.monotonic() + self.ttl, flight[1])
+                while len(self.__entries) > self.max_entries:
+                    self.__entries.popitem(last=False)
+            return flight[1]
+        finally:
+            with self.__lock:
+                del self.__loading[key]
+            flight[0].set()
+
+    def invalidate(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def invalidate_if(self, predicate):
+        """
+        Drops every value for which predicate(value) is true.
+        """
+        with self.__lock:
+            for key in [key for key, entry in self.__entries.items() if predicate(entry[1])]:
+                del self.__entries[key]
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def snapshot(self):
+        """
+        :return: list of (key, seconds left, value) of the values still valid
+        """
+        now = time.monotonic()
+        with self.__lock:
+            return [(key, entry[0] - now, entry[1]) for key, entry in self.__entries.items() if entry[0] > now]
+
+    def restore(self, entries, age=0):
+        """
+        Adds the values of a snapshot, the keys cached since are kept
+        :param list entries: returned by snapshot
+        :param float age: Seconds since the snapshot was taken.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            for key, left, value in entries:
+                left = min(left - age, self.ttl)
+                if left > 0 and key not in self.__entries:
+                    self.__entries[key] = (now + left, value)
+            # back in expiry order
+            for key, entry in sorted(self.__entries.items(), key=lambda item: item[1][0]):
+                self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+
+FileRef = collections.namedtuple('FileRef', ['file_id', 'file_unique_id', 'kind', 'file_size'])
+
+# Message fields holding a file, a GIF comes as both document and animation so animation is read last and wins
+_MEDIA_KINDS = ('document', 'animation', 'audio', 'video', 'voice', 'video_note', 'sticker')
+
+
+class FileIdIndex:
+    """
+    Remembers the freshest file_id of every file seen in messages, keyed by file_unique_id
+    and by keys you choose (see set_key), so a known file can be sent again by file_id instead of uploaded.
+    Holds at most max_entries files and max_entries keys, the least recently seen are dropped first,
+    and the keys of a dropped file go with it.
+    """
+
+    def __init__(self, max_entries=100000, filename=None):
+        """
+        :param int max_entries: Maximum number of files kept.
+        :param str or None filename: Snapshot file loaded now and written by save.
+        """
+        if max_entries <= 0:
+            raise ValueError('max_entries must be a positive number, got {0!r}'.format(max_entries))
+        self.max_entries = max_entries
+        self.filename = filename
+        # file_unique_id: FileRef
+        self.__files = collections.OrderedDict()
+        # user key: file_unique_id, oldest first
+        self.__keys = collections.OrderedDict()
+        # file_unique_id: user keys resolving to it
+        self.__aliases = {}
+        self.__lock = threading.Lock()
+        if filename is not None and os.path.isfile(filename):
+            self.load(filename)
+
+    def __len__(self):
+        return len(self.__files)
+
+    def add(self, file_unique_id, file_id, kind, file_size=None):
+        """
+        Records file_id as the freshest file_id of file_unique_id.
+        :param str file_unique_id:
+        :param str file_id:
+        :param str kind: 'photo', 'document', 'sticker', ...
+        :param int or None file_size:
+        """
+        with self.__lock:
+            self.__files.pop(file_unique_id, None)
+            self.__files[file_unique_id] = FileRef(file_id, file_unique_id, kind, file_size)
+            self.__trim()
+
+    def harvest(self, message):
+        """
+        Adds every file of a message, and of the message it replies to.
+        :param dict message: a Message as returned by the Bot API, before de_json.
+        :return: number of files added.
+        :rtype: int
+        """
+        count = 0
+        photo = message.get('photo')
+        if photo:
+            largest = photo[-1]
+            self.add(largest['file_unique_id'], largest['file_id'], 'photo', largest.get('file_size'))
+            count += 1
+        for kind in _MEDIA_KINDS:
+            media = message.get(kind)
+            if media:
+                self.add(media['file_unique_id'], media['file_id'], kind, media.get('file_size'))
+                count += 1
+        reply = message.get('reply_to_message')
+        if reply:
+            count += self.harvest(reply)
+        return count
+
+    def set_key(self, key, file_unique_id):
+        """
+        Makes key resolve to the file with file_unique_id, e.g. set_key('welcome-banner', photo.file_unique_id).
+        """
+        with self.__lock:
+            self.__set_key(key, file_unique_id)
+            self.__trim()
+
+    def get(self, key):
+        """
+        :param str key: a file_unique_id or a key passed to set_key.
+        :return: the freshest known reference to the file or None.
+        :rtype: FileRef or None
+        """
+        with self.__lock:
+            file_unique_id = self.__keys.get(key)
+            if file_unique_id is not None:
+                self.__keys.move_to_end(key)
+            else:
+                file_unique_id = key
+            ref = self.__files.get(file_unique_id)
+            if ref is not None:
+                self.__files.move_to_end(file_unique_id)
+            return ref
+
+    def resolve(self, key):
+        """
+        :param str key: a file_unique_id or a key passed to set_key.
+        :return: a file_id to send the file with, or None if it isn't known.
+        :rtype: str or None
+        """
+        ref = self.get(key)
+        return ref.file_id if ref is not None else None
+
+    def save(self, filename=None):
+        """
+        Writes a snapshot of the index, atomically.
+        :param str or None filename: defaults to the filename passed to the constructor.
+        """
+        filename = filename or self.filename
+        data = json_dumps(self.snapshot())
+        dirs = os.path.dirname(filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        with open(filename + '.tmp', 'w', encoding='utf-8') as file:
+            file.write(data)
+        os.replace(filename + '.tmp', filename)
+
+    def load(self, filename):
+        """
+        Adds the files and keys of a snapshot written by save.
+        """
+        with open(filename, 'rb') as file:
+            self.restore(json_loads(file.read()))
+
+    def snapshot(self):
+        """
+        :return: the keys and files of the index, JSON serializable
+        :rtype: dict
+        """
+        with self.__lock:
+            return {'keys': dict(self.__keys), 'files': [list(ref) for ref in self.__files.values()]}
+
+    def restore(self, snapshot):
+        """
+        Adds the files and keys of a snapshot, older than what the index has seen since it was taken
+        :param dict snapshot: returned by snapshot
+        """
+        with self.__lock:
+            for key, file_unique_id in reversed(list(snapshot['keys'].items())):
+                if key not in self.__keys:
+                    self.__set_key(key, file_unique_id)
+                    self.__keys.move_to_end(key, last=False)
+            for ref in reversed(snapshot['files']):
+                ref = FileRef(*ref)
+                if ref.file_unique_id not in self.__files:
+                    self.__files[ref.file_unique_id] = ref
+                    self.__files.move_to_end(ref.file_unique_id, last=False)
+            self.__trim()
+
+    def __set_key(self, key, file_unique_id):
+        old = self.__keys.pop(key, None)
+        if old is not None:
+            self.__unalias(key, old)
+        self.__keys[key] = file_unique_id
+        self.__aliases.setdefault(file_unique_id, set()).add(key)
+
+    def __unalias(self, key, file_unique_id):
+        aliases = self.__aliases.get(file_unique_id)
+        if aliases is not None:
+            aliases.discard(key)
+            if not aliases:
+                del self.__aliases[file_unique_id]
+
+    def __trim(self):
+        while len(self.__files) > self.max_entries:
+            file_unique_id, _ = self.__files.popitem(last=False)
+            for key in self.__aliases.pop(file_unique_id, ()):
+                del self.__keys[key]
+        while len(self.__keys) > self.max_entries:
+            key, file_unique_id = self.__keys.popitem(last=False)
+            self.__unalias(key, file_unique_id)
@@ -1,6 +1,99 @@
 import json
 import six
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _json_default(obj):
+    # nested Telegram objects (reply markups, input message contents, ...) left inside a dict
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    if isinstance(obj, JsonSerializable):
+        return json_loads(obj.to_json())
+    raise TypeError("Object of type {0} is not JSON serializable".format(type(obj).__name__))
+
+
+# same output as json.dumps, but a single encoder is reused instead of building one per call
+_json_dumps = json.JSONEncoder(default=_json_default).encode
+
+
+def _orjson_dumps(obj):
+    try:
+        return orjson.dumps(obj, default=_json_default).decode('utf-8')
+    except TypeError:
+        # non-str dict keys or ints wider than 64 bits, both handled by the standard library
+        return _json_dumps(obj)
+
+
+def _ujson_dumps(obj):
+    try:
+        return ujson.dumps(obj, escape_forward_slashes=False, default=_json_default)
+    except (TypeError, OverflowError):
+        return _json_dumps(obj)
+
+
+# (name, loads, dumps) of the selected backend, replaced as a whole so readers never see a mix
+_json_backend = ('json', json.loads, _json_dumps)
+
+
+def set_json_backend(name=None):
+    """
+    Selects the library used to parse and produce JSON everywhere in tgbotapi,
+    By default the fastest installed one of orjson, ujson and the standard json module.
+    :param str or None name: 'orjson', 'ujson' or 'json', None picks automatically.
+    :return: name of the selected backend.
+    :rtype: str
+    """
+    global _json_backend
+    if name is None:
+        name = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+    if name == 'orjson' and orjson is not None:
+        _json_backend = (name, orjson.loads, _orjson_dumps)
+    elif name == 'ujson' and ujson is not None:
+        _json_backend = (name, ujson.loads, _ujson_dumps)
+    elif name == 'json':
+        _json_backend = (name, json.loads, _json_dumps)
+    else:
+        raise ValueError("JSON backend {0} is unknown or not installed.".format(name))
+    return name
+
+
+def get_json_backend():
+    """
+    :return: name of the JSON backend in use ('orjson', 'ujson' or 'json').
+    :rtype: str
+    """
+    return _json_backend[0]
+
+
+def json_loads(data):
+    """
+    Parses a JSON document with the selected backend.
+    :param str or bytes data:
+    :return: the decoded object.
+    """
+    return _json_backend[1](data)
+
+
+def json_dumps(obj):
+    """
+    Serializes obj to a JSON string with the selected backend.
+    :param any obj:
+    :rtype: str
+    """
+    return _json_backend[2](obj)
+
+
+set_json_backend()
+
 
 class Dictionaryable(object):
     """
@@ -38,7 +131,7 @@ class JsonDeserializable(object):
     def check_type(obj_type):
         """
         Checks whether obj_type is a dict or a string. If it is already a dict, it is returned as-is,
-        If it is not, it is converted to a dict by means of json.loads(obj_type),
+        If it is not, it is converted to a dict by means of json_loads(obj_type),
         :param str or dict obj_type:
         :return: dict
         """
@@ -46,7 +139,7 @@ class JsonDeserializable(object):
         if type(obj_type) == dict:
             return obj_type
         elif type(obj_type) == str:
-            return json.loads(obj_type)
+            return json_loads(obj_type)
         else:
             raise ValueError("obj_type should be a dict or string.")
 
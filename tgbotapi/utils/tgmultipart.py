@@ -0,0 +1,155 @@
+import binascii
+import os
+
+from six import string_types
+
+
+class MultipartEncoder:
+    """
+    A multipart/form-data body that is produced chunk by chunk while it is sent,
+    Instead of being built in memory like requests does for files=, at most chunk_size bytes of a file are held at once.
+    It takes the same files mapping as requests and encodes it the same way: name -> file object, mmap, bytes, str,
+    iterator of bytes, or a (filename, content[, content_type[, headers]]) tuple.
+    len is the Content-Length of the body, or None if an iterator or a non-seekable stream makes it unknown,
+    in which case the body is sent with chunked transfer encoding.
+    """
+
+    def __init__(self, fields=None, files=None, boundary=None, chunk_size=65536):
+        """
+        :param dict or None fields: Plain form fields, name -> value.
+        :param dict or None files: File fields, see the class docstring.
+        :param str or None boundary: Multipart boundary, random by default.
+        :param int chunk_size: Maximum number of bytes read from a file at once.
+        """
+        self.boundary = boundary or binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.content_type = 'multipart/form-data; boundary={0}'.format(self.boundary)
+        self.chunk_size = chunk_size
+        self.__parts = []
+        self.__known_length = True
+        self.len = 0
+        for name, value in (fields or {}).items():
+            if value is None:
+                continue
+            if not isinstance(value, bytes):
+                value = str(value).encode('utf-8')
+            self.__add_part(name, None, None, None, value, len(value))
+        for name, value in (files or {}).items():
+            filename = content_type = headers = None
+            if isinstance(value, (tuple, list)):
+                filename, content_type, headers = (tuple(value[:1]) + tuple(value[2:]) + (None, None))[:3]
+                value = value[1]
+            else:
+                filename = _guess_filename(value) or name
+            if value is None:
+                continue
+            source, size = _source(value)
+            self.__add_part(name, filename, content_type, headers, source, size)
+        self.__parts.append('--{0}--\r\n'.format(self.boundary).encode('ascii'))
+        self.len = self.len + len(self.__parts[-1]) if self.__known_length else None
+        self.__chunks = None
+        self.__buffer = b''
+        self.__offset = 0
+
+    def __add_part(self, name, filename, content_type, headers, source, size):
+        disposition = 'form-data; name="{0}"'.format(_quote(name))
+        if filename is not None:
+            disposition += '; filename="{0}"'.format(_quote(filename))
+        lines = ['--{0}'.format(self.boundary), 'Content-Disposition: {0}'.format(disposition)]
+        if content_type is not None:
+            lines.append('Content-Type: {0}'.format(content_type))
+        for key, value in (headers or {}).items():
+            lines.append('{0}: {1}'.format(key, value))
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+        self.__parts.extend((head, source, b'\r\n'))
+        if size is None:
+            self.__known_length = False
+        else:
+            self.len += len(head) + size + 2
+
+    def __iter__(self):
+        for part in self.__parts:
+            if isinstance(part, bytes):
+                if part:
+                    yield part
+            elif isinstance(part, memoryview):
+                for i in range(0, len(part), self.chunk_size):
+                    yield part[i:i + self.chunk_size].tobytes()
+            elif hasattr(part, 'read'):
+                chunk = part.read(self.chunk_size)
+                while chunk:
+                    yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                    chunk = part.read(self.chunk_size)
+            else:
+                for chunk in part:
+                    if chunk:
+                        yield chunk.encode('utf-8') if isinstance(chunk, str) else bytes(chunk)
+
+    def read(self, size=-1):
+        """
+        File-like access to the body, this is how requests and http.client consume it.
+        :param int size: maximum number of bytes returned, -1 for all of the rest.
+        :rtype: bytes
+        """
+        if self.__chunks is None:
+            self.__chunks = iter(self)
+        pieces = []
+        while size != 0:
+            if self.__offset >= len(self.__buffer):
+                self.__buffer = next(self.__chunks, None)
+                self.__offset = 0
+                if self.__buffer is None:
+                    self.__buffer = b''
+                    break
+            end = len(self.__buffer) if size < 0 else min(len(self.__buffer), self.__offset + size)
+            pieces.append(self.__buffer[self.__offset:end])
+            if size > 0:
+                size -= end - self.__offset
+            self.__offset = end
+        return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+
+def _guess_filename(value):
+    name = getattr(value, 'name', None)
+    if isinstance(name, string_types) and name[:1] != '<' and name[-1:] != '>':
+        return os.path.basename(name)
+    return None
+
+
+def _quote(value):
+    return value.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+def _source(value):
+    """
+    :return: (what MultipartEncoder iterates, size in bytes or None if unknown)
+    """
+    if isinstance(value, string_types):
+        value = value.encode('utf-8')
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = memoryview(value).cast('B')
+        return value, len(value)
+    if hasattr(value, 'read'):
+        return value, _remaining(value)
+    return iter(value), None
+
+
+def _remaining(stream):
+    try:
+        position = stream.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if hasattr(stream, 'size') and hasattr(stream, 'resize'):
+        # mmap: size() is the size of the underlying file, len() is the size of the mapping
+        return len(stream) - position
+    try:
+        size = os.fstat(stream.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        try:
+            size = stream.seek(0, 2)
+            stream.seek(position)
+        except (AttributeError, OSError, ValueError):
+            return None
+    if 'b' not in getattr(stream, 'mode', 'b'):
+        # the size of a text file isn't the size of its encoded content
+        return None
+    return max(0, size - position)
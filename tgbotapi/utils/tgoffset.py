@@ -0,0 +1,265 @@
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+
+class OffsetStore:
+    """
+    Interface of the stores of TBot.enable_offset_store, the last update_id whose handlers all finished
+    """
+
+    def load(self):
+        """
+        :return: the saved update_id, None if nothing was saved yet
+        :rtype: int or None
+        """
+        raise NotImplementedError
+
+    def save(self, update_id):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileOffsetStore(OffsetStore):
+    """
+    The update_id in a text file, replaced atomically by every save
+    """
+
+    def __init__(self, filename="./.state-saves/offset"):
+        """
+        :param str filename: The file, created on the first save.
+        """
+        self.filename = filename
+
+    def load(self):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as file:
+                return int(file.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def save(self, update_id):
+        dirs = os.path.dirname(self.filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        with open(self.filename + '.tmp', 'w', encoding='utf-8') as file:
+            file.write(str(update_id))
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+class SqliteOffsetStore(OffsetStore):
+    """
+    The update_id in an SQLite database, several bots can share it under different names
+    """
+
+    def __init__(self, filename="./.state-saves/offset.db", name='default'):
+        """
+        :param str filename: Database file.
+        :param str name: Row of this bot, e.g. its username.
+        """
+        dirs = os.path.dirname(filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        self.filename = filename
+        self.name = name
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS offsets (name TEXT PRIMARY KEY, "
+                                  "update_id INTEGER NOT NULL)")
+
+    def load(self):
+        with self.__lock:
+            row = self.__connection.execute("SELECT update_id FROM offsets WHERE name = ?", (self.name,)).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, update_id):
+        with self.__lock:
+            self.__connection.execute("INSERT OR REPLACE INTO offsets VALUES (?, ?)", (self.name, update_id))
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+class OffsetCheckpoint:
+    """
+    Tracks the batches of updates being handled and commits the last update_id of the longest run of finished
+    batches, oldest first, so a crash never skips an update whose handlers didn't finish.
+    The committed update_id is written to the store at most every interval seconds, and by flush(force=True).
+    """
+
+    def __init__(self, store, interval=1.0):
+        """
+        :param OffsetStore store:
+        :param float interval: Minimum number of seconds between two writes to the store.
+        """
+        self.store = store
+        self.interval = interval
+        self.committed = store.load() or 0
+        self.writes = 0
+        self.__saved = self.committed
+        self.__written_at = 0
+        self.__batches = collections.deque()
+        self.__lock = threading.Lock()
+        self.__progress = threading.Condition(self.__lock)
+
+    def begin(self, update_id):
+        """
+        Starts a batch
+        :param int update_id: The last update_id of the batch.
+        :return: the batch, pass it to wrap and dispatched
+        """
+        batch = [update_id, 0, False]
+        with self.__lock:
+            self.__batches.append(batch)
+        return batch
+
+    def wrap(self, batch, task):
+        """
+        :return: task, counting as part of batch until it returns or raises
+        """
+        with self.__lock:
+            batch[1] += 1
+
+        def wrapper(*args, **kwargs):
+            try:
+                return task(*args, **kwargs)
+            finally:
+                with self.__lock:
+                    batch[1] -= 1
+                    self.__advance()
+                self.flush()
+
+        return wrapper
+
+    def dispatched(self, batch):
+        """
+        Marks that every task of batch was wrapped, the batch is finished once they all return
+        """
+        with self.__lock:
+            batch[2] = True
+            self.__advance()
+        self.flush()
+
+    def __advance(self):
+        committed = self.committed
+        while self.__batches and self.__batches[0][2] and self.__batches[0][1] == 0:
+            self.committed = max(self.committed, self.__batches.popleft()[0])
+        if self.committed != committed:
+            self.__progress.notify_all()
+
+    def wait(self, committed, timeout):
+        """
+        Waits until an update_id after committed is committed
+        :return: True if it was, False on timeout
+        :rtype: bool
+        """
+        with self.__lock:
+            return self.__progress.wait_for(lambda: self.committed != committed, timeout)
+
+    def flush(self, force=False):
+        """
+        Writes the committed update_id if it changed and interval passed since the last write
+        :param bool force: Ignore interval.
+        """
+        with self.__lock:
+            committed = self.committed
+            if committed == self.__saved or (not force and time.time() - self.__written_at < self.interval):
+                return
+            self.__saved = committed
+            self.__written_at = time.time()
+            self.writes += 1
+            self.store.save(committed)
+
+
+class UpdateWindow:
+    """
+    The update_ids seen among the last size ones, one bit each, to drop the updates delivered twice:
+    webhook retries and updates handed back by getUpdates after a restart.
+    An update_id older than the window is taken as a reset of the ids by Telegram and starts a new window.
+    """
+
+    def __init__(self, size=65536):
+        """
+        :param int size: Number of update_ids remembered, rounded up to a multiple of 8.
+        """
+        if size <= 0:
+            raise ValueError('size must be a positive number, got {0!r}'.format(size))
+        self.size = (size + 7) // 8 * 8
+        self.new = 0
+        self.duplicates = 0
+        self.resets = 0
+        # highest update_id seen, None before the first one
+        self.__last = None
+        self.__bits = bytearray(self.size // 8)
+        self.__lock = threading.Lock()
+
+    def add(self, update_id):
+        """
+        :return: False if update_id was already seen, True otherwise
+        :rtype: bool
+        """
+        with self.__lock:
+            last = self.__last
+            if last is not None and last - self.size < update_id <= last:
+                index = update_id % self.size
+                if self.__bits[index >> 3] & (1 << (index & 7)):
+                    self.duplicates += 1
+                    return False
+            elif last is None or update_id <= last - self.size or update_id - last >= self.size:
+                if last is not None and update_id < last:
+                    self.resets += 1
+                self.__bits[:] = bytes(len(self.__bits))
+                self.__last = update_id
+            else:
+                # forget the update_ids leaving the window
+                for old in range(last + 1, update_id + 1):
+                    index = old % self.size
+                    self.__bits[index >> 3] &= ~(1 << (index & 7)) & 0xff
+                self.__last = update_id
+            index = update_id % self.size
+            self.__bits[index >> 3] |= 1 << (index & 7)
+            self.new += 1
+            return True
+
+    def stats(self):
+        """
+        :return: new, duplicates and resets counts
+        :rtype: dict
+        """
+        return {'new': self.new, 'duplicates': self.duplicates, 'resets': self.resets}
+
+    def snapshot(self, handled=None):
+        """
+        :param int or None handled: The update_ids after it are left out, their handlers may not have finished.
+        :return: (highest update_id seen, bits), None if nothing was seen
+        """
+        with self.__lock:
+            if self.__last is None:
+                return None
+            bits = bytearray(self.__bits)
+        self.__forget_after(bits, self.__last, handled)
+        return self.__last, bytes(bits)
+
+    def restore(self, snapshot, handled=None):
+        """
+        Loads a snapshot of a window of the same size, ignored if update_ids were seen since it was taken
+        :param int or None handled: The update_ids after it are left out, so they are handled again.
+        """
+        with self.__lock:
+            if snapshot is None or self.__last is not None or len(snapshot[1]) != len(self.__bits):
+                return
+            self.__last = snapshot[0]
+            self.__bits[:] = snapshot[1]
+            self.__forget_after(self.__bits, self.__last, handled)
+
+    def __forget_after(self, bits, last, handled):
+        if handled is None:
+            return
+        for update_id in range(max(handled + 1, last - self.size + 1), last + 1):
+            index = update_id % self.size
+            bits[index >> 3] &= ~(1 << (index & 7)) & 0xff
@@ -0,0 +1,272 @@
+import os
+import queue
+import threading
+import time
+
+import requests
+
+from .extra import ApiException
+from .logger import logger
+from .tgjson import json_dumps, json_loads
+
+
+class Outbox:
+    """
+    Durable queue of API calls: a call is appended to a log file before put returns, sent by a pool of sender
+    threads and marked done once sent, the calls still in the log when it is opened again are sent then.
+    Appends made while the log is being written are written and flushed together (group commit), and the log
+    is rewritten with the calls not sent yet once it has four times as many lines, at least 10000.
+    Calls to the same chat are sent in order by the same thread, failed calls are retried if Telegram is
+    flooded or unreachable and dropped with an error log otherwise.
+    """
+
+    def __init__(self, filename, send, num_threads=2, fsync=False, max_attempts=5, retry_delay=1):
+        """
+        :param str filename: The log file, created if missing.
+        :param send: Called with the method name and the argument list of a call to send it.
+        :param int num_threads: Number of sender threads.
+        :param bool fsync: fsync the log after every group commit, so calls also survive a power loss.
+        :param int max_attempts: Number of times a call is tried before it is dropped.
+        :param float retry_delay: Seconds before the first retry, doubled for each other one up to 60,
+            unless Telegram asks for a longer wait.
+        """
+        if num_threads <= 0:
+            raise ValueError('num_threads must be a positive number, got {0!r}'.format(num_threads))
+        self.filename = filename
+        self.send = send
+        self.fsync = fsync
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.commits = 0
+        self.records = 0
+        self.__lock = threading.Lock()
+        # seq -> (seq, created, method, args) of the calls not sent yet, oldest first
+        self.__pending = {}
+        self.__next_seq = 1
+        self.__writes = []
+        self.__write_cond = threading.Condition()
+        self.__write_error = None
+        # lines in the log file
+        self.__lines = 0
+        self.__closed = threading.Event()
+        self.__load()
+        self.__file = open(self.filename, 'a', encoding='utf-8')
+        self.__writer = threading.Thread(target=self.__write_loop, name="OutboxWriter", daemon=True)
+        self.__writer.start()
+        self.__queues = [queue.Queue() for _ in range(num_threads)]
+        self.__senders = [threading.Thread(target=self.__send_loop, args=(tasks,), name="OutboxSender", daemon=True)
+                          for tasks in self.__queues]
+        for sender in self.__senders:
+            sender.start()
+        for entry in list(self.__pending.values()):
+            self.__route(entry)
+
+    @property
+    def backlog(self):
+        """
+        :return: number of calls not sent yet
+        :rtype: int
+        """
+        return len(self.__pending)
+
+    def oldest_age(self):
+        """
+        :return: seconds since the oldest call not sent yet was put, 0 if there's none
+        :rtype: float
+        """
+        with self.__lock:
+            oldest = next(iter(self.__pending.values()), None)
+        return 0 if oldest is None else max(0, time.time() - oldest[1])
+
+    def stats(self):
+        """
+        :return: backlog, oldest_age, sent, failed, retries, commits and records (log lines written)
+        :rtype: dict
+        """
+        return {'backlog': self.backlog, 'oldest_age': self.oldest_age(), 'sent': self.sent, 'failed': self.failed,
+                'retries': self.retries, 'commits': self.commits, 'records': self.records}
+
+    def put(self, method, args):
+        """
+        Logs a call and queues it for sending
+        :param str method: Name of the call, passed to send.
+        :param list args: Arguments of the call, must be JSON serializable.
+        :return: the sequence number of the call
+        :rtype: int
+        """
+        if self.__closed.is_set():
+            raise ValueError("the outbox is closed")
+        with self.__lock:
+            seq = self.__next_seq
+            self.__next_seq += 1
+        entry = (seq, time.time(), method, list(args))
+        try:
+            line = json_dumps(['call', seq, entry[1], method, entry[3]])
+        except (TypeError, ValueError) as e:
+            raise ValueError("the arguments of {0} can't be logged: {1}".format(method, e))
+        with self.__lock:
+            self.__pending[seq] = entry
+        try:
+            self.__append(line, wait=True)
+        except Exception:
+            with self.__lock:
+                self.__pending.pop(seq, None)
+            raise
+        self.__route(entry)
+        return seq
+
+    def close(self):
+        """
+        Stops the senders after their current call and the writer after the pending writes,
+        The calls not sent yet stay in the log.
+        """
+        self.__closed.set()
+        for tasks in self.__queues:
+            tasks.put(None)
+        for sender in self.__senders:
+            sender.join()
+        with self.__write_cond:
+            self.__write_cond.notify_all()
+        self.__writer.join()
+        self.__file.close()
+
+    def __route(self, entry):
+        # the first argument of the methods sending something is the chat
+        key = entry[3][0] if entry[3] else entry[0]
+        self.__queues[hash(str(key)) % len(self.__queues)].put(entry)
+
+    def __append(self, line, wait):
+        done = threading.Event() if wait else None
+        with self.__write_cond:
+            if self.__write_error is not None:
+                raise self.__write_error
+            self.__writes.append((line, done))
+            self.__write_cond.notify()
+        if done is not None:
+            done.wait()
+            if self.__write_error is not None:
+                raise self.__write_error
+
+    def __write_loop(self):
+        while True:
+            with self.__write_cond:
+                while not self.__writes and not self.__closed.is_set():
+                    self.__write_cond.wait()
+                if not self.__writes:
+                    return
+                writes, self.__writes = self.__writes, []
+            try:
+                self.__file.write(''.join(line + '\n' for line, done in writes))
+                self.__file.flush()
+                if self.fsync:
+                    os.fsync(self.__file.fileno())
+                self.commits += 1
+                self.records += len(writes)
+                self.__lines += len(writes)
+                if self.__lines >= max(10000, 4 * len(self.__pending)):
+                    self.__file.close()
+                    self.__compact()
+                    self.__file = open(self.filename, 'a', encoding='utf-8')
+            except OSError as e:
+                logger.error("CAN'T WRITE THE OUTBOX {0}: {1}".format(self.filename, e))
+                self.__write_error = e
+            for line, done in writes:
+                if done is not None:
+                    done.set()
+
+    def __send_loop(self, tasks):
+        while not self.__closed.is_set():
+            entry = tasks.get()
+            if entry is None or self.__closed.is_set():
+                return
+            seq, created, method, args = entry
+            ok = self.__send(method, args)
+            if ok is None:
+                # closed while waiting to retry, sent again when the log is opened
+                return
+            with self.__lock:
+                self.__pending.pop(seq, None)
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+            try:
+                self.__append(json_dumps(['done', seq, ok]), wait=False)
+            except OSError:
+                pass
+
+    def __send(self, method, args):
+        """
+        :return: True if sent, False if dropped, None if the outbox was closed before it could be sent
+        """
+        delay = self.retry_delay
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.send(method, args)
+                return True
+            except ApiException as e:
+                status = getattr(e.result, 'status_code', None)
+                if status != 429 and (status is None or status < 500):
+                    logger.error("DROPPED {0} FROM THE OUTBOX: {1}".format(method, e))
+                    return False
+                delay = _retry_after(e.result) or delay
+                error = e
+            except (requests.RequestException, OSError) as e:
+                # network errors, the call may or may not have reached Telegram
+                error = e
+            except Exception as e:
+                logger.error("DROPPED {0} FROM THE OUTBOX: {1!r}".format(method, e))
+                return False
+            if attempt < self.max_attempts:
+                with self.__lock:
+                    self.retries += 1
+                if self.__closed.wait(delay):
+                    return None
+                delay = min(delay * 2, 60)
+        logger.error("DROPPED {0} FROM THE OUTBOX AFTER {1} ATTEMPTS: {2}".format(method, self.max_attempts, error))
+        return False
+
+    def __load(self):
+        dirs = os.path.dirname(self.filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, 'rb') as file:
+            for line in file:
+                try:
+                    record = json_loads(line)
+                except ValueError:
+                    # torn last line after a crash
+                    continue
+                if record[0] == 'call':
+                    self.__pending[record[1]] = (record[1], record[2], record[3], record[4])
+                else:
+                    self.__pending.pop(record[1], None)
+                self.__next_seq = max(self.__next_seq, record[1] + 1)
+        self.__compact()
+
+    def __compact(self):
+        """
+        Rewrites the log with the calls not sent yet
+        """
+        with self.__lock:
+            pending = list(self.__pending.values())
+        with open(self.filename + '.tmp', 'w', encoding='utf-8') as file:
+            for seq, created, method, args in pending:
+                file.write(json_dumps(['call', seq, created, method, args]) + '\n')
+            if self.fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(self.filename + '.tmp', self.filename)
+        self.__lines = len(pending)
+
+
+def _retry_after(response):
+    try:
+        return json_loads(response.content)['parameters']['retry_after']
+    except Exception:
+        return None
@@ -0,0 +1,56 @@
+import mmap
+import os
+import pickle
+import time
+
+from .logger import logger
+
+
+def write_snapshot(filename, sections):
+    """
+    Writes sections to filename atomically, one pickle per section so that they can be read one at a time.
+    :param str filename: The snapshot file.
+    :param sections: iterable of (name, data), data must be picklable.
+    :return: size of the snapshot in bytes
+    :rtype: int
+    """
+    dirs = os.path.dirname(filename)
+    if dirs:
+        os.makedirs(dirs, exist_ok=True)
+    with open(filename + '.tmp', 'wb') as file:
+        for name, data in sections:
+            pickle.dump((name, time.time(), data), file, protocol=pickle.HIGHEST_PROTOCOL)
+        size = file.tell()
+    os.replace(filename + '.tmp', filename)
+    return size
+
+
+def read_snapshot(filename, max_age=None):
+    """
+    Yields the sections of a snapshot written by write_snapshot as they are read from a memory map of the file,
+    Sections older than max_age[name] seconds are skipped, a damaged end of file ends the snapshot.
+    :param str filename: The snapshot file, nothing is yielded if it's missing or empty.
+    :param dict or None max_age: Seconds by section name, a missing or None value means no limit.
+    :return: iterator of (name, age in seconds, data)
+    """
+    max_age = max_age or {}
+    try:
+        file = open(filename, 'rb')
+    except OSError:
+        return
+    with file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            while view.tell() < size:
+                try:
+                    name, saved_at, data = pickle.load(view)
+                except Exception as e:
+                    logger.warning("IGNORED THE DAMAGED END OF THE SNAPSHOT {0}: {1!r}".format(filename, e))
+                    return
+                age = max(0, time.time() - saved_at)
+                if max_age.get(name) is not None and age > max_age[name]:
+                    logger.info("IGNORED THE STALE {0} OF THE SNAPSHOT {1}".format(name, filename))
+                    continue
+                yield name, age, data
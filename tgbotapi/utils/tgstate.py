@@ -0,0 +1,230 @@
+import collections
+import os
+import sqlite3
+import threading
+
+from .tgjson import json_dumps, json_loads
+
+
+class StateStorage:
+    """
+    Interface of the conversation state storages of TBot.enable_states, the state name and data dict of
+    every (chat_id, user_id) in a conversation. The SQLite and file storages keep data as JSON.
+    """
+
+    def get(self, chat_id, user_id):
+        """
+        :return: (state, data), (None, {}) if the user isn't in a conversation
+        :rtype: tuple
+        """
+        raise NotImplementedError
+
+    def set(self, chat_id, user_id, state, data):
+        """
+        :param str state: The new state.
+        :param dict data: The new data, replaces the old one.
+        """
+        raise NotImplementedError
+
+    def delete(self, chat_id, user_id):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryStateStorage(StateStorage):
+    """
+    States in memory, the least recently used are dropped past max_entries, they don't survive a restart
+    """
+
+    def __init__(self, max_entries=100000):
+        """
+        :param int max_entries: Maximum number of conversations kept.
+        """
+        if max_entries <= 0:
+            raise ValueError('max_entries must be a positive number, got {0!r}'.format(max_entries))
+        self.max_entries = max_entries
+        self.__states = collections.OrderedDict()
+        # keys set or deleted since begin_restore, None when no restore is expected
+        self.__touched = None
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__states)
+
+    def get(self, chat_id, user_id):
+        with self.__lock:
+            entry = self.__states.get((chat_id, user_id))
+            if entry is None:
+                return None, {}
+            self.__states.move_to_end((chat_id, user_id))
+            return entry[0], dict(entry[1])
+
+    def set(self, chat_id, user_id, state, data):
+        with self.__lock:
+            if self.__touched is not None:
+                self.__touched.add((chat_id, user_id))
+            self.__states[(chat_id, user_id)] = (state, dict(data))
+            self.__states.move_to_end((chat_id, user_id))
+            while len(self.__states) > self.max_entries:
+                self.__states.popitem(last=False)
+
+    def delete(self, chat_id, user_id):
+        with self.__lock:
+            if self.__touched is not None:
+                self.__touched.add((chat_id, user_id))
+            self.__states.pop((chat_id, user_id), None)
+
+    def snapshot(self):
+        """
+        :return: list of (chat_id, user_id, state, data), least recently used first
+        """
+        with self.__lock:
+            return [(chat_id, user_id, state, data) for (chat_id, user_id), (state, data) in self.__states.items()]
+
+    def begin_restore(self):
+        """
+        Records the conversations set or deleted from now on, so restore doesn't bring back an older state of them
+        """
+        with self.__lock:
+            self.__touched = set()
+
+    def end_restore(self):
+        with self.__lock:
+            self.__touched = None
+
+    def restore(self, snapshot):
+        """
+        Adds the conversations of a snapshot, those changed since it was taken or since begin_restore are kept
+        """
+        with self.__lock:
+            touched = self.__touched or ()
+            for chat_id, user_id, state, data in reversed(snapshot):
+                if (chat_id, user_id) not in self.__states and (chat_id, user_id) not in touched:
+                    self.__states[(chat_id, user_id)] = (state, dict(data))
+                    self.__states.move_to_end((chat_id, user_id), last=False)
+            while len(self.__states) > self.max_entries:
+                self.__states.popitem(last=False)
+
+
+class SqliteStateStorage(StateStorage):
+    """
+    States in an SQLite database, one row per conversation read when its user sends a message
+    """
+
+    def __init__(self, filename="./.state-saves/states.db"):
+        """
+        :param str filename: Database file, ':memory:' for a temporary one.
+        """
+        dirs = os.path.dirname(filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        self.filename = filename
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS states (chat_id INTEGER NOT NULL, "
+                                  "user_id INTEGER NOT NULL, state TEXT NOT NULL, data TEXT NOT NULL, "
+                                  "PRIMARY KEY (chat_id, user_id))")
+
+    def __len__(self):
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(*) FROM states").fetchone()[0]
+
+    def get(self, chat_id, user_id):
+        with self.__lock:
+            row = self.__connection.execute("SELECT state, data FROM states WHERE chat_id = ? AND user_id = ?",
+                                            (chat_id, user_id)).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json_loads(row[1])
+
+    def set(self, chat_id, user_id, state, data):
+        data = json_dumps(data)
+        with self.__lock:
+            self.__connection.execute("INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?)",
+                                      (chat_id, user_id, state, data))
+
+    def delete(self, chat_id, user_id):
+        with self.__lock:
+            self.__connection.execute("DELETE FROM states WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+class FileStateStorage(StateStorage):
+    """
+    States in memory and in an append-only file of JSON lines, one line per change,
+    The file is read at startup and compacted once it has twice as many lines as there are conversations.
+    """
+
+    def __init__(self, filename="./.state-saves/states.jsonl"):
+        """
+        :param str filename: The file, created if missing.
+        """
+        self.filename = filename
+        self.__states = {}
+        self.__records = 0
+        self.__lock = threading.Lock()
+        self.__load()
+
+    def __len__(self):
+        return len(self.__states)
+
+    def get(self, chat_id, user_id):
+        with self.__lock:
+            entry = self.__states.get((chat_id, user_id))
+        if entry is None:
+            return None, {}
+        return entry[0], dict(entry[1])
+
+    def set(self, chat_id, user_id, state, data):
+        line = json_dumps([chat_id, user_id, state, data])
+        with self.__lock:
+            self.__states[(chat_id, user_id)] = (state, dict(data))
+            self.__append(line)
+
+    def delete(self, chat_id, user_id):
+        with self.__lock:
+            if self.__states.pop((chat_id, user_id), None) is not None:
+                self.__append(json_dumps([chat_id, user_id, None, None]))
+
+    def __load(self):
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, 'rb') as file:
+            for line in file:
+                try:
+                    chat_id, user_id, state, data = json_loads(line)
+                except ValueError:
+                    # torn last line after a crash
+                    continue
+                self.__records += 1
+                if state is None:
+                    self.__states.pop((chat_id, user_id), None)
+                else:
+                    self.__states[(chat_id, user_id)] = (state, data)
+
+    def __append(self, line):
+        if self.__records >= 2 * max(len(self.__states), 1000):
+            self.__compact()
+            return
+        dirs = os.path.dirname(self.filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        with open(self.filename, 'a', encoding='utf-8') as file:
+            file.write(line + '\n')
+        self.__records += 1
+
+    def __compact(self):
+        dirs = os.path.dirname(self.filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        with open(self.filename + '.tmp', 'w', encoding='utf-8') as file:
+            for (chat_id, user_id), (state, data) in self.__states.items():
+                file.write(json_dumps([chat_id, user_id, state, data]) + '\n')
+        os.replace(self.filename + '.tmp', self.filename)
+        self.__records = len(self.__states)
@@ -1,5 +1,7 @@
 from .logger import logger
 from .extra import ApiException
+from .tgjson import json_loads
+from .tgmultipart import MultipartEncoder
 import queue as q
 import threading
 import traceback
@@ -105,7 +107,9 @@ class ThreadPool:
         for worker in self.workers:
             worker.stop()
         for worker in self.workers:
-            worker.join()
+            # a task closing the pool can't wait for its own thread, which stops once the task returns
+            if worker is not threading.current_thread():
+                worker.join()
 
 
 class AsyncTask:
@@ -215,8 +219,13 @@ def make_request(method, api_url, api_method, files, params, proxies):
         if 'timeout' in params:
             timeout = params['timeout'] + 10
 
-    result = get_req_session().request(method, api_url, params, data=None, headers=None,
-                                        cookies=None, files=files, auth=None, timeout=timeout, allow_redirects=True,
+    data = headers = None
+    if files:
+        # streamed from the files while it is sent instead of being built in memory by requests
+        data = MultipartEncoder(None, files)
+        headers = {'Content-Type': data.content_type}
+    result = get_req_session().request(method, api_url, params, data=data, headers=headers,
+                                        cookies=None, files=None, auth=None, timeout=timeout, allow_redirects=True,
                                         proxies=proxies, verify=None, stream=None, cert=None)
     logger.info("REQUEST DONE!")
     logger.debug("The server returned: '{0}'".format(result.text.encode('utf8')))
@@ -227,7 +236,7 @@ def make_request(method, api_url, api_method, files, params, proxies):
 
     try:
 
-        result_json = result.json()
+        result_json = json_loads(result.content)
     except Exception:
         msg = 'The server returned an invalid JSON response. Response body:\n[{0}]'.format(result.text.encode('utf8'))
         raise ApiException(msg, api_method, result)